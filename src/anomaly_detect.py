@@ -1,11 +1,16 @@
 """
 anomaly_detect.py
-Detects anomalies in URL counts using z-score.
+Detects anomalies in URL counts using z-score, as a batch job over the result
+collections; online_anomaly.py scores URLs as they arrive.
+With --source parquet the per-type counts and average threat scores are computed
+from the Parquet copy written by preprocess.py --parquet instead of read from MongoDB.
 """
 
+import argparse
 from pymongo import MongoClient
 import numpy as np
 from scipy import stats
+import columnar
 
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "cyber_intel"
@@ -13,23 +18,49 @@ DB_NAME = "cyber_intel"
 client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 
-def detect_anomalies(collection, field):
-    cursor = db[collection].find({}, {field: 1})
-    values = [doc[field] for doc in cursor if field in doc]
+def zscore_anomalies(values):
     if not values:
         return []
     z_scores = np.abs(stats.zscore(values))
     anomalies = [i for i, z in enumerate(z_scores) if z > 3]
     return anomalies
 
+def detect_anomalies(collection, field):
+    # The _id (type) of each anomalous document rather than its position
+    docs = [doc for doc in db[collection].find({}, {field: 1}) if field in doc]
+    return [docs[i]['_id'] for i in zscore_anomalies([doc[field] for doc in docs])]
+
+def parquet_values():
+    # Same series the counts_by_type and threat_scores collections hold
+    df = columnar.load_records(['type', 'threat_score'])
+    by_type = df.groupby('type')['threat_score']
+    return by_type.size(), by_type.mean()
+
+def series_anomalies(series):
+    keys = list(series.index)
+    return [keys[i] for i in zscore_anomalies(list(series))]
+
 def main():
+    parser = argparse.ArgumentParser(description='Detect anomalies in aggregated URL counts.')
+    parser.add_argument('--source', choices=['mongo', 'parquet'], default='mongo',
+                        help='read aggregates from MongoDB or compute them from the Parquet copy')
+    args = parser.parse_args()
+
+    if args.source == 'parquet':
+        counts, avg_scores = parquet_values()
+        print("Detecting anomalies in counts by type...")
+        print(f"Anomalous types: {series_anomalies(counts)}")
+        print("Detecting anomalies in threat scores...")
+        print(f"Anomalous types: {series_anomalies(avg_scores)}")
+        return
+
     print("Detecting anomalies in counts_by_type...")
     anomalies = detect_anomalies('counts_by_type', 'value')
-    print(f"Anomalous indices: {anomalies}")
+    print(f"Anomalous types: {anomalies}")
 
     print("Detecting anomalies in threat_scores...")
     anomalies = detect_anomalies('threat_scores', 'avg_threat_score')
-    print(f"Anomalous indices: {anomalies}")
+    print(f"Anomalous types: {anomalies}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
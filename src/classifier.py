@@ -0,0 +1,150 @@
+"""
+classifier.py
+Classifies raw URLs with the model saved by ml_predict.py, for the dashboard's
+/api/classify endpoint.
+
+URLs go through the same path as the ingested data: preprocess.parse_batch (the
+columnar parse_row) for the record fields, then ml_predict.predict_batch for the
+derived features and the model. Both cost little per extra URL and a fixed amount
+per call, so MicroBatcher coalesces concurrent requests: a request waits at most
+MAX_WAIT_MS for others to join its batch (up to MAX_BATCH URLs), and one model call
+answers all of them.
+--benchmark times concurrent clients with and without the micro-batching.
+"""
+
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from pymongo import MongoClient
+import preprocess
+import ml_predict
+
+MONGO_URI = "mongodb://localhost:27017/"
+DB_NAME = "cyber_intel"
+COLL_NAME = "urls"
+MAX_BATCH = 1024  # URLs per model call
+MAX_WAIT_MS = 5  # a request waits at most this long for others to join its batch
+BENCH_CLIENTS = 16
+BENCH_REQUESTS = 100  # per client
+BENCH_URLS = 4  # per request
+
+client = MongoClient(MONGO_URI)
+db = client[DB_NAME]
+col = db[COLL_NAME]
+
+def classify_urls(bundle, urls):
+    """One {'url', 'predicted_type', 'confidence'} (or {'url', 'error'}) per input URL, in order."""
+    urls = pd.Series(urls, dtype=object)
+    results = [{'url': u, 'error': 'not a URL'} for u in urls]
+    # parse_batch expects strings; anything else is reported, not parsed
+    text = urls[urls.map(lambda u: isinstance(u, str))]
+    records = preprocess.parse_batch(text, pd.Series([''] * len(text), index=text.index, dtype=object))
+    if len(records):
+        labels, confidence = ml_predict.predict_batch(bundle, records.drop(columns='type'))
+        for pos, label, conf in zip(records.index, labels, confidence):
+            results[pos] = {'url': urls[pos], 'predicted_type': label, 'confidence': round(conf, 4)}
+    return results
+
+class MicroBatcher:
+    """Runs classify_urls on a worker thread over the URLs of every request waiting for it."""
+
+    def __init__(self, bundle, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.bundle = bundle
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, urls):
+        future = Future()
+        self.pending.put((list(urls), future))
+        return future
+
+    def classify(self, urls, timeout=None):
+        return self.submit(urls).result(timeout)
+
+    def run(self):
+        while True:
+            requests = [self.pending.get()]
+            size = len(requests[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    requests.append(self.pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+                size += len(requests[-1][0])
+            self.answer(requests)
+
+    def answer(self, requests):
+        urls = [u for batch, _ in requests for u in batch]
+        try:
+            results = classify_urls(self.bundle, urls)
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        start = 0
+        for batch, future in requests:
+            future.set_result(results[start:start + len(batch)])
+            start += len(batch)
+
+def run_clients(classify, urls, clients, requests, per_request):
+    """(per-request latencies in seconds, wall seconds) for `clients` threads calling classify."""
+    def client_loop(c):
+        latencies = []
+        for r in range(requests):
+            at = (c * requests + r) * per_request % max(len(urls) - per_request, 1)
+            start = time.perf_counter()
+            classify(urls[at:at + per_request])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        latencies = [x for part in pool.map(client_loop, range(clients)) for x in part]
+    return np.array(latencies), time.perf_counter() - start
+
+def benchmark(bundle, clients=BENCH_CLIENTS, requests=BENCH_REQUESTS, per_request=BENCH_URLS):
+    urls = [d['url'] for d in col.aggregate([{'$sample': {'size': 20000}}, {'$project': {'url': 1}}])]
+    if not urls:
+        print("No URLs in the collection to benchmark with")
+        return
+    total = clients * requests * per_request
+    print(f"{clients} clients x {requests} requests x {per_request} URLs")
+    batcher = MicroBatcher(bundle)
+    for name, classify in [('one model call per request', lambda u: classify_urls(bundle, u)),
+                           ('micro-batched', batcher.classify)]:
+        latencies, secs = run_clients(classify, urls, clients, requests, per_request)
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"  {name:<28} {total / secs:>9,.0f} URLs/s   p50 {p50:6.1f} ms   p99 {p99:6.1f} ms")
+    print(f"  ({batcher.batches} model calls for {clients * requests} requests)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify URLs with the saved model.')
+    parser.add_argument('urls', nargs='*')
+    parser.add_argument('--benchmark', action='store_true', help='time concurrent clients against the model')
+    parser.add_argument('--clients', type=int, default=BENCH_CLIENTS)
+    parser.add_argument('--requests', type=int, default=BENCH_REQUESTS, help='requests per client')
+    parser.add_argument('--urls-per-request', type=int, default=BENCH_URLS)
+    args = parser.parse_args()
+
+    bundle = ml_predict.load_model()
+    if bundle is None:
+        print("No trained model at", ml_predict.MODEL_PATH, "- run ml_predict.py first")
+        return
+    if args.benchmark:
+        benchmark(bundle, args.clients, args.requests, args.urls_per_request)
+        return
+    for result in classify_urls(bundle, args.urls):
+        print(result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+columnar.py
+Typed Parquet copy of the processed_urls records, written by preprocess.py --parquet
+into data/processed_urls_parquet/ (zstd-compressed, one row group per parsed chunk).
+
+load_records() reads it memory-mapped straight into pandas, so ml_predict.py,
+anomaly_detect.py and visualize.py can skip both JSON decoding and MongoDB.
+Run this file to compare size and load time against processed_urls.json.
+"""
+
+import os
+import glob
+import json
+import time
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = pq = None
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+JSON_PATH = os.path.join(DATA_DIR, 'processed_urls.json')
+PARQUET_DIR = os.path.join(DATA_DIR, 'processed_urls_parquet')  # part-NNNNN.parquet
+COMPRESSION = 'zstd'
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+
+def record_schema():
+    require_pyarrow()
+    # Same fields and order as preprocess.RECORD_FIELDS
+    return pa.schema([
+        ('url', pa.string()),
+        ('type', pa.string()),
+        ('domain', pa.string()),
+        ('subdomain', pa.string()),
+        ('tld', pa.string()),
+        ('path', pa.string()),
+        ('query', pa.string()),
+        ('scheme', pa.string()),
+        ('has_https', pa.bool_()),
+        ('url_length', pa.int32()),
+        ('num_subdomains', pa.int32()),
+        ('country', pa.string()),
+        ('threat_score', pa.float64()),
+    ])
+
+def part_path(seq):
+    return os.path.join(PARQUET_DIR, f'part-{seq:05d}.parquet')
+
+def next_part_seq():
+    return len(glob.glob(os.path.join(PARQUET_DIR, 'part-*.parquet')))
+
+def available():
+    return pa is not None and next_part_seq() > 0
+
+def to_table(out):
+    return pa.Table.from_pandas(out, schema=record_schema(), preserve_index=False)
+
+def open_writer(path):
+    return pq.ParquetWriter(path, record_schema(), compression=COMPRESSION)
+
+def write_part(out, path):
+    pq.write_table(to_table(out), path, compression=COMPRESSION)
+
+def load_records(columns=None):
+    """Reads every part (only the requested columns) memory-mapped into one DataFrame."""
+    require_pyarrow()
+    if not available():
+        raise FileNotFoundError(f"No Parquet parts in {PARQUET_DIR}. Run preprocess.py --parquet first.")
+    return pq.read_table(PARQUET_DIR, columns=columns, memory_map=True).to_pandas()
+
+def load_json_records(path=JSON_PATH):
+    # What ingest.py does per line, collected into a DataFrame
+    with open(path, 'r', encoding='utf-8') as fin:
+        return pd.DataFrame([json.loads(line) for line in fin])
+
+def dir_size(path):
+    return sum(os.path.getsize(p) for p in glob.glob(os.path.join(path, '*.parquet')))
+
+def main():
+    json_mb = os.path.getsize(JSON_PATH) / 2**20
+    parquet_mb = dir_size(PARQUET_DIR) / 2**20
+    print(f"Size: JSON lines {json_mb:,.1f} MB, Parquet {parquet_mb:,.1f} MB ({parquet_mb / json_mb:.0%})")
+
+    timings = [
+        ('JSON lines, all fields', load_json_records),
+        ('Parquet, all fields', load_records),
+        ('Parquet, numeric fields', lambda: load_records(['url_length', 'num_subdomains', 'has_https', 'threat_score'])),
+    ]
+    for name, load in timings:
+        start = time.perf_counter()
+        df = load()
+        print(f"{name:>24}: {time.perf_counter() - start:.2f}s for {len(df)} rows")
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,26 @@ dashboard.py
 Professional interactive dashboard for Cybersecurity Threat Intelligence.
 """
 
-from flask import Flask, render_template_string, jsonify
+import threading
+from flask import Flask, render_template_string, jsonify, request
 from pymongo import MongoClient
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import numpy as np
+import hll
+import histograms
+import classifier
+import ml_predict
+import heavy_hitters
 
 app = Flask(__name__)
 
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "cyber_intel"
+MAX_CLASSIFY_URLS = 10000  # per /api/classify request
 
 # Custom color palette
 COLORS = {
@@ -40,32 +47,94 @@ def get_threat_summary():
     return {
         'total_urls': total_urls,
         'malicious_urls': malicious,
+        'distinct_malicious_domains': distinct_malicious_domains(),
         'benign_urls': total_urls - malicious,
         'threat_percentage': round((malicious / total_urls * 100), 2) if total_urls > 0 else 0,
         'avg_threat_score': round(avg_threat, 2),
         'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
 
+def distinct_malicious_domains():
+    """Union of the per-type HyperLogLog sketches for every non-benign type."""
+    union = None
+    for doc in db['distinct_domains'].find({'field': 'type', 'value': {'$ne': 'benign'}}):
+        sketch = hll.HyperLogLog.from_bytes(doc['registers'], doc['p'])
+        union = sketch if union is None else union.merge(sketch)
+    return union.count() if union else 0
+
+@app.route('/api/distinct_domains')
+def api_distinct_domains():
+    """Estimated distinct domains per type, tld and country."""
+    result = {}
+    for doc in db['distinct_domains'].find({}, {'registers': 0}).sort('estimate', -1):
+        result.setdefault(doc['field'], []).append({'value': doc['value'], 'estimate': doc['estimate']})
+    return jsonify({'relative_error': hll.HyperLogLog().relative_error(), 'groups': result})
+
+@app.route('/api/outliers')
+@app.route('/api/outliers/<level>/<metric>')
+def api_outliers(level='domain', metric='malicious'):
+    """Top peer outliers (peer_outliers.py) for a level (domain, tld) and metric."""
+    docs = db['peer_outliers'].find({'level': level, 'metric': metric}, {'_id': 0}).sort('rank', 1).limit(100)
+    return jsonify(list(docs))
+
+batcher = None
+batcher_lock = threading.Lock()
+
+def get_batcher():
+    """The micro-batcher over the saved model, loaded on the first classification."""
+    global batcher
+    with batcher_lock:
+        if batcher is None:
+            bundle = ml_predict.load_model()
+            if bundle is not None:
+                batcher = classifier.MicroBatcher(bundle)
+        return batcher
+
+@app.route('/api/classify', methods=['POST'])
+def api_classify():
+    """Predicted type and confidence for {"urls": [...]} (or {"url": ...})."""
+    body = request.get_json(silent=True)
+    urls = None
+    if isinstance(body, dict):
+        urls = body.get('urls', [body['url']] if 'url' in body else None)
+    if not isinstance(urls, list) or not urls or len(urls) > MAX_CLASSIFY_URLS:
+        return jsonify({'error': f'expected {{"urls": [...]}} with 1 to {MAX_CLASSIFY_URLS} URLs'}), 400
+    # Checked here, so one bad request cannot fail the micro-batch it would share
+    bad = [i for i, u in enumerate(urls) if not isinstance(u, str)]
+    if bad:
+        return jsonify({'error': 'URLs must be strings', 'positions': bad[:100]}), 400
+    batch = get_batcher()
+    if batch is None:
+        return jsonify({'error': 'no trained model; run ml_predict.py'}), 503
+    return jsonify({'model_version': batch.bundle.get('version'), 'results': batch.classify(urls)})
+
 @app.route('/')
 def index():
     # Fetch data
     counts = list(db['counts_by_type'].find())
     df_counts = pd.DataFrame(counts)
 
-    domains = list(db['mal_domains'].find().sort('value', -1).limit(10))
-    df_domains = pd.DataFrame(domains)
+    # Space-Saving summary (heavy_hitters.py); the exact counts until one is stored
+    top, bound = heavy_hitters.top_k('mal_domains', 10)
+    if not top:
+        top = [{'item': d['_id'], 'count': d['value'], 'lower': d['value']}
+               for d in db['mal_domains'].find().sort('value', -1).limit(10)]
+    df_domains = pd.DataFrame({'_id': [r['item'] for r in top], 'value': [r['count'] for r in top],
+                               'lower': [r['lower'] for r in top]})
+    domains_title = 'Top 10 Malicious Domains' + (f' (counts high by at most {bound:,.0f})' if bound else '')
 
     scores = list(db['threat_scores'].find())
     df_scores = pd.DataFrame(scores)
 
     threat_summary = get_threat_summary()
+    outliers = list(db['peer_outliers'].find({'level': 'domain', 'metric': 'malicious'}).sort('rank', 1).limit(10))
 
     # Create subplots with improved layout
     fig = make_subplots(
         rows=3, cols=2,
         subplot_titles=(
             'URL Classification Distribution',
-            'Top 10 Malicious Domains',
+            domains_title,
             'Average Threat Scores by Type',
             'Threat Score Distribution',
             'Threat Detection Timeline',
@@ -73,7 +142,7 @@ def index():
         ),
         specs=[
             [{'type': 'pie'}, {'type': 'bar'}],
-            [{'type': 'bar'}, {'type': 'histogram'}],
+            [{'type': 'bar'}, {'type': 'bar'}],
             [{'type': 'scatter'}, {'type': 'table'}]
         ],
         vertical_spacing=0.12,
@@ -98,9 +167,10 @@ def index():
         go.Bar(
             x=df_domains['_id'],
             y=df_domains['value'],
+            customdata=df_domains['lower'],
             name='Detected Threats',
             marker_color=COLORS['secondary'],
-            hovertemplate="<b>Domain: %{x}</b><br>Threats Detected: %{y}<extra></extra>"
+            hovertemplate="<b>Domain: %{x}</b><br>Threats Detected: %{y} (at least %{customdata})<extra></extra>"
         ),
         row=1, col=2
     )
@@ -120,42 +190,55 @@ def index():
         row=2, col=1
     )
 
-    # Add threat score distribution histogram
-    all_scores = list(db['urls'].find({}, {'threat_score': 1}))
-    scores_list = [doc.get('threat_score', 0) for doc in all_scores if 'threat_score' in doc]
-    
+    # Threat score distribution from the stored histogram (mapreduce_queries.py)
+    score_bins = histograms.load(db['threat_score_hist'])
     fig.add_trace(
-        go.Histogram(
-            x=scores_list,
-            nbinsx=20,
+        go.Bar(
+            x=[(b['lower'] + b['upper']) / 2 for b in score_bins],
+            y=[b['value'] for b in score_bins],
+            width=[b['upper'] - b['lower'] for b in score_bins],
+            customdata=[[b['lower'], b['upper']] for b in score_bins],
             name='Score Distribution',
             marker_color=COLORS['accent'],
-            hovertemplate="Score Range: %{x}<br>Count: %{y}<extra></extra>"
+            hovertemplate="Score Range: %{customdata[0]:.2f}-%{customdata[1]:.2f}<br>Count: %{y}<extra></extra>"
         ),
         row=2, col=2
     )
 
-    # Add timeline of threats (last 7 days)
-    timeline = list(db['urls'].find(
-        {'timestamp': {'$exists': True}},
-        {'timestamp': 1, 'type': 1}
-    ).sort('timestamp', -1).limit(100))
-    
-    df_timeline = pd.DataFrame(timeline)
-    if not df_timeline.empty and 'timestamp' in df_timeline:
+    # Timeline of threats (last 7 days) from the per-minute windows (time_windows.py),
+    # with the windows burst_detect.py flagged
+    since = datetime.now(timezone.utc) - timedelta(days=7)
+    timeline = list(db['url_windows'].aggregate([
+        {'$match': {'field': 'type', 'start': {'$gte': since}}},
+        {'$group': {'_id': {'start': '$start', 'malicious': {'$ne': ['$key', 'benign']}},
+                    'count': {'$sum': '$count'}}},
+        {'$sort': {'_id.start': 1}}
+    ]))
+    for malicious, label, color in [(True, 'Malicious URLs', COLORS['warning']), (False, 'Benign URLs', COLORS['success'])]:
+        points = [t for t in timeline if t['_id']['malicious'] == malicious]
+        if points:
+            fig.add_trace(
+                go.Scatter(
+                    x=[t['_id']['start'] for t in points],
+                    y=[t['count'] for t in points],
+                    mode='lines',
+                    line=dict(color=color),
+                    name=label,
+                    hovertemplate="<b>%{x}</b><br>" + label + ": %{y}<extra></extra>"
+                ),
+                row=3, col=1
+            )
+    bursts = list(db['window_anomalies'].find({'field': 'all', 'start': {'$gte': since}}))
+    if bursts:
         fig.add_trace(
             go.Scatter(
-                x=df_timeline['timestamp'],
-                y=[1] * len(df_timeline),
+                x=[b['start'] for b in bursts],
+                y=[b['count'] for b in bursts],
                 mode='markers',
-                marker=dict(
-                    color=[COLORS['warning'] if t != 'benign' else COLORS['success'] for t in df_timeline['type']],
-                    symbol='diamond',
-                    size=10
-                ),
-                name='Threat Timeline',
-                hovertemplate="<b>Detection Time</b>: %{x}<br>Type: %{text}<extra></extra>",
-                text=df_timeline['type']
+                marker=dict(color=COLORS['secondary'], symbol='diamond', size=10),
+                name='Burst',
+                hovertemplate="<b>Burst</b>: %{x}<br>URLs: %{y}<br>Robust score: %{text}<extra></extra>",
+                text=[f"{b['robust']:+.1f}" for b in bursts]
             ),
             row=3, col=1
         )
@@ -286,6 +369,18 @@ def index():
             .chart-container {
                 margin-top: 30px;
             }
+            .outliers {
+                margin-top: 30px;
+            }
+            .outliers table {
+                width: 100%;
+                border-collapse: collapse;
+            }
+            .outliers th, .outliers td {
+                padding: 8px;
+                text-align: left;
+                border-bottom: 1px solid var(--background);
+            }
             footer {
                 text-align: center;
                 margin-top: 30px;
@@ -321,6 +416,10 @@ def index():
                     <div class="status-label">Threats Detected</div>
                     <div class="status-value">{{ summary.malicious_urls }}</div>
                 </div>
+                <div class="status-item">
+                    <div class="status-label">Distinct Malicious Domains</div>
+                    <div class="status-value">~{{ summary.distinct_malicious_domains }}</div>
+                </div>
                 <div class="status-item">
                     <div class="status-label">Detection Rate</div>
                     <div class="status-value">{{ summary.threat_percentage }}%</div>
@@ -335,13 +434,31 @@ def index():
                 {{ graph_html | safe }}
             </div>
 
+            {% if outliers %}
+            <div class="outliers">
+                <h2>Domains Out of Line with Their TLD</h2>
+                <table>
+                    <tr><th>Domain</th><th>TLD</th><th>Malicious URLs</th><th>TLD Median</th><th>Robust Score</th></tr>
+                    {% for o in outliers %}
+                    <tr>
+                        <td>{{ o.key }}</td>
+                        <td>{{ o.group }}</td>
+                        <td>{{ o.value | int }}</td>
+                        <td>{{ '%.1f' | format(o.median) }}</td>
+                        <td>{{ '%.1f' | format(o.score) }}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+            </div>
+            {% endif %}
+
             <footer>
                 <p>Last Updated: {{ summary.last_updated }} | Cybersecurity Threat Intelligence Platform</p>
             </footer>
         </div>
     </body>
     </html>
-    """, graph_html=graph_html, summary=threat_summary)
+    """, graph_html=graph_html, summary=threat_summary, outliers=outliers)
 
 def find_free_port(start_port=5001):
     """Find a free port starting from start_port."""
@@ -0,0 +1,50 @@
+"""
+domains.py
+Offline, cached domain decomposition (domain, subdomain, tld) used by preprocess.py,
+ml_predict.py and realtime.py.
+
+The public suffix list comes from data/public_suffix_list.dat when present, otherwise
+from the snapshot bundled with tldextract -- it is never fetched over the network.
+Results are memoized per netloc in a bounded LRU; cache_stats() reports hits/misses.
+"""
+
+import os
+from functools import lru_cache
+from urllib.parse import urlsplit
+import tldextract
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+SUFFIX_LIST_PATH = os.path.join(DATA_DIR, 'public_suffix_list.dat')  # optional pinned copy
+CACHE_SIZE = 200000  # distinct netlocs kept in memory
+
+def make_extractor(suffix_list_path=SUFFIX_LIST_PATH):
+    urls = ()
+    if os.path.exists(suffix_list_path):
+        urls = ('file://' + os.path.abspath(suffix_list_path),)
+    # cache_dir=None: no disk cache and no remote URLs, so a cold start stays offline
+    return tldextract.TLDExtract(cache_dir=None, suffix_list_urls=urls, fallback_to_snapshot=True)
+
+_extract = make_extractor()
+
+@lru_cache(maxsize=CACHE_SIZE)
+def split_netloc(netloc):
+    """Returns (domain, subdomain, tld) for a netloc, exactly as parse_row stores them."""
+    td = _extract('http://' + netloc)
+    domain = '.'.join([s for s in [td.domain, td.suffix] if s]) or netloc
+    subdomain = td.subdomain or ''
+    tld = td.suffix or ''
+    return domain, subdomain, tld
+
+def split_url(url):
+    if not url.startswith(('http://', 'https://')):
+        url = 'http://' + url
+    try:
+        netloc = urlsplit(url).netloc
+    except ValueError:
+        # e.g. unbalanced IPv6 brackets
+        netloc = ''
+    return split_netloc(netloc)
+
+def cache_stats():
+    info = split_netloc.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
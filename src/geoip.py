@@ -0,0 +1,110 @@
+"""
+geoip.py
+Country enrichment for preprocess.get_country() from a local MaxMind-format database
+(data/GeoLite2-Country.mmdb or any Country/City .mmdb), opened memory-mapped.
+
+How a domain becomes an address depends on the resolve mode:
+ - 'off':   only hosts that are IP literals are looked up
+ - 'cache': names are answered from data/resolver_cache.tsv (domain<TAB>ip), never the network
+ - 'dns':   like 'cache', but misses are resolved with DNS and appended to the cache file
+Each distinct domain is looked up once per process and kept in an LRU.
+Without the database (or the maxminddb package) every domain is 'Unknown'.
+"""
+
+import os
+import socket
+import ipaddress
+from functools import lru_cache
+
+try:
+    import maxminddb
+except ImportError:  # installed with geoip2
+    maxminddb = None
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+GEOIP_DB = os.path.join(DATA_DIR, 'GeoLite2-Country.mmdb')
+RESOLVER_CACHE = os.path.join(DATA_DIR, 'resolver_cache.tsv')
+RESOLVE_MODES = ['off', 'cache', 'dns']
+CACHE_SIZE = 200000  # distinct domains kept in memory
+UNKNOWN = 'Unknown'
+
+_settings = {'db_path': GEOIP_DB, 'resolve': 'off'}
+_reader = None
+_resolved = None  # resolver cache file contents, loaded on first use
+
+def configure(db_path=GEOIP_DB, resolve='off'):
+    # Also used as the process pool initializer so workers get the same settings
+    global _reader, _resolved
+    if resolve not in RESOLVE_MODES:
+        raise ValueError(f"resolve must be one of {RESOLVE_MODES}")
+    _settings.update(db_path=db_path, resolve=resolve)
+    _reader = None
+    _resolved = None
+    country_of.cache_clear()
+
+def current_settings():
+    return _settings['db_path'], _settings['resolve']
+
+def get_reader():
+    global _reader
+    path = _settings['db_path']
+    if _reader is None and maxminddb is not None and path and os.path.exists(path):
+        _reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+    return _reader
+
+def enabled():
+    return get_reader() is not None
+
+def load_resolver_cache(path=RESOLVER_CACHE):
+    cache = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                domain, _, ip = line.rstrip('\n').partition('\t')
+                cache[domain] = ip  # '' records a failed lookup
+    return cache
+
+def resolve(domain):
+    try:
+        ipaddress.ip_address(domain)
+        return domain
+    except ValueError:
+        pass
+    if _settings['resolve'] == 'off' or not domain:
+        return None
+    global _resolved
+    if _resolved is None:
+        _resolved = load_resolver_cache()
+    if domain in _resolved:
+        return _resolved[domain] or None
+    if _settings['resolve'] != 'dns':
+        return None
+    try:
+        ip = socket.gethostbyname(domain)
+    except (OSError, UnicodeError):
+        ip = ''
+    _resolved[domain] = ip
+    # One short append per name, so concurrent workers can share the file
+    with open(RESOLVER_CACHE, 'a', encoding='utf-8') as f:
+        f.write(f"{domain}\t{ip}\n")
+    return ip or None
+
+@lru_cache(maxsize=CACHE_SIZE)
+def country_of(domain):
+    reader = get_reader()
+    if reader is None:
+        return UNKNOWN
+    ip = resolve(domain)
+    if ip is None:
+        return UNKNOWN
+    try:
+        record = reader.get(ip)
+    except ValueError:
+        return UNKNOWN
+    country = (record or {}).get('country') or (record or {}).get('registered_country') or {}
+    return country.get('names', {}).get('en') or UNKNOWN
+
+def lookup_countries(domains):
+    """Countries for a batch of domains, looking up each distinct domain once."""
+    found = {domain: country_of(domain) for domain in set(domains)}
+    return [found[domain] for domain in domains]
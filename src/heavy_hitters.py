@@ -0,0 +1,253 @@
+"""
+heavy_hitters.py
+Bounded-memory top-k of malicious domains and TLDs (Space-Saving summaries),
+kept in cyber_intel.heavy_hitters so they survive restarts.
+
+A summary with capacity m tracks at most m items. Every reported count
+overestimates the true count by at most its own `error`, and never by more than
+total / m, so any item seen more often than that is guaranteed to be tracked.
+
+Run this file to fold in the documents ingested since the last update
+(the same ingested_at watermark as mapreduce_queries.py --incremental);
+realtime.py runs the same fold every few seconds. update() is the only writer:
+counting goes strictly by the watermark, so no document is counted twice, and a
+lease in aggregate_state keeps two folds (say main.py's and realtime's) from
+overwriting each other. A long fold renews the lease as it goes, and one that has
+lost it anyway does not save.
+--top K prints the current top K with bounds, --benchmark compares accuracy and
+memory against exact counts for several capacities.
+"""
+
+import os
+import time
+import heapq
+import socket
+import argparse
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+import mapreduce_queries
+
+MONGO_URI = "mongodb://localhost:27017/"
+DB_NAME = "cyber_intel"
+COLL_NAME = "urls"
+SKETCH_COLL = "heavy_hitters"
+CAPACITY = 1000  # counters per summary
+SUMMARIES = ['mal_domains', 'malicious_tlds']
+BENCH_CAPACITIES = [50, 100, 500, 1000, 5000]
+LEASE_ID = 'heavy_hitters_lease'  # in mapreduce_queries.STATE_COLL
+LEASE_SECONDS = 600  # a crashed holder blocks other folds at most this long
+RENEW_SECONDS = 60  # a running fold extends its lease this often
+
+client = MongoClient(MONGO_URI)
+db = client[DB_NAME]
+col = db[COLL_NAME]
+
+class SpaceSaving:
+    """
+    Space-Saving summary (Metwally et al.). When all counters are taken, a new item
+    replaces the smallest one and inherits its count as error, so count - error <=
+    true count <= count. The heap holds stale entries too; they are skipped on pop.
+    """
+
+    def __init__(self, capacity=CAPACITY, counters=None, total=0):
+        self.capacity = capacity
+        self.total = total
+        self.counts = {item: [count, error] for item, count, error in counters or []}
+        self.heap = [(count, item) for item, (count, _) in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, item, weight=1):
+        self.total += weight
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += weight
+        elif len(self.counts) < self.capacity:
+            entry = self.counts[item] = [weight, 0]
+        else:
+            while True:
+                low, victim = heapq.heappop(self.heap)
+                if self.counts.get(victim, [None])[0] == low:
+                    break
+            del self.counts[victim]
+            entry = self.counts[item] = [low + weight, low]
+        heapq.heappush(self.heap, (entry[0], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, key) for key, (count, _) in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def bound(self):
+        # No count is off by more than this
+        return self.total / self.capacity
+
+    def top(self, k=10):
+        """The k largest counters with their bounds; 'guaranteed' means certainly in the true top k."""
+        ranked = sorted(self.counts.items(), key=lambda kv: kv[1][0], reverse=True)
+        cutoff = ranked[k][1][0] if len(ranked) > k else 0
+        return [{'item': item, 'count': count, 'error': error, 'lower': count - error,
+                 'guaranteed': count - error >= cutoff}
+                for item, (count, error) in ranked[:k]]
+
+    def to_doc(self):
+        return {'capacity': self.capacity, 'total': self.total,
+                'counters': [[item, count, error] for item, (count, error) in self.counts.items()]}
+
+    @classmethod
+    def from_doc(cls, doc):
+        return cls(doc['capacity'], doc['counters'], doc['total'])
+
+def load_summaries(capacity=CAPACITY):
+    """Returns ({name: SpaceSaving}, watermark) from SKETCH_COLL, empty summaries if none are stored."""
+    summaries = {}
+    watermark = None
+    for name in SUMMARIES:
+        doc = db[SKETCH_COLL].find_one({'_id': name})
+        summaries[name] = SpaceSaving.from_doc(doc) if doc else SpaceSaving(capacity)
+        if doc:
+            watermark = doc.get('watermark')
+    return summaries, watermark
+
+def save_summaries(summaries, watermark):
+    for name, summary in summaries.items():
+        doc = dict(summary.to_doc(), watermark=watermark, updated=datetime.now(timezone.utc))
+        db[SKETCH_COLL].replace_one({'_id': name}, doc, upsert=True)
+
+def observe(summaries, doc):
+    # Same keys as mal_domains and malicious_tld_counts; a missing domain counts as 'unknown'
+    if doc.get('type') == 'benign':
+        return
+    summaries['mal_domains'].add(doc.get('domain') or 'unknown')
+    tld = doc.get('tld')
+    summaries['malicious_tlds'].add('unknown' if tld is None else tld)
+
+def acquire_lease(owner):
+    """True if owner now holds the fold lease (free, expired or already its own)."""
+    now = datetime.now(timezone.utc)
+    try:
+        db[mapreduce_queries.STATE_COLL].update_one(
+            {'_id': LEASE_ID, '$or': [{'expires': {'$lt': now}}, {'owner': owner}]},
+            {'$set': {'owner': owner, 'expires': now + timedelta(seconds=LEASE_SECONDS)}}, upsert=True)
+    except DuplicateKeyError:
+        # Held by someone else: the filter missed and the upsert hit the existing _id
+        return False
+    return True
+
+def release_lease(owner):
+    db[mapreduce_queries.STATE_COLL].delete_one({'_id': LEASE_ID, 'owner': owner})
+
+def update(capacity=CAPACITY, rebuild=False, wait=True, verbose=True):
+    """
+    Folds the documents ingested since the stored watermark into the summaries.
+    Returns the summaries, or None if wait is False and another fold holds the lease.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    while not acquire_lease(owner):
+        if not wait:
+            return None
+        time.sleep(1)
+    try:
+        return _fold(capacity, rebuild, verbose, owner)
+    finally:
+        release_lease(owner)
+
+def _renew(owner):
+    if not acquire_lease(owner):
+        raise RuntimeError("Lost the heavy-hitter lease to another fold; not saving")
+
+def _fold(capacity, rebuild, verbose, owner):
+    summaries, watermark = load_summaries(capacity)
+    if rebuild or watermark is None:
+        summaries = {name: SpaceSaving(capacity) for name in SUMMARIES}
+        watermark = None
+    upper = mapreduce_queries.settled_time()
+    if watermark is None:
+        match = mapreduce_queries.up_to(upper)
+    else:
+        match = {'ingested_at': {'$gt': watermark, '$lte': upper}}
+    start = renewed = time.perf_counter()
+    seen = 0
+    for doc in col.find(match, {'type': 1, 'domain': 1, 'tld': 1, '_id': 0},
+                        batch_size=mapreduce_queries.BATCH_SIZE):
+        observe(summaries, doc)
+        seen += 1
+        if time.perf_counter() - renewed > RENEW_SECONDS:
+            _renew(owner)
+            renewed = time.perf_counter()
+    # Renewed right before saving, so the save finishes well inside the lease
+    _renew(owner)
+    save_summaries(summaries, upper)
+    if verbose:
+        print(f"Folded {seen} documents into the summaries in {time.perf_counter() - start:.2f}s")
+    return summaries
+
+def top_k(name, k=10):
+    """Top k of a stored summary, plus the summary's global error bound."""
+    doc = db[SKETCH_COLL].find_one({'_id': name})
+    if not doc:
+        return [], 0
+    summary = SpaceSaving.from_doc(doc)
+    return summary.top(k), summary.bound()
+
+def print_top(k=15):
+    for name in SUMMARIES:
+        rows, bound = top_k(name, k)
+        print(f"{name} (counts overestimate by at most {bound:,.0f}):")
+        for row in rows:
+            flag = '' if row['guaranteed'] else '  (may not be in the true top)'
+            print(f"  {row['item']:<40} {row['count']:>10} (>= {row['lower']}){flag}")
+
+def _traced(fn):
+    # (result, bytes still allocated by fn's result)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+def benchmark(k=15, capacities=BENCH_CAPACITIES):
+    """Recall of the true top k, worst count error and memory of each capacity against an exact Counter."""
+    keys = [doc.get('domain') or 'unknown'
+            for doc in col.find({'type': {'$ne': 'benign'}}, {'domain': 1, '_id': 0},
+                                batch_size=mapreduce_queries.BATCH_SIZE)]
+    exact, exact_bytes = _traced(lambda: Counter(keys))
+    truth = [item for item, _ in exact.most_common(k)]
+    print(f"{len(keys)} malicious URLs, {len(exact)} distinct domains; "
+          f"exact counts use {exact_bytes / 2**10:,.0f} KB")
+    print(f"{'capacity':>9} {'recall@' + str(k):>10} {'max error':>10} {'bound':>9} {'memory':>10} {'secs':>6}")
+    for capacity in capacities:
+        def feed():
+            summary = SpaceSaving(capacity)
+            for key in keys:
+                summary.add(key)
+            return summary
+        start = time.perf_counter()
+        summary, size = _traced(feed)
+        secs = time.perf_counter() - start
+        top = summary.top(k)
+        recall = len({row['item'] for row in top} & set(truth)) / max(len(truth), 1)
+        worst = max((row['count'] - exact[row['item']] for row in top), default=0)
+        print(f"{capacity:>9} {recall:>10.0%} {worst:>10} {summary.bound():>9,.0f} "
+              f"{size / 2**10:>8,.0f} KB {secs:>6.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain top-k summaries of malicious domains and TLDs.')
+    parser.add_argument('--capacity', type=int, default=CAPACITY, help='counters per summary')
+    parser.add_argument('--rebuild', action='store_true', help='start the summaries over from the whole collection')
+    parser.add_argument('--top', type=int, metavar='K', help='print the stored top K instead of updating')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare accuracy and memory with exact counts for several capacities')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+    elif args.top:
+        print_top(args.top)
+    else:
+        update(args.capacity, args.rebuild)
+        print_top()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+histograms.py
+Numeric histograms of any urls field (url_length, threat_score, num_subdomains, ...),
+optionally grouped by another field such as type.
+
+Bins are computed in MongoDB and stored as numbers, one document per (key, bin):
+  {'_id': {'key': 'phishing', 'lower': 50.0}, 'key': 'phishing', 'lower': 50.0, 'upper': 100.0, 'value': 12}
+so results sort by edge, merge by adding 'value' per _id, and fixed-width bins can
+be re-binned into wider ones. Bin modes:
+ - fixed:    [k * width, (k + 1) * width)
+ - log:      [base**k - 1, base**(k + 1) - 1), for non-negative values
+ - quantile: edges from $bucketAuto (roughly equal counts), kept in histogram_edges
+             so later deltas are binned the same way; values outside are clamped
+             and the last bin includes its upper edge
+Documents without a numeric value are left out.
+"""
+
+import math
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from pymongo import UpdateOne
+
+EDGES_COLL = "histogram_edges"
+LOG_EPSILON = 1e-9  # keeps exact powers of the base in their own bin despite rounding
+
+# Output collection -> spec; mapreduce_queries.py runs one job per entry
+HISTOGRAMS = {
+    'url_length_by_type': {'field': 'url_length', 'bins': 'fixed', 'width': 50, 'by': 'type'},
+    'url_length_log_by_type': {'field': 'url_length', 'bins': 'log', 'base': 2, 'by': 'type'},
+    'num_subdomains_by_type': {'field': 'num_subdomains', 'bins': 'fixed', 'width': 1, 'by': 'type'},
+    'threat_score_hist': {'field': 'threat_score', 'bins': 'fixed', 'width': 0.25, 'by': None},
+    'threat_score_quantiles': {'field': 'threat_score', 'bins': 'quantile', 'buckets': 10, 'by': None},
+}
+
+def key_expr(spec):
+    return {'$ifNull': ['$' + spec['by'], 'unknown']} if spec['by'] else {'$literal': 'all'}
+
+def bin_stages(spec, edges=None):
+    """Stages turning each document into {key, lower, upper} for its bin."""
+    value = '$' + spec['field']
+    if spec['bins'] == 'fixed':
+        width = float(spec['width'])  # double edges whatever the field's type, as bin_of returns
+        lower = {'$multiply': [{'$floor': {'$divide': [value, width]}}, width]}
+        return [{'$project': {'key': key_expr(spec), 'lower': lower}},
+                {'$project': {'key': 1, 'lower': 1, 'upper': {'$add': ['$lower', width]}}}]
+    if spec['bins'] == 'log':
+        base = spec['base']
+        power = {'$floor': {'$add': [{'$log': [{'$add': [value, 1]}, base]}, LOG_EPSILON]}}
+        return [{'$project': {'key': key_expr(spec), 'power': power}},
+                {'$project': {'key': 1,
+                              'lower': {'$subtract': [{'$pow': [base, '$power']}, 1]},
+                              'upper': {'$subtract': [{'$pow': [base, {'$add': ['$power', 1]}]}, 1]}}}]
+    if spec['bins'] == 'quantile':
+        if not edges or len(edges) < 2:
+            raise ValueError("quantile bins need at least two edges")
+        inner = len(edges) - 2
+        lower = {'$switch': {'branches': [{'case': {'$lt': [value, edges[i + 1]]}, 'then': edges[i]}
+                                          for i in range(inner)],
+                             'default': edges[inner]}}
+        upper = {'$switch': {'branches': [{'case': {'$eq': ['$lower', edges[i]]}, 'then': edges[i + 1]}
+                                          for i in range(inner)],
+                             'default': edges[-1]}}
+        return [{'$project': {'key': key_expr(spec), 'lower': lower}},
+                {'$project': {'key': 1, 'lower': 1, 'upper': upper}}]
+    raise ValueError(f"unknown bin mode {spec['bins']!r}")
+
+def pipeline(spec, edges=None):
+    return ([{'$match': {spec['field']: {'$type': 'number'}}}] + bin_stages(spec, edges) +
+            [{'$group': {'_id': {'key': '$key', 'lower': '$lower'}, 'upper': {'$first': '$upper'},
+                         'value': {'$sum': 1}}},
+             {'$project': {'key': '$_id.key', 'lower': '$_id.lower', 'upper': 1, 'value': 1}}])
+
+def quantile_edges(col, spec, match=None):
+    """Bin edges for spec['buckets'] roughly equal-count bins, computed by $bucketAuto."""
+    stages = [{'$match': match}] if match else []
+    stages += [{'$match': {spec['field']: {'$type': 'number'}}},
+               {'$bucketAuto': {'groupBy': '$' + spec['field'], 'buckets': spec['buckets']}}]
+    buckets = list(col.aggregate(stages))
+    if not buckets:
+        return []
+    edges = [b['_id']['min'] for b in buckets] + [buckets[-1]['_id']['max']]
+    return closed_edges(edges)
+
+def closed_edges(edges):
+    # Sorted distinct edges; a single value still makes one (degenerate) bin
+    edges = sorted(set(edges))
+    return edges * 2 if len(edges) == 1 else edges
+
+def save_edges(db, name, edges):
+    db[EDGES_COLL].replace_one({'_id': name}, {'edges': edges}, upsert=True)
+
+def load_edges(db, name):
+    doc = db[EDGES_COLL].find_one({'_id': name})
+    return doc['edges'] if doc else None
+
+def bin_of(spec, value, edges=None):
+    """(lower, upper) of the bin holding value -- the Python twin of bin_stages."""
+    if spec['bins'] == 'fixed':
+        width = spec['width']
+        lower = float(math.floor(value / width) * width)
+        return lower, lower + width
+    if spec['bins'] == 'log':
+        base = spec['base']
+        power = math.floor(math.log(value + 1, base) + LOG_EPSILON)
+        return float(base ** power - 1), float(base ** (power + 1) - 1)
+    for i in range(len(edges) - 2):
+        if value < edges[i + 1]:
+            return edges[i], edges[i + 1]
+    return edges[-2], edges[-1]
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class Counter:
+    """Client-side accumulator producing the same documents as pipeline()."""
+
+    def __init__(self, spec, edges=None):
+        self.spec = spec
+        self.edges = edges
+        self.counts = defaultdict(int)
+
+    def add(self, doc):
+        value = doc.get(self.spec['field'])
+        if not is_number(value):
+            return
+        key = doc.get(self.spec['by']) if self.spec['by'] else 'all'
+        self.counts[('unknown' if key is None else key,) + bin_of(self.spec, value, self.edges)] += 1
+
+    def docs(self):
+        return [to_doc(key, lower, upper, value) for (key, lower, upper), value in self.counts.items()]
+
+def frame_edges(values, buckets):
+    # Quantile edges from an in-memory column, for sources without $bucketAuto
+    if len(values) == 0:
+        return []
+    return closed_edges(float(v) for v in np.quantile(values, np.linspace(0, 1, buckets + 1), method='lower'))
+
+def frame_histogram(df, spec, edges=None):
+    """pipeline(spec) over a DataFrame with typed columns (columnar.load_records)."""
+    df = df[df[spec['field']].notna()]
+    values = df[spec['field']].to_numpy(dtype='float64')
+    if spec['bins'] == 'fixed':
+        width = float(spec['width'])
+        lower = np.floor(values / width) * width
+        upper = lower + width
+    elif spec['bins'] == 'log':
+        base = spec['base']
+        power = np.floor(np.log(values + 1) / np.log(base) + LOG_EPSILON)
+        lower, upper = base ** power - 1, base ** (power + 1) - 1
+    else:
+        edges = np.asarray(frame_edges(values, spec['buckets']) if edges is None else edges)
+        if len(edges) < 2:
+            return []
+        index = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+        lower, upper = edges[index], edges[index + 1]
+    bins = pd.DataFrame({'key': df[spec['by']].fillna('unknown').to_numpy() if spec['by'] else 'all',
+                         'lower': lower, 'upper': upper})
+    return [to_doc(key, float(low), float(high), int(value))
+            for (key, low, high), value in bins.groupby(['key', 'lower', 'upper']).size().items()]
+
+def to_doc(key, lower, upper, value):
+    return {'_id': {'key': key, 'lower': lower}, 'key': key, 'lower': lower, 'upper': upper, 'value': value}
+
+def merge(coll, docs):
+    """Adds the counts of docs (same bins) into a stored histogram."""
+    requests = [UpdateOne({'_id': d['_id']}, {'$inc': {'value': d['value']},
+                                              '$setOnInsert': {'key': d['key'], 'lower': d['lower'],
+                                                               'upper': d['upper']}}, upsert=True)
+                for d in docs]
+    if requests:
+        coll.bulk_write(requests, ordered=False)
+
+def rebin(docs, width):
+    """Merges fixed-width bins into bins `width` wide (a multiple of the stored width)."""
+    merged = defaultdict(int)
+    for d in docs:
+        lower = float(math.floor(d['lower'] / width) * width)
+        merged[(d['key'], lower)] += d['value']
+    return sorted((to_doc(key, lower, lower + width, value) for (key, lower), value in merged.items()),
+                  key=lambda d: (str(d['key']), d['lower']))
+
+def load(coll, key=None):
+    """Stored bins, optionally for one key, ordered by key then lower edge."""
+    query = {} if key is None else {'key': key}
+    return list(coll.find(query).sort([('key', 1), ('lower', 1)]))
@@ -0,0 +1,108 @@
+"""
+hll.py
+HyperLogLog distinct counting for the distinct_domains aggregate in mapreduce_queries.py.
+
+A sketch is 2**p one-byte registers (4 KB at the default p=12) whatever the number
+of distinct items, and two sketches merge by taking the register-wise maximum, so
+per-group sketches can be stored, refreshed with a delta and unioned later.
+The estimate has a relative standard error of about 1.04 / sqrt(2**p) (1.6% at p=12).
+Run this file to check the error against that bound on synthetic data.
+"""
+
+import math
+import random
+import hashlib
+import argparse
+import numpy as np
+
+P = 12  # register index bits
+HASH_BITS = 64
+
+def hash64(item):
+    return int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class HyperLogLog:
+
+    def __init__(self, p=P, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError(f"expected {self.m} registers, got {len(self.registers)}")
+
+    def add(self, item):
+        self.add_hash(hash64(item))
+
+    def add_hash(self, h):
+        # First p bits pick the register, the rank of the first 1 in the rest is its value
+        index = h >> (HASH_BITS - self.p)
+        rest = h & ((1 << (HASH_BITS - self.p)) - 1)
+        rank = HASH_BITS - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("cannot merge sketches with different precision")
+        merged = np.maximum(np.frombuffer(self.registers, np.uint8), np.frombuffer(other.registers, np.uint8))
+        self.registers = bytearray(merged.tobytes())
+        return self
+
+    def count(self):
+        registers = np.frombuffer(self.registers, np.uint8)
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / np.sum(np.ldexp(1.0, -registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(registers == 0))
+        if estimate <= 2.5 * self.m and zeros:
+            # Small-range correction: linear counting
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data, p=P):
+        return cls(p, data)
+
+def check_error(cardinalities=(100, 1000, 10000, 100000, 1000000), trials=5, p=P, seed=0):
+    """
+    Estimates synthetic sets of known size and checks each error is within three
+    standard errors; also checks that merging two halves equals sketching the union.
+    """
+    rng = random.Random(seed)
+    bound = 3 * 1.04 / math.sqrt(1 << p)
+    ok = True
+    print(f"p={p}: standard error {bound / 3:.2%}, allowed error {bound:.2%}")
+    for n in cardinalities:
+        worst = 0.0
+        for _ in range(trials):
+            salt = rng.getrandbits(64)
+            left, right = HyperLogLog(p), HyperLogLog(p)
+            whole = HyperLogLog(p)
+            for i in range(n):
+                item = f"{salt}-{i}.example"
+                whole.add(item)
+                (left if i % 2 else right).add(item)
+            merged_ok = left.merge(right).registers == whole.registers
+            error = abs(whole.count() - n) / n
+            worst = max(worst, error)
+            ok = ok and merged_ok and error <= bound
+        print(f"{n:>9} distinct: worst error {worst:.2%} over {trials} trials "
+              f"{'ok' if worst <= bound else 'OUT OF BOUND'}")
+    print("All estimates within bound" if ok else "Some estimates out of bound")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Check HyperLogLog error on synthetic data.')
+    parser.add_argument('--p', type=int, default=P)
+    parser.add_argument('--trials', type=int, default=5)
+    args = parser.parse_args()
+    if not check_error(trials=args.trials, p=args.p):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
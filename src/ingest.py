@@ -1,51 +1,340 @@
 """
 ingest.py
 Bulk inserts data/processed_urls.json (JSON lines) into MongoDB collection cyber_intel.urls
+Also reads the part files written by preprocess.py --shards, or with --delta only the
+records the last preprocess.py --incremental run appended.
+
+--writers N runs a pipeline instead: one thread decodes JSON into batches, a bounded
+queue hands them to N threads doing unordered bulk writes, and data/ingest_progress.json
+records how far the load got so an interrupted run resumes where it stopped.
+
+--dedup keys every document by a hash of its normalized URL and writes with bulk
+upserts, so re-ingesting an overlapping feed only touches new (or, with
+--overwrite-type, relabelled) URLs.
+
+Every new document is stamped with ingested_at, which mapreduce_queries.py
+--incremental uses as its watermark. The stamp is set by the thread doing the bulk
+write, right before it, so a batch that waited in the writers' queue is not stamped
+older than the watermark the aggregates have already moved past.
 """
 
 import os
+import glob
 import json
-from pymongo import MongoClient, InsertOne
+import time
+import uuid
+import hashlib
+import queue
+import argparse
+import threading
+from datetime import datetime, timezone
+from functools import partial
+from pymongo import MongoClient, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from tqdm import tqdm
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
 INPATH = os.path.join(DATA_DIR, 'processed_urls.json')
+SHARD_DIR = os.path.join(DATA_DIR, 'processed_urls_shards')
+MANIFEST_PATH = os.path.join(DATA_DIR, 'processed_urls.manifest.json')
+PROGRESS_PATH = os.path.join(DATA_DIR, 'ingest_progress.json')
 
 MONGO_URI = "mongodb://localhost:27017/"  # change if needed
 DB_NAME = "cyber_intel"
 COLL_NAME = "urls"
 BATCH_SIZE = 2000
+PROGRESS_INTERVAL = 1.0  # seconds between progress marker writes
+DUPLICATE_KEY = 11000
+
+def input_files(path):
+    # A shard directory is read part by part, in the order preprocess.py wrote it
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, 'part-*.json')))
+    return [path]
+
+def iter_lines(path, start=0, end=None):
+    # (offset, line) for the lines of path between byte offsets start and end
+    with open(path, 'rb') as fin:
+        fin.seek(start)
+        pos = start
+        for line in fin:
+            if end is not None and pos >= end:
+                break
+            yield pos, line
+            pos += len(line)
+
+def delta_range():
+    if not os.path.exists(MANIFEST_PATH):
+        raise FileNotFoundError(f"{MANIFEST_PATH} not found. Run preprocess.py --incremental first.")
+    with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest['delta_start'] == 0:
+        print("Last preprocess run was a full rebuild; the delta is the whole file")
+    print(f"Delta: {manifest['delta_rows']} records from byte {manifest['delta_start']:,}")
+    return manifest['delta_start'], manifest['output_size']
+
+def default_input():
+    if not os.path.exists(INPATH) and os.path.isdir(SHARD_DIR):
+        return SHARD_DIR
+    return INPATH
+
+def input_fingerprint(sources):
+    return [[os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f), start, end] for f, start, end in sources]
+
+def url_key(url):
+    # Stable document key: the same normalized URL gets the same _id on every run
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def stamp(doc, now=None):
+    # mapreduce_queries.py --incremental picks up documents by this field
+    doc['ingested_at'] = now or datetime.now(timezone.utc)
+    return doc
+
+def stamped_requests(docs, to_request=InsertOne):
+    # Called just before the bulk write, so the stamp is within one write of the commit
+    now = datetime.now(timezone.utc)
+    return [to_request(stamp(doc, now)) for doc in docs]
+
+def request_maker(dedup=False, overwrite_type=False):
+    return partial(upsert_request, overwrite_type=overwrite_type) if dedup else InsertOne
+
+def upsert_request(doc, overwrite_type=False):
+    """Insert-if-absent keyed by URL; existing documents only change when their label does."""
+    key = url_key(doc['url'])
+    if overwrite_type:
+        label = doc.pop('type')
+        return UpdateOne({'_id': key}, {'$setOnInsert': doc, '$set': {'type': label}}, upsert=True)
+    return UpdateOne({'_id': key}, {'$setOnInsert': doc}, upsert=True)
+
+def save_progress(progress, path=PROGRESS_PATH):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(tmp, path)
+
+def load_progress(sources, path=PROGRESS_PATH):
+    # The marker only applies to the exact same input files and ranges
+    fingerprint = input_fingerprint(sources)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+        if progress['input'] == fingerprint:
+            print(f"Resuming load {progress['load_id']} after {progress['inserted']} documents")
+            return progress
+        print("Progress marker belongs to a different input; starting a new load")
+    return {'load_id': uuid.uuid4().hex[:12], 'input': fingerprint, 'source': 0, 'offset': 0,
+            'inserted': 0, 'new': 0, 'modified': 0}
+
+class ProgressTracker:
+    """
+    Batches finish out of order; the marker only moves past a batch once every
+    earlier batch is written too, so resuming from it never skips documents.
+    """
+
+    def __init__(self, progress, path=PROGRESS_PATH):
+        self.progress = progress
+        self.path = path
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.done = {}
+        self.last_save = time.monotonic()
+
+    def complete(self, seq, source, offset, count, written):
+        with self.lock:
+            self.done[seq] = (source, offset, count, written)
+            while self.next_seq in self.done:
+                source, offset, count, written = self.done.pop(self.next_seq)
+                self.progress.update(source=source, offset=offset)
+                self.progress['inserted'] += count
+                self.progress['new'] += written['new']
+                self.progress['modified'] += written['modified']
+                self.next_seq += 1
+            if time.monotonic() - self.last_save >= PROGRESS_INTERVAL:
+                save_progress(self.progress, self.path)
+                self.last_save = time.monotonic()
+
+def written_counts(details):
+    return {'new': details.get('nInserted', 0) + details.get('nUpserted', 0),
+            'modified': details.get('nModified', 0)}
+
+def write_batch(col, docs, to_request=InsertOne):
+    try:
+        return written_counts(col.bulk_write(stamped_requests(docs, to_request), ordered=False).bulk_api_result)
+    except BulkWriteError as e:
+        # Batches replayed after an interrupt hit their own earlier inserts; anything else is fatal
+        if e.details.get('writeConcernErrors') or any(err['code'] != DUPLICATE_KEY for err in e.details['writeErrors']):
+            raise
+        return written_counts(e.details)
+
+def write_concurrently(col, batches, writers=4, on_written=None, to_request=InsertOne):
+    """
+    Writes (tag, docs) pairs from an iterable with `writers` threads, stamping each
+    batch and turning it into requests with to_request as it is written. The queue
+    holds at most two batches per writer, so a faster producer blocks instead of
+    buffering its whole input. on_written(tag, count, written) runs after each batch.
+    Returns the summed write counts.
+    """
+    pending = queue.Queue(maxsize=writers * 2)
+    totals = {'inserted': 0, 'new': 0, 'modified': 0}
+    lock = threading.Lock()
+    errors = []
+
+    def writer():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            tag, docs = item
+            if errors:
+                continue  # drain the queue so the producer never blocks
+            try:
+                written = write_batch(col, docs, to_request)
+                with lock:
+                    totals['inserted'] += len(docs)
+                    totals['new'] += written['new']
+                    totals['modified'] += written['modified']
+                if on_written:
+                    on_written(tag, len(docs), written)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=writer, daemon=True) for _ in range(writers)]
+    for t in threads:
+        t.start()
+    try:
+        for item in batches:
+            if errors:
+                break
+            pending.put(item)
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    return totals
+
+def pipelined_ingest(col, sources, batch_size=BATCH_SIZE, writers=4, resume=True, dedup=False,
+                     overwrite_type=False, progress_path=PROGRESS_PATH):
+    """
+    Decodes on the calling thread and writes on `writers` threads. Documents get
+    _id = <load id>-<source>-<byte offset> (or the URL key with dedup), so replaying
+    part of a load is idempotent. Returns the progress record of the finished load.
+    """
+    if not resume and os.path.exists(progress_path):
+        os.remove(progress_path)
+    progress = load_progress(sources, progress_path)
+    tracker = ProgressTracker(progress, progress_path)
+
+    def read_batches():
+        seq = 0
+        for source, (in_file, start, end) in enumerate(sources):
+            if source < progress['source']:
+                continue
+            if source == progress['source']:
+                start = max(start, progress['offset'])
+            docs = []
+            for pos, line in tqdm(iter_lines(in_file, start, end), desc=f'Reading {os.path.basename(in_file)}'):
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not dedup:
+                    doc['_id'] = f"{progress['load_id']}-{source}-{pos}"
+                docs.append(doc)
+                if len(docs) >= batch_size:
+                    yield (seq, source, pos + len(line)), docs
+                    seq += 1
+                    docs = []
+            if docs:
+                yield (seq, source, pos + len(line)), docs
+                seq += 1
+
+    try:
+        write_concurrently(col, read_batches(), writers,
+                           lambda tag, count, written: tracker.complete(*tag, count, written),
+                           request_maker(dedup, overwrite_type))
+    finally:
+        save_progress(tracker.progress, progress_path)
+    os.remove(progress_path)
+    return tracker.progress
+
+def create_indexes(col):
+    print("Creating indexes on domain, type, tld, ingested_at")
+    col.create_index("domain")
+    col.create_index("type")
+    col.create_index("tld")
+    col.create_index("url_length")
+    col.create_index("ingested_at")
 
 def main():
-    if not os.path.exists(INPATH):
-        raise FileNotFoundError(f"{INPATH} not found. Run preprocess.py first.")
+    parser = argparse.ArgumentParser(description='Bulk insert processed URLs into MongoDB.')
+    parser.add_argument('--input', default=None,
+                        help=f'JSON lines file or shard directory (default: {INPATH}, else {SHARD_DIR})')
+    parser.add_argument('--delta', action='store_true',
+                        help='insert only the records appended by the last preprocess.py --incremental run')
+    parser.add_argument('--writers', type=int, default=0,
+                        help='concurrent unordered bulk writers; 0 keeps the single-threaded ordered load')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--no-resume', action='store_true',
+                        help=f'ignore {PROGRESS_PATH} and start the load from the beginning')
+    parser.add_argument('--dedup', action='store_true',
+                        help='key documents by a hash of their URL and upsert, so re-ingesting never duplicates')
+    parser.add_argument('--overwrite-type', action='store_true',
+                        help='with --dedup, let a newer feed overwrite the stored type of an existing URL')
+    args = parser.parse_args()
+    if args.overwrite_type and not args.dedup:
+        parser.error('--overwrite-type requires --dedup')
+
+    path = INPATH if args.delta else args.input or default_input()
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found. Run preprocess.py first.")
+    if args.delta:
+        sources = [(path, *delta_range())]
+    else:
+        sources = [(in_file, 0, None) for in_file in input_files(path)]
     client = MongoClient(MONGO_URI)
     db = client[DB_NAME]
     col = db[COLL_NAME]
     # Optional: create indexes after inserting
-    total = 0
-    batch = []
-    with open(INPATH, 'r', encoding='utf-8') as fin:
-        for line in tqdm(fin, desc='Reading JSON lines'):
-            try:
-                doc = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            batch.append(InsertOne(doc))
-            if len(batch) >= BATCH_SIZE:
-                res = col.bulk_write(batch)
-                total += len(batch)
-                batch = []
+    started = time.perf_counter()
+    if args.writers > 0:
+        written = pipelined_ingest(col, sources, args.batch_size, args.writers, not args.no_resume,
+                                   args.dedup, args.overwrite_type)
+        total = written['inserted']
+    else:
+        total = 0
+        written = {'new': 0, 'modified': 0}
+        to_request = request_maker(args.dedup, args.overwrite_type)
+        batch = []
+        for in_file, start, end in sources:
+            for _, line in tqdm(iter_lines(in_file, start, end), desc=f'Reading {os.path.basename(in_file)}'):
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                batch.append(doc)
+                if len(batch) >= args.batch_size:
+                    # Upserts are independent, so the server may apply them in any order
+                    res = col.bulk_write(stamped_requests(batch, to_request), ordered=not args.dedup)
+                    total += len(batch)
+                    batch = []
+                    for key, value in written_counts(res.bulk_api_result).items():
+                        written[key] += value
         if batch:
-            res = col.bulk_write(batch)
+            res = col.bulk_write(stamped_requests(batch, to_request), ordered=not args.dedup)
             total += len(batch)
+            for key, value in written_counts(res.bulk_api_result).items():
+                written[key] += value
+    elapsed = time.perf_counter() - started
     print(f"Inserted (approx): {total} documents into {DB_NAME}.{COLL_NAME}")
+    if args.dedup:
+        print(f"New URLs: {written['new']}, relabelled: {written['modified']}, "
+              f"unchanged: {total - written['new'] - written['modified']}")
+    print(f"Throughput: {total / elapsed:,.0f} docs/s over {elapsed:.1f}s")
 
-    print("Creating indexes on domain, type, tld")
-    col.create_index("domain")
-    col.create_index("type")
-    col.create_index("tld")
-    col.create_index("url_length")
+    create_indexes(col)
     print("Done.")
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@ Runs the entire Cybersecurity Threat Intelligence Analyzer pipeline with one com
 """
 
 import os
+import argparse
 import subprocess
 import sys
 
@@ -18,18 +19,29 @@ def run_command(cmd, desc):
     print(f"Completed: {desc}\n")
 
 def main():
+    parser = argparse.ArgumentParser(description='Run the full pipeline.')
+    parser.add_argument('--stream', action='store_true',
+                        help='preprocess straight into MongoDB (stream_ingest.py) without the intermediate JSON file')
+    args = parser.parse_args()
+
     # Check if data exists
     if not os.path.exists('malicious_phish.csv'):
         print("Error: malicious_phish.csv not found. Download from Kaggle and place in root.")
         sys.exit(1)
 
     # Run pipeline
-    run_command("python src/preprocess.py", "Preprocessing data")
-    run_command("python src/ingest.py", "Ingesting into MongoDB")
+    if args.stream:
+        run_command("python src/stream_ingest.py", "Preprocessing and ingesting into MongoDB")
+    else:
+        run_command("python src/preprocess.py", "Preprocessing data")
+        run_command("python src/ingest.py", "Ingesting into MongoDB")
     run_command("python src/mapreduce_queries.py", "Running aggregations")
+    run_command("python src/heavy_hitters.py", "Updating top-k summaries")
     run_command("python src/visualize.py", "Generating visualizations")
     run_command("python src/ml_predict.py", "Training ML model")
     run_command("python src/anomaly_detect.py", "Detecting anomalies")
+    run_command("python src/burst_detect.py", "Detecting bursts over time windows")
+    run_command("python src/peer_outliers.py", "Scoring domains and TLDs against their peers")
 
     print("Pipeline completed! Starting web dashboard...")
     import subprocess
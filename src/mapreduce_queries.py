@@ -5,16 +5,68 @@ Outputs:
  - counts_by_type
  - mal_domains
  - malicious_tld_counts
- - url_length_by_type
+ - threat_scores
+ - country_counts
+ - distinct_domains (HyperLogLog estimate of distinct domains per type, tld and country)
+ - the numeric histograms in histograms.HISTOGRAMS (url_length_by_type, threat_score_hist, ...)
+
+By default each job scans the collection on its own (one pipeline per output and
+the distinct_domains sketch pass),
+run concurrently (--concurrency) in dependency order; --jobs runs only the named
+ones. Per-job time and output size go to job_runs; --scan-stats adds the documents
+each job examined, from the server's explain of its pipelines (which runs every
+scan a second time, after the jobs).
+--single-scan computes every output from one cursor over the fields the jobs use
+(see single_scan()); --benchmark times both modes and reports documents examined,
+writing only to scratch collections (the stored results and watermark are untouched).
+
+Both are full rebuilds that also record a watermark on the ingested_at stamp the
+loaders put on every document. --incremental then aggregates only documents
+stamped after the watermark and adds their counts, sums and maxes into the stored
+results, so a refresh costs as much as the delta. Relabelling a stored URL
+(ingest.py --dedup --overwrite-type) is not a new document; rebuild after such
+loads. --verify recomputes everything up to the watermark and diffs it against
+the stored results without writing.
+
+Full rebuilds write each output into <name>_staging ($out for the pipelines) and
+rename it over the live collection, so results never pass through Python and
+readers such as dashboard.py never see an empty or half-written collection.
+--materialize-benchmark measures this against the old drop/insert_many path.
 """
 
-from pymongo import MongoClient
+import math
+import time
+import argparse
+import threading
+import tracemalloc
+from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
 import pprint
+import hll
+import histograms
 import pycountry
 
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "cyber_intel"
 COLL_NAME = "urls"
+SCAN_FIELDS = ['type', 'domain', 'tld', 'url_length', 'num_subdomains', 'threat_score', 'country']
+BATCH_SIZE = 10000  # documents per cursor batch in single-scan mode
+BENCH_COLL = "bench_urls"  # synthetic collection for --materialize-benchmark, dropped afterwards
+BENCH_OUT_PREFIX = "bench_out_"  # --benchmark's per-job outputs, dropped afterwards
+STATE_COLL = "aggregate_state"  # watermark of the stored results
+# ingest.py and stream_ingest.py stamp ingested_at in the writer thread right before each
+# bulk write, and realtime/ingest writes land within seconds of it; younger documents
+# wait for the next run, and a write committing more than this after its stamp is missed
+SETTLE_SECONDS = 60
+JOB_RUNS_COLL = "job_runs"  # per-run timings of the scheduled jobs
+CONCURRENCY = 4  # jobs running at once
+STAGING_SUFFIX = "_staging"  # full rebuilds write here, then rename over the live collection
+DISTINCT_FIELDS = ['type', 'tld', 'country']  # distinct_domains groups
+COUNT_OUTPUTS = ['counts_by_type', 'mal_domains', 'malicious_tld_counts']
 
 def get_country_code(country_name):
     if not country_name or country_name == "Unknown":
@@ -29,64 +81,70 @@ client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 col = db[COLL_NAME]
 
-def mr_counts_by_type():
-    pipeline = [
-        {"$group": {"_id": "$type", "value": {"$sum": 1}}}
-    ]
-    results = list(col.aggregate(pipeline))
-    # Insert into collection
-    db['counts_by_type'].drop()  # Clear previous
-    if results:
-        db['counts_by_type'].insert_many(results)
-    print("Top types:")
-    for doc in db['counts_by_type'].find().sort('value', -1).limit(20):
-        pprint.pprint(doc)
-
-def mr_malicious_domains():
-    pipeline = [
-        {"$match": {"type": {"$ne": "benign"}}},
-        {"$group": {"_id": "$domain", "value": {"$sum": 1}}}
-    ]
-    results = list(col.aggregate(pipeline))
-    db['mal_domains'].drop()
-    if results:
-        db['mal_domains'].insert_many(results)
-    print("Top malicious domains:")
-    for doc in db['mal_domains'].find().sort('value', -1).limit(20):
-        pprint.pprint(doc)
-
-def mr_malicious_tld_counts():
-    pipeline = [
-        {"$match": {"type": {"$ne": "benign"}}},
-        {"$group": {"_id": {"$ifNull": ["$tld", "unknown"]}, "value": {"$sum": 1}}}
-    ]
-    results = list(col.aggregate(pipeline))
-    db['malicious_tld_counts'].drop()
-    if results:
-        db['malicious_tld_counts'].insert_many(results)
-    for doc in db['malicious_tld_counts'].find().sort('value', -1).limit(50):
-        pprint.pprint(doc)
-
-def mr_threat_scores():
-    pipeline = [
-        {"$group": {"_id": "$type", "avg_threat_score": {"$avg": "$threat_score"}, "max_threat_score": {"$max": "$threat_score"}}}
-    ]
-    results = list(col.aggregate(pipeline))
-    db['threat_scores'].drop()
+COUNTS_BY_TYPE = [
+    {"$group": {"_id": "$type", "value": {"$sum": 1}}}
+]
+
+MALICIOUS_DOMAINS = [
+    {"$match": {"type": {"$ne": "benign"}}},
+    {"$group": {"_id": "$domain", "value": {"$sum": 1}}}
+]
+
+MALICIOUS_TLD_COUNTS = [
+    {"$match": {"type": {"$ne": "benign"}}},
+    {"$group": {"_id": {"$ifNull": ["$tld", "unknown"]}, "value": {"$sum": 1}}}
+]
+
+THREAT_SCORES = [
+    {"$group": {"_id": "$type", "avg_threat_score": {"$avg": "$threat_score"}, "max_threat_score": {"$max": "$threat_score"},
+                # kept so --incremental can update the average
+                "score_sum": {"$sum": "$threat_score"},
+                "score_count": {"$sum": {"$cond": [{"$isNumber": "$threat_score"}, 1, 0]}}}}
+]
+
+COUNTRY_COUNTS = [
+    {"$match": {"type": {"$ne": "benign"}}},
+    {"$group": {"_id": "$country", "count": {"$sum": 1}}}
+]
+
+def scoped(pipeline, match=None):
+    return ([{"$match": match}] if match else []) + pipeline
+
+def swap_in(name):
+    # renameCollection with dropTarget: readers see the old results or the new, never a gap
+    staging = name + STAGING_SUFFIX
+    if staging in db.list_collection_names():
+        db[staging].rename(name, dropTarget=True)
+    else:
+        db[name].drop()
+
+def materialize(name, pipeline, source=None):
+    """Writes the pipeline's results server-side ($out) into a staging collection and swaps it in."""
+    source = col if source is None else source
+    source.aggregate(pipeline + [{"$out": name + STAGING_SUFFIX}])
+    swap_in(name)
+
+def save_results(name, results):
+    # For results built in Python (country mapping, single scan): same staging swap
+    staging = db[name + STAGING_SUFFIX]
+    staging.drop()
     if results:
-        db['threat_scores'].insert_many(results)
-    print("Threat scores by type:")
-    for doc in db['threat_scores'].find():
-        pprint.pprint(doc)
+        staging.insert_many(results)
+    swap_in(name)
 
-def mr_country_counts():
-    # First, get the raw country counts
-    pipeline = [
-        {"$match": {"type": {"$ne": "benign"}}},
-        {"$group": {"_id": "$country", "count": {"$sum": 1}}}
-    ]
-    results = list(col.aggregate(pipeline))
-    
+def mr_counts_by_type(match=None):
+    materialize('counts_by_type', scoped(COUNTS_BY_TYPE, match))
+
+def mr_malicious_domains(match=None):
+    materialize('mal_domains', scoped(MALICIOUS_DOMAINS, match))
+
+def mr_malicious_tld_counts(match=None):
+    materialize('malicious_tld_counts', scoped(MALICIOUS_TLD_COUNTS, match))
+
+def mr_threat_scores(match=None):
+    materialize('threat_scores', scoped(THREAT_SCORES, match))
+
+def to_country_docs(results):
     # Convert country names to ISO-3 codes and aggregate counts
     country_data = []
     other_count = 0
@@ -115,49 +173,536 @@ def mr_country_counts():
             "country_name": "Other/Unknown",
             "count": other_count
         })
+    return country_data
+
+def mr_country_counts(match=None):
+    # First, get the raw country counts
+    results = list(col.aggregate(scoped(COUNTRY_COUNTS, match)))
+    country_data = to_country_docs(results)
     
     # Update the database
-    db['country_counts'].drop()
-    if country_data:
-        db['country_counts'].insert_many(country_data)
-    
-    print("Malicious URLs by country:")
-    for doc in db['country_counts'].find().sort('count', -1).limit(10):
-        pprint.pprint(doc)
-
-def mr_url_length_by_type():
-    pipeline = [
-        {"$project": {
-            "type": {"$ifNull": ["$type", "unknown"]},
-            "url_length": {"$ifNull": ["$url_length", 0]}
-        }},
-        {"$project": {
-            "type": 1,
-            "bucket": {
-                "$concat": [
-                    {"$toString": {"$multiply": [{"$floor": {"$divide": ["$url_length", 50]}}, 50]}},
-                    "-",
-                    {"$toString": {"$add": [{"$multiply": [{"$floor": {"$divide": ["$url_length", 50]}}, 50]}, 49]}}
-                ]
-            }
-        }},
-        {"$group": {"_id": {"type": "$type", "bucket": "$bucket"}, "value": {"$sum": 1}}}
-    ]
-    results = list(col.aggregate(pipeline))
-    db['url_length_by_type'].drop()
+    save_results('country_counts', country_data)
+
+def histogram_edges(match=None):
+    # Quantile edges for each quantile histogram, from the documents in scope
+    return {name: histograms.quantile_edges(col, spec, match)
+            for name, spec in histograms.HISTOGRAMS.items() if spec['bins'] == 'quantile'}
+
+def stored_edges():
+    # The edges of the stored results, so deltas land in the same bins
+    return {name: histograms.load_edges(db, name)
+            for name, spec in histograms.HISTOGRAMS.items() if spec['bins'] == 'quantile'}
+
+def mr_histogram(name, match=None):
+    spec = histograms.HISTOGRAMS[name]
+    edges = None
+    if spec['bins'] == 'quantile':
+        edges = histograms.quantile_edges(col, spec, match)
+        histograms.save_edges(db, name, edges)
+        if not edges:
+            save_results(name, [])
+            return
+    materialize(name, scoped(histograms.pipeline(spec, edges), match))
+
+def add_distinct(sketches, doc):
+    # One hash per document, added to the sketch of each group it belongs to
+    domain = doc.get('domain')
+    if not domain:
+        return
+    h = hll.hash64(domain)
+    for field in DISTINCT_FIELDS:
+        key = (field, doc.get(field))
+        if key not in sketches:
+            sketches[key] = hll.HyperLogLog()
+        sketches[key].add_hash(h)
+
+def distinct_domain_docs(sketches):
+    # Registers are stored so later deltas (and unions of groups) can be merged in
+    return [{'_id': {'field': field, 'value': value}, 'field': field, 'value': value,
+             'estimate': sketch.count(), 'p': sketch.p, 'registers': sketch.to_bytes()}
+            for (field, value), sketch in sketches.items()]
+
+def distinct_sketches(match=None):
+    # $addToSet per group would hold every domain in memory; the sketches stay at 4 KB each
+    sketches = {}
+    projection = {'_id': 0, 'domain': 1, **{field: 1 for field in DISTINCT_FIELDS}}
+    for doc in col.find(match or {}, projection, batch_size=BATCH_SIZE):
+        add_distinct(sketches, doc)
+    return sketches
+
+def mr_distinct_domains(match=None):
+    save_results('distinct_domains', distinct_domain_docs(distinct_sketches(match)))
+
+# Job name -> function and the jobs whose output it reads ('output' defaults to the
+# name). A job starts once all of its dependencies have finished.
+JOBS = {
+    'counts_by_type': {'run': mr_counts_by_type, 'deps': []},
+    'mal_domains': {'run': mr_malicious_domains, 'deps': []},
+    'malicious_tld_counts': {'run': mr_malicious_tld_counts, 'deps': []},
+    'threat_scores': {'run': mr_threat_scores, 'deps': []},
+    'country_counts': {'run': mr_country_counts, 'deps': []},
+    'distinct_domains': {'run': mr_distinct_domains, 'deps': []},
+}
+JOBS.update({name: {'run': partial(mr_histogram, name), 'deps': []} for name in histograms.HISTOGRAMS})
+JOB_PIPELINES = {'counts_by_type': COUNTS_BY_TYPE, 'mal_domains': MALICIOUS_DOMAINS,
+                 'malicious_tld_counts': MALICIOUS_TLD_COUNTS, 'threat_scores': THREAT_SCORES,
+                 'country_counts': COUNTRY_COUNTS, 'distinct_domains': []}
+
+def job_scans(name, match=None):
+    """The pipelines a job runs over urls, for explain (a find is an empty pipeline); None if unknown."""
+    if name in JOB_PIPELINES:
+        return [scoped(JOB_PIPELINES[name], match)]
+    spec = histograms.HISTOGRAMS.get(name)
+    if spec is None:
+        return None
+    if spec['bins'] != 'quantile':
+        return [scoped(histograms.pipeline(spec), match)]
+    # The $bucketAuto edge pass reads what its $match stages read
+    edges = histograms.load_edges(db, name)
+    scans = [scoped([{'$match': {spec['field']: {'$type': 'number'}}}], match)]
+    return scans + ([scoped(histograms.pipeline(spec, edges), match)] if edges else [])
+
+def single_scan(match=None, edges=None):
+    """
+    Reduces one projected cursor into the documents the jobs produce.
+    Mirrors their null handling: $ne 'benign' matches a missing type, $ifNull
+    maps a missing tld/type, $avg and $max skip non-numeric scores.
+    Quantile histograms use `edges` (name -> edges), computed from the documents
+    in scope when not given. Returns (results keyed by collection name, documents read).
+    """
+    counts_by_type = defaultdict(int)
+    mal_domains = defaultdict(int)
+    tld_counts = defaultdict(int)
+    edges = histogram_edges(match) if edges is None else edges
+    counters = {name: histograms.Counter(spec, edges.get(name))
+                for name, spec in histograms.HISTOGRAMS.items()
+                if spec['bins'] != 'quantile' or edges.get(name)}
+    scores = {}  # type -> [sum, count, max]
+    country_counts = defaultdict(int)
+    sketches = {}
+    scanned = 0
+    projection = {field: 1 for field in SCAN_FIELDS}
+    projection['_id'] = 0
+    for doc in col.find(match or {}, projection, batch_size=BATCH_SIZE):
+        scanned += 1
+        url_type = doc.get('type')
+        counts_by_type[url_type] += 1
+        if url_type != 'benign':
+            mal_domains[doc.get('domain')] += 1
+            tld = doc.get('tld')
+            tld_counts['unknown' if tld is None else tld] += 1
+            country_counts[doc.get('country')] += 1
+        add_distinct(sketches, doc)
+        for counter in counters.values():
+            counter.add(doc)
+        stats = scores.setdefault(url_type, [0, 0, None])
+        score = doc.get('threat_score')
+        if isinstance(score, (int, float)) and not isinstance(score, bool):
+            stats[0] += score
+            stats[1] += 1
+            stats[2] = score if stats[2] is None else max(stats[2], score)
+
+    results = {
+        'counts_by_type': [{'_id': k, 'value': v} for k, v in counts_by_type.items()],
+        'mal_domains': [{'_id': k, 'value': v} for k, v in mal_domains.items()],
+        'malicious_tld_counts': [{'_id': k, 'value': v} for k, v in tld_counts.items()],
+        'threat_scores': [{'_id': k, 'avg_threat_score': total / n if n else None, 'max_threat_score': top,
+                           'score_sum': total, 'score_count': n}
+                          for k, (total, n, top) in scores.items()],
+        'country_counts': to_country_docs([{'_id': k, 'count': v} for k, v in country_counts.items()]),
+        'distinct_domains': distinct_domain_docs(sketches),
+    }
+    for name in histograms.HISTOGRAMS:
+        results[name] = counters[name].docs() if name in counters else []
+    return results, scanned
+
+def show_results(names=None):
+    for name, sort_field, limit in [('counts_by_type', 'value', 20), ('mal_domains', 'value', 20),
+                                    ('malicious_tld_counts', 'value', 50), ('threat_scores', None, 0),
+                                    ('country_counts', 'count', 10), ('distinct_domains', 'estimate', 20)]:
+        if names is not None and name not in names:
+            continue
+        print(f"{name}:")
+        cur = db[name].find({}, {'registers': 0} if name == 'distinct_domains' else None)
+        if sort_field:
+            cur = cur.sort(sort_field, -1)
+        for doc in cur.limit(limit):
+            pprint.pprint(doc)
+    for name in histograms.HISTOGRAMS:
+        if names is not None and name not in names:
+            continue
+        print(f"{name}:")
+        for doc in histograms.load(db[name])[:30]:
+            print(f"  {str(doc['key']):<12} [{doc['lower']:g}, {doc['upper']:g}) {doc['value']}")
+
+def mr_single_scan(match=None):
+    edges = histogram_edges(match)
+    for name, values in edges.items():
+        histograms.save_edges(db, name, values)
+    results, scanned = single_scan(match, edges)
+    for name, docs in results.items():
+        save_results(name, docs)
+    print(f"Single scan read {scanned} documents")
+    show_results()
+
+def resolve_jobs(names=None):
+    """The named jobs plus everything they depend on, dependencies first."""
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name not in JOBS:
+            raise ValueError(f"Unknown job {name!r}; choose from {sorted(JOBS)}")
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Job {name!r} is part of a dependency cycle")
+        visiting.add(name)
+        for dep in JOBS[name]['deps']:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in names or JOBS:
+        visit(name)
+    return order
+
+def timed_job(name, match=None):
+    start = time.perf_counter()
+    JOBS[name]['run'](match)
+    output = JOBS[name].get('output', name)
+    return {'seconds': time.perf_counter() - start, 'output_docs': db[output].estimated_document_count()}
+
+def run_jobs(names=None, concurrency=CONCURRENCY, match=None, scan_stats=False):
+    """
+    Runs the jobs on a thread pool of `concurrency` threads, each one as soon as its
+    dependencies are done. Records the run in job_runs and returns per-job stats.
+    """
+    jobs = resolve_jobs(names)
+    stats = {}
+    started = datetime.now(timezone.utc)
+    wall = time.perf_counter()
+    pending = list(jobs)
+    running = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while pending or running:
+            for name in [n for n in pending if all(dep in stats for dep in JOBS[n]['deps'])]:
+                pending.remove(name)
+                running[pool.submit(timed_job, name, match)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                stats[name] = future.result()
+    wall = time.perf_counter() - wall
+    if scan_stats:
+        # After the jobs, so the explains do not slow them down; None where explain is unavailable
+        for name in jobs:
+            scans = job_scans(name, match)
+            examined = None if scans is None else [docs_examined(p, fallback=False) for p in scans]
+            stats[name]['docs_scanned'] = None if examined is None or None in examined else sum(examined)
+    db[JOB_RUNS_COLL].insert_one({'started': started, 'concurrency': concurrency,
+                                  'wall_seconds': wall, 'jobs': stats})
+    print(f"{'job':>21} {'seconds':>8} {'scanned':>10} {'output':>9}")
+    for name in jobs:
+        job = stats[name]
+        scanned = job.get('docs_scanned')
+        print(f"{name:>21} {job['seconds']:>8.2f} {'-' if scanned is None else scanned:>10} {job['output_docs']:>9}")
+    print(f"Wall time {wall:.2f}s with {concurrency} threads, sum of job times "
+          f"{sum(job['seconds'] for job in stats.values()):.2f}s")
+    return stats
+
+def load_watermark():
+    state = db[STATE_COLL].find_one({'_id': 'mapreduce'})
+    return state['watermark'] if state else None
+
+def save_watermark(watermark, mode):
+    db[STATE_COLL].replace_one({'_id': 'mapreduce'},
+                               {'watermark': watermark, 'mode': mode, 'updated': datetime.now(timezone.utc)},
+                               upsert=True)
+
+def settled_time():
+    # Upper bound for this run; documents stamped later are left for the next one
+    return datetime.now(timezone.utc) - timedelta(seconds=SETTLE_SECONDS)
+
+def up_to(watermark):
+    # $not/$gt also matches documents loaded before ingested_at existed
+    return {'ingested_at': {'$not': {'$gt': watermark}}}
+
+def rebuild(single=False, concurrency=CONCURRENCY, scan_stats=False):
+    """Drops and recomputes every result collection, then records the watermark they cover."""
+    watermark = settled_time()
+    if single:
+        mr_single_scan(up_to(watermark))
+    else:
+        run_jobs(None, concurrency, up_to(watermark), scan_stats)
+        show_results()
+    save_watermark(watermark, 'rebuild')
+
+def rerun_jobs(names, concurrency=CONCURRENCY, scan_stats=False):
+    # Recomputes some outputs up to the stored watermark, so --incremental stays consistent
+    watermark = load_watermark()
+    run_jobs(names, concurrency, up_to(watermark) if watermark else None, scan_stats)
+    show_results(resolve_jobs(names))
+
+def merge_results(results):
+    """Adds delta results (shaped like single_scan's) into the stored collections with upserts."""
+    for name in COUNT_OUTPUTS:
+        requests = [UpdateOne({'_id': d['_id']}, {'$inc': {'value': d['value']}}, upsert=True)
+                    for d in results[name]]
+        if requests:
+            db[name].bulk_write(requests, ordered=False)
+
+    requests = [UpdateOne({'_id': d['_id']}, {'$inc': {'count': d['count']},
+                                              '$setOnInsert': {'country_name': d['country_name']}}, upsert=True)
+                for d in results['country_counts']]
+    if requests:
+        db['country_counts'].bulk_write(requests, ordered=False)
+
+    requests = []
+    for d in results['threat_scores']:
+        update = {'$inc': {'score_sum': d['score_sum'], 'score_count': d['score_count']}}
+        if d['max_threat_score'] is not None:
+            update['$max'] = {'max_threat_score': d['max_threat_score']}
+        requests.append(UpdateOne({'_id': d['_id']}, update, upsert=True))
+    if requests:
+        db['threat_scores'].bulk_write(requests, ordered=False)
+        # The average follows from the merged sum and count
+        touched = [d['_id'] for d in results['threat_scores']]
+        for doc in db['threat_scores'].find({'_id': {'$in': touched}}):
+            count = doc.get('score_count', 0)
+            db['threat_scores'].update_one({'_id': doc['_id']}, {'$set': {
+                'avg_threat_score': doc['score_sum'] / count if count else None}})
+
+    for name in histograms.HISTOGRAMS:
+        histograms.merge(db[name], results[name])
+
+    # HyperLogLog registers merge by register-wise max
+    for d in results['distinct_domains']:
+        sketch = hll.HyperLogLog.from_bytes(d['registers'], d['p'])
+        stored = db['distinct_domains'].find_one({'_id': d['_id']})
+        if stored:
+            sketch.merge(hll.HyperLogLog.from_bytes(stored['registers'], stored['p']))
+        db['distinct_domains'].update_one({'_id': d['_id']}, {'$set': {
+            'field': d['field'], 'value': d['value'], 'p': sketch.p,
+            'estimate': sketch.count(), 'registers': sketch.to_bytes()}}, upsert=True)
+
+def refresh():
+    """Aggregates the documents ingested since the watermark and merges them in."""
+    watermark = load_watermark()
+    if watermark is None:
+        print("No watermark yet; running a full rebuild")
+        rebuild(single=True)
+        return
+    upper = settled_time()
+    start = time.perf_counter()
+    # ingested_at is indexed, so this reads only the delta
+    results, scanned = single_scan({'ingested_at': {'$gt': watermark, '$lte': upper}}, stored_edges())
+    if scanned:
+        merge_results(results)
+    save_watermark(upper, 'refresh')
+    print(f"Merged {scanned} new documents in {time.perf_counter() - start:.2f}s "
+          f"(watermark {upper:%Y-%m-%d %H:%M:%S} UTC)")
+
+def same_doc(a, b):
+    if a.keys() != b.keys():
+        return False
+    for key, value in a.items():
+        if isinstance(value, float) and isinstance(b[key], (int, float)):
+            if not math.isclose(value, b[key], rel_tol=1e-9, abs_tol=1e-9):
+                return False
+        elif value != b[key]:
+            return False
+    return True
+
+def verify():
+    """Recomputes the results up to the stored watermark and reports differences from the stored ones."""
+    watermark = load_watermark()
+    if watermark is None:
+        print("No watermark yet; nothing to verify")
+        return True
+    expected, scanned = single_scan(up_to(watermark), stored_edges())
+    ok = True
+    for name, docs in expected.items():
+        stored = {repr(d['_id']): d for d in db[name].find()}
+        # to_country_docs can map two spellings to one code; merged they are one document
+        wanted = {}
+        for d in docs:
+            key = repr(d['_id'])
+            if key in wanted and name == 'country_counts':
+                wanted[key] = dict(wanted[key], count=wanted[key]['count'] + d['count'])
+            else:
+                wanted[key] = d
+        bad = [k for k in wanted.keys() | stored.keys()
+               if k not in wanted or k not in stored or not same_doc(wanted[k], stored[k])]
+        print(f"{name:>22}: {len(stored)} stored, {len(bad)} differ")
+        ok = ok and not bad
+    print(f"Verified against {scanned} documents up to {watermark:%Y-%m-%d %H:%M:%S} UTC: "
+          f"{'match' if ok else 'MISMATCH, run a full rebuild'}")
+    return ok
+
+def docs_examined(pipeline, fallback=True):
+    # totalDocsExamined from the server's explain; without it, a full scan is assumed
+    # (or None without fallback)
+    try:
+        plan = db.command('explain', {'aggregate': COLL_NAME, 'pipeline': pipeline, 'cursor': {}},
+                          verbosity='executionStats')
+    except (OperationFailure, NotImplementedError):
+        return col.estimated_document_count() if fallback else None
+    stats = plan.get('executionStats') or plan['stages'][0]['$cursor']['executionStats']
+    return stats['totalDocsExamined']
+
+def scanned_total(scans):
+    # Documents examined by these pipelines, or None if explain cannot tell
+    examined = [docs_examined(p, fallback=False) for p in scans]
+    return None if None in examined else sum(examined)
+
+def bench_job(name, match):
+    """What job `name` reads and computes, with its output going to a scratch collection."""
+    if name == 'distinct_domains':
+        distinct_domain_docs(distinct_sketches(match))
+        return
+    spec = histograms.HISTOGRAMS.get(name)
+    if spec is None:
+        pipeline = JOB_PIPELINES[name]
+    else:
+        edges = histograms.quantile_edges(col, spec, match) if spec['bins'] == 'quantile' else None
+        if spec['bins'] == 'quantile' and not edges:
+            return
+        pipeline = histograms.pipeline(spec, edges)
+    col.aggregate(scoped(pipeline, match) + [{"$out": BENCH_OUT_PREFIX + name}])
+
+def benchmark(runs=3, concurrency=CONCURRENCY):
+    """
+    Best-of-N wall time and documents examined for the per-job and single-scan modes,
+    over the same documents a rebuild would read. Nothing is written to the stored
+    results, their edges or the watermark.
+    """
+    match = up_to(settled_time())
+    names = list(JOBS)
+
+    def per_job():
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda name: bench_job(name, match), names))
+
+    timings = {}
+    try:
+        for name, run in [('per-job scans', per_job), ('single scan', lambda: single_scan(match))]:
+            best = None
+            for _ in range(runs):
+                start = time.perf_counter()
+                run()
+                secs = time.perf_counter() - start
+                best = secs if best is None else min(best, secs)
+            timings[name] = best
+    finally:
+        for name in names:
+            db[BENCH_OUT_PREFIX + name].drop()
+    # single_scan also runs the quantile edge passes before its cursor
+    edge_passes = [job_scans(name, match)[0] for name, spec in histograms.HISTOGRAMS.items()
+                   if spec['bins'] == 'quantile']
+    examined = {'per-job scans': scanned_total([p for name in names for p in job_scans(name, match)]),
+                'single scan': scanned_total([scoped([], match)] + edge_passes)}
+    print(f"Benchmark on {col.estimated_document_count()} documents, best of {runs}:")
+    for name, secs in timings.items():
+        count = 'n/a' if examined[name] is None else examined[name]
+        print(f"{name:>13}: {secs:.2f}s, {count} documents examined")
+    print(f"Single scan: {timings['per-job scans'] / timings['single scan']:.1f}x faster", end='')
+    if None in examined.values():
+        print(" (documents examined need the server's explain)")
+    else:
+        print(f", {examined['single scan'] / max(examined['per-job scans'], 1):.0%} of the documents examined")
+
+def make_synthetic(docs, domains):
+    bench = db[BENCH_COLL]
+    bench.drop()
+    types = ['benign', 'phishing', 'malware', 'defacement']
+    batch = []
+    for i in range(docs):
+        batch.append({'type': types[i % len(types)], 'domain': f"host{(i * 7919) % domains}.example"})
+        if len(batch) >= BATCH_SIZE:
+            bench.insert_many(batch)
+            batch = []
+    if batch:
+        bench.insert_many(batch)
+    return bench
+
+def client_round_trip(name, pipeline, source):
+    # What the jobs did before: results through Python, then drop and insert_many
+    results = list(source.aggregate(pipeline))
+    db[name].drop()
     if results:
-        db['url_length_by_type'].insert_many(results)
-    print("Sample url_length_by_type:")
-    for doc in db['url_length_by_type'].find().limit(30):
-        pprint.pprint(doc)
+        db[name].insert_many(results)
+
+def watch_reads(name, expected, stop, seen):
+    # Polls like a dashboard refresh would, counting reads that miss the full result
+    while not stop.is_set():
+        seen['reads'] += 1
+        if db[name].estimated_document_count() != expected:
+            seen['partial'] += 1
+
+def materialize_benchmark(docs=2000000, domains=500000):
+    """Wall time, peak Python memory and reader-visible gaps of both ways to store mal_domains."""
+    print(f"Building {BENCH_COLL}: {docs} documents, {domains} distinct domains")
+    source = make_synthetic(docs, domains)
+    out = 'bench_mal_domains'
+    materialize(out, MALICIOUS_DOMAINS, source)
+    expected = db[out].estimated_document_count()
+    print(f"mal_domains on it has {expected} groups")
+    for label, run in [('client round trip', client_round_trip), ('server-side $out', materialize)]:
+        stop = threading.Event()
+        seen = {'reads': 0, 'partial': 0}
+        reader = threading.Thread(target=watch_reads, args=(out, expected, stop, seen))
+        reader.start()
+        start = time.perf_counter()
+        run(out, MALICIOUS_DOMAINS, source)
+        secs = time.perf_counter() - start
+        stop.set()
+        reader.join()
+        # Separate run for memory, since tracing slows the client path down
+        tracemalloc.start()
+        run(out, MALICIOUS_DOMAINS, source)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:>18}: {secs:.2f}s, peak Python memory {peak / 2**20:,.1f} MB, "
+              f"{seen['partial']} of {seen['reads']} reads saw an empty or partial collection")
+    for name in [BENCH_COLL, out, out + STAGING_SUFFIX]:
+        db[name].drop()
 
 def main():
-    mr_counts_by_type()
-    mr_malicious_domains()
-    mr_malicious_tld_counts()
-    mr_url_length_by_type()
-    mr_threat_scores()
-    mr_country_counts()
+    parser = argparse.ArgumentParser(description='Run the aggregation jobs on cyber_intel.urls.')
+    parser.add_argument('--jobs', nargs='+', choices=list(JOBS), metavar='JOB',
+                        help=f'run only these jobs (and their dependencies): {", ".join(JOBS)}')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='jobs running at once')
+    parser.add_argument('--scan-stats', action='store_true',
+                        help="record the documents each job examined (explains every job's pipelines)")
+    parser.add_argument('--single-scan', action='store_true',
+                        help='compute all outputs from one pass over the collection')
+    parser.add_argument('--incremental', action='store_true',
+                        help='merge only documents ingested since the last run into the stored results')
+    parser.add_argument('--verify', action='store_true',
+                        help='recompute the results up to the watermark and compare them with the stored ones')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare wall time and documents examined of per-job scans and a single scan')
+    parser.add_argument('--materialize-benchmark', action='store_true',
+                        help='compare server-side $out plus rename with the client round trip on a synthetic collection')
+    parser.add_argument('--bench-docs', type=int, default=2000000)
+    parser.add_argument('--bench-domains', type=int, default=500000)
+    args = parser.parse_args()
+
+    if args.materialize_benchmark:
+        materialize_benchmark(args.bench_docs, args.bench_domains)
+        return
+    if args.benchmark:
+        benchmark(concurrency=args.concurrency)
+    elif args.verify:
+        verify()
+        return
+    elif args.incremental:
+        refresh()
+    elif args.jobs:
+        rerun_jobs(args.jobs, args.concurrency, args.scan_stats)
+    else:
+        rebuild(args.single_scan, args.concurrency, args.scan_stats)
     print("All aggregation jobs completed.")
 
 if __name__ == '__main__':
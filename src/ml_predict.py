@@ -1,44 +1,249 @@
 """
 ml_predict.py
 Trains an improved ML model to predict URL types.
+Training data comes from MongoDB, or with --source parquet from the Parquet copy
+written by preprocess.py --parquet.
+
+The default trains a RandomForest on a SAMPLE_ROWS sample, after loading the whole
+collection. --mode stream trains out of core instead: the cursor is read
+STREAM_BATCH_ROWS documents at a time, and each batch updates a running scaler and
+an SGD logistic regression (partial_fit) over the scaled features plus hashed
+character n-grams of the URL, so memory stays bounded whatever the collection size.
+Its holdout is every HOLDOUT_EVERYth document by key hash, scored in a second
+streamed pass. --compare runs both modes in fresh processes and reports their peak
+RSS and their accuracy on that same holdout.
+The trained scaler and model are saved, with the feature configuration, to
+data/url_classifier.joblib for predict_batch(), which realtime.py and the
+dashboard's /api/classify (classifier.py) use to score new URLs.
 """
 
+import os
+import time
+import argparse
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import joblib
+
 from pymongo import MongoClient
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.metrics import classification_report, confusion_matrix
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from sklearn.preprocessing import StandardScaler
+from domains import split_url
+import columnar
+import features
 
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "cyber_intel"
 COLL_NAME = "urls"
+TRAIN_FIELDS = ["url_length", "num_subdomains", "has_https", "threat_score", "domain", "url", "type"]
+FEATURES = ['url_length', 'num_subdomains', 'has_https', 'threat_score', 'domain_length', 'has_suspicious_words', 'entropy']
+SUSPICIOUS_WORDS = features.SUSPICIOUS_WORDS
+SAMPLE_ROWS = 50000
+STREAM_BATCH_ROWS = 20000  # documents per partial_fit
+HASH_FEATURES = 2 ** 18  # hashed character n-gram columns
+NGRAM_RANGE = (3, 5)
+HOLDOUT_EVERY = 5  # 1 in 5 documents (by _id hash) is held out, as test_size=0.2
+ARTIFACT_VERSION = 2  # layout of the saved bundle; load_model refuses newer ones
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'url_classifier.joblib')
 
 client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 col = db[COLL_NAME]
 
-def add_features(df):
-    # Additional features
-    df['domain_length'] = df['domain'].apply(len)
-    df['has_suspicious_words'] = df['url'].str.contains('login|bank|paypal|secure', case=False).astype(int)
-    df['entropy'] = df['domain'].apply(lambda x: -sum((x.count(c)/len(x))*np.log2(x.count(c)/len(x)) for c in set(x)) if x else 0)
-    return df
+def add_features(df, suspicious_words=SUSPICIOUS_WORDS):
+    # Documents without a stored domain (e.g. straight from a feed) go through the cached splitter
+    if 'domain' not in df:
+        df['domain'] = df['url'].map(lambda u: split_url(u)[0])
+    # Additional features, computed once per distinct domain (features.py)
+    return features.derived_features(df, suspicious_words)
 
-def main():
-    # Load data
-    cursor = col.find({}, {"url_length": 1, "num_subdomains": 1, "has_https": 1, "threat_score": 1, "domain": 1, "url": 1, "type": 1})
-    data = list(cursor)
-    df = pd.DataFrame(data)
+def make_hasher(n_features=HASH_FEATURES, ngram_range=NGRAM_RANGE):
+    # Stateless: nothing about the vocabulary has to be learned or stored
+    return HashingVectorizer(analyzer='char_wb', ngram_range=tuple(ngram_range), n_features=n_features,
+                             alternate_sign=False)
+
+def feature_matrix(bundle, df):
+    """Model input for a frame with add_features applied: scaled features, plus hashed URL n-grams."""
+    X = bundle['scaler'].transform(df[bundle['features']])
+    hashing = bundle.get('hashing')
+    if not hashing:
+        return X
+    return sparse.hstack([sparse.csr_matrix(X), make_hasher(**hashing).transform(df['url'])], format='csr')
+
+def prepare(df):
+    # The cleaning main() always applied before add_features
     df['has_https'] = df['has_https'].astype(int)
-    df = df.dropna()
+    return add_features(df.dropna())
+
+def is_holdout(ids):
+    # Deterministic across runs and processes, unlike hash()
+    return pd.util.hash_array(np.asarray([str(i) for i in ids], dtype=object)) % HOLDOUT_EVERY == 0
+
+def stream_batches(batch_rows=STREAM_BATCH_ROWS):
+    """Prepared DataFrames of at most batch_rows documents, straight from the cursor."""
+    cursor = col.find({}, {field: 1 for field in TRAIN_FIELDS}, batch_size=min(batch_rows, 10000))
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_rows:
+            yield prepare(pd.DataFrame(batch))
+            batch = []
+    if batch:
+        yield prepare(pd.DataFrame(batch))
+
+def train_stream(batch_rows=STREAM_BATCH_ROWS, epochs=1):
+    """Bundle ({'model', 'scaler', 'features', 'hashing', 'rows'}) from partial_fit over the non-holdout documents."""
+    classes = np.array(sorted(t for t in col.distinct('type') if isinstance(t, str)))
+    bundle = {'model': SGDClassifier(loss='log_loss', random_state=42), 'scaler': StandardScaler(),
+              'features': FEATURES, 'hashing': {'n_features': HASH_FEATURES, 'ngram_range': NGRAM_RANGE},
+              'rows': 0}
+    for epoch in range(epochs):
+        for df in stream_batches(batch_rows):
+            df = df[~is_holdout(df['_id'])]
+            if df.empty:
+                continue
+            if epoch == 0:
+                bundle['scaler'].partial_fit(df[FEATURES])
+                bundle['rows'] += len(df)
+            bundle['model'].partial_fit(feature_matrix(bundle, df), df['type'], classes=classes)
+        print(f"Epoch {epoch + 1}: {bundle['rows']} rows")
+    return bundle
+
+def evaluate_stream(predict, batch_rows=STREAM_BATCH_ROWS):
+    """(accuracy, labels, confusion matrix) of predict(frame) over the holdout, streamed."""
+    counts = {}
+    for df in stream_batches(batch_rows):
+        df = df[is_holdout(df['_id'])]
+        if df.empty:
+            continue
+        pairs = pd.DataFrame({'truth': df['type'].to_numpy(), 'guess': np.asarray(predict(df))})
+        for pair, n in pairs.value_counts().items():
+            counts[pair] = counts.get(pair, 0) + n
+    labels = sorted({label for pair in counts for label in pair})
+    matrix = np.array([[counts.get((t, g), 0) for g in labels] for t in labels], dtype='int64')
+    return (np.trace(matrix) / matrix.sum() if matrix.sum() else float('nan')), labels, matrix
 
-    df = add_features(df)
+def _compare_run(mode, batch_rows):
+    # Runs in a fresh process so ru_maxrss covers only this mode
+    start = time.perf_counter()
+    if mode == 'sample':
+        # main()'s default path, with the holdout taken out before sampling
+        df = prepare(pd.DataFrame(list(col.find({}, {field: 1 for field in TRAIN_FIELDS}))))
+        test = is_holdout(df['_id'])
+        train = df[~test].sample(n=min(SAMPLE_ROWS, int((~test).sum())), random_state=42)
+        scaler = StandardScaler()
+        model = RandomForestClassifier(n_estimators=100, max_depth=10, random_state=42)
+        model.fit(scaler.fit_transform(train[FEATURES]), train['type'])
+        rows = len(train)
+        predict = lambda frame: model.predict(scaler.transform(frame[FEATURES]))
+        accuracy = (predict(df[test]) == df.loc[test, 'type']).mean()
+    else:
+        bundle = train_stream(batch_rows)
+        rows = bundle['rows']
+        accuracy = evaluate_stream(lambda frame: bundle['model'].predict(feature_matrix(bundle, frame)),
+                                   batch_rows)[0] if rows else float('nan')
+    return rows, accuracy, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, time.perf_counter() - start
+
+def compare(batch_rows=STREAM_BATCH_ROWS):
+    """Peak RSS and holdout accuracy of the sampled RandomForest and of streamed training."""
+    results = {}
+    for mode in ['sample', 'stream']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            rows, accuracy, peak_mb, secs = pool.submit(_compare_run, mode, batch_rows).result()
+        results[mode] = peak_mb
+        print(f"{mode:>7}: trained on {rows:,.0f} rows in {secs:.1f}s, holdout accuracy {accuracy:.4f}, "
+              f"{peak_mb:,.0f} MB peak")
+    print(f"Streaming uses {results['stream'] / results['sample']:.0%} of the sampled run's peak")
+
+def save_model(model, scaler, path=MODEL_PATH, hashing=None):
+    """Saves the bundle load_model() reads; returns its version (the training time)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    trained_at = datetime.now(timezone.utc)
+    version = trained_at.strftime('%Y%m%dT%H%M%SZ')
+    # Written aside and renamed, so a running service never loads half a file
+    tmp = path + '.tmp'
+    joblib.dump({'artifact_version': ARTIFACT_VERSION, 'version': version,
+                 'model': model, 'scaler': scaler, 'features': FEATURES, 'hashing': hashing,
+                 'suspicious_words': SUSPICIOUS_WORDS, 'trained_at': trained_at}, tmp)
+    os.replace(tmp, path)
+    return version
+
+def load_model(path=MODEL_PATH):
+    """
+    The saved {'model', 'scaler', 'features', 'hashing', 'suspicious_words', 'version', ...}
+    bundle, or None before the first training.
+    """
+    if not os.path.exists(path):
+        return None
+    bundle = joblib.load(path)
+    if bundle.get('artifact_version', 1) > ARTIFACT_VERSION:
+        raise ValueError(f"{path} was saved by a newer ml_predict.py (artifact version "
+                         f"{bundle['artifact_version']}); update the code or retrain")
+    return bundle
+
+def predict_batch(bundle, docs):
+    """(predicted types, confidences) for a list of URL documents, in one model call."""
+    df = pd.DataFrame(docs)
+    for field in ['url_length', 'num_subdomains', 'has_https', 'threat_score']:
+        df[field] = pd.to_numeric(df[field], errors='coerce').fillna(0) if field in df else 0
+    if 'domain' in df:
+        df['domain'] = df['domain'].fillna('')
+    df = add_features(df, bundle.get('suspicious_words', SUSPICIOUS_WORDS))
+    proba = bundle['model'].predict_proba(feature_matrix(bundle, df))
+    best = proba.argmax(axis=1)
+    return bundle['model'].classes_[best].tolist(), proba[np.arange(len(best)), best].tolist()
+
+def main():
+    parser = argparse.ArgumentParser(description='Train a URL type classifier.')
+    parser.add_argument('--source', choices=['mongo', 'parquet'], default='mongo',
+                        help='read training data from MongoDB or from the Parquet copy')
+    parser.add_argument('--mode', choices=['sample', 'stream'], default='sample',
+                        help='RandomForest on a sample, or out-of-core SGD over the whole cursor')
+    parser.add_argument('--batch-rows', type=int, default=STREAM_BATCH_ROWS, help='with --mode stream')
+    parser.add_argument('--epochs', type=int, default=1, help='with --mode stream')
+    parser.add_argument('--compare', action='store_true',
+                        help='report peak RSS and holdout accuracy of both modes instead of saving a model')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.batch_rows)
+        return
+    if args.mode == 'stream':
+        if args.source != 'mongo':
+            parser.error('--mode stream reads the MongoDB cursor')
+        bundle = train_stream(args.batch_rows, args.epochs)
+        if not bundle['rows']:
+            print("No training rows")
+            return
+        accuracy, labels, matrix = evaluate_stream(
+            lambda frame: bundle['model'].predict(feature_matrix(bundle, frame)), args.batch_rows)
+        print(f"Holdout accuracy: {accuracy:.4f}")
+        print("Confusion Matrix:", labels)
+        print(matrix)
+        version = save_model(bundle['model'], bundle['scaler'], hashing=bundle['hashing'])
+        print("Model saved to:", MODEL_PATH, f"(version {version})")
+        return
+
+    # Load data
+    if args.source == 'parquet':
+        df = columnar.load_records(TRAIN_FIELDS)
+    else:
+        cursor = col.find({}, {field: 1 for field in TRAIN_FIELDS})
+        data = list(cursor)
+        df = pd.DataFrame(data)
+    df = prepare(df)
     # Sample smaller dataset for speed
-    df = df.sample(n=50000, random_state=42)
+    df = df.sample(n=min(SAMPLE_ROWS, len(df)), random_state=42)
 
-    X = df[['url_length', 'num_subdomains', 'has_https', 'threat_score', 'domain_length', 'has_suspicious_words', 'entropy']]
+    X = df[FEATURES]
     y = df['type']
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
@@ -62,5 +267,8 @@ def main():
     print("Confusion Matrix:")
     print(confusion_matrix(y_test, y_pred))
 
+    version = save_model(model, scaler)
+    print("Model saved to:", MODEL_PATH, f"(version {version})")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
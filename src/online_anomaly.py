@@ -0,0 +1,194 @@
+"""
+online_anomaly.py
+Streaming anomaly detection on threat_score, fed one URL at a time by realtime.py.
+
+Running statistics are kept per key -- each type, tld and domain -- either as
+Welford's mean/variance over everything seen or as an exponentially weighted
+mean/variance (--mode ewma, which follows drift). A URL is scored against the
+statistics of its keys *before* it is added; |z| above THRESHOLD after
+MIN_SAMPLES observations is written to the anomalies collection with the key,
+value and score. Updates are O(1) per key; domain statistics are capped at
+MAX_DOMAINS, least recently seen evicted first. State lives in memory, so
+after a restart each key warms up again.
+
+Run this file with --benchmark to measure events/sec on the stored URLs.
+"""
+
+import math
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pymongo import MongoClient
+
+MONGO_URI = "mongodb://localhost:27017/"
+DB_NAME = "cyber_intel"
+COLL_NAME = "urls"
+ANOMALY_COLL = "anomalies"
+KEY_FIELDS = ['type', 'tld', 'domain']
+VALUE_FIELD = 'threat_score'
+MODES = ['welford', 'ewma']
+ALPHA = 0.05  # EWMA weight of the newest value
+THRESHOLD = 3.0  # |z| that counts as an anomaly
+MIN_SAMPLES = 30  # observations of a key before it is scored
+MAX_DOMAINS = 100000  # domain statistics kept in memory
+FLUSH_EVERY = 100  # anomaly records buffered before insert_many
+MAX_AGE_SECONDS = 5.0  # or until the oldest buffered record is this old
+BENCH_EVENTS = 200000
+
+client = MongoClient(MONGO_URI)
+db = client[DB_NAME]
+col = db[COLL_NAME]
+
+class RunningStats:
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Welford: sum of squared deviations; EWMA: the variance itself
+
+    def std(self, mode):
+        if mode == 'ewma':
+            return math.sqrt(self.m2)
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def update(self, x, mode, alpha=ALPHA):
+        self.n += 1
+        delta = x - self.mean
+        if mode == 'ewma' and self.n > 1:
+            self.mean += alpha * delta
+            self.m2 = (1 - alpha) * (self.m2 + alpha * delta * delta)
+        elif mode == 'ewma':
+            self.mean = x
+        else:
+            self.mean += delta / self.n
+            self.m2 += delta * (x - self.mean)
+
+class Detector:
+    """Scores each value against the running statistics of its type, tld and domain."""
+
+    def __init__(self, mode='welford', threshold=THRESHOLD, min_samples=MIN_SAMPLES,
+                 alpha=ALPHA, max_domains=MAX_DOMAINS):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        self.mode = mode
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.max_domains = max_domains
+        self.stats = {field: {} for field in KEY_FIELDS}
+        self.stats['domain'] = OrderedDict()
+
+    def observe(self, doc):
+        """Updates the statistics with doc and returns its anomaly records (usually none)."""
+        value = doc.get(VALUE_FIELD)
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return []
+        found = []
+        for field in KEY_FIELDS:
+            key = doc.get(field)
+            if key is None:
+                continue
+            table = self.stats[field]
+            stats = table.get(key)
+            if stats is None:
+                stats = table[key] = RunningStats()
+                if field == 'domain' and len(table) > self.max_domains:
+                    table.popitem(last=False)
+            elif field == 'domain':
+                table.move_to_end(key)
+            if stats.n >= self.min_samples:
+                std = stats.std(self.mode)
+                score = (value - stats.mean) / std if std > 0 else 0.0
+                if abs(score) > self.threshold:
+                    found.append({'key_field': field, 'key': key, 'field': VALUE_FIELD, 'value': value,
+                                  'score': score, 'mean': stats.mean, 'std': std, 'n': stats.n,
+                                  'mode': self.mode, 'url': doc.get('url'),
+                                  'ingested_at': doc.get('ingested_at')})
+            stats.update(value, self.mode, self.alpha)
+        return found
+
+class AnomalySink:
+    """
+    Buffers anomaly records and inserts them into ANOMALY_COLL, every flush_every
+    records or once the oldest has waited max_age seconds (checked by add and poll).
+    Safe to share between threads: flush() returns once everything added before it
+    is stored.
+    """
+
+    def __init__(self, coll=None, flush_every=FLUSH_EVERY, max_age=MAX_AGE_SECONDS):
+        self.coll = db[ANOMALY_COLL] if coll is None else coll
+        self.flush_every = flush_every
+        self.max_age = max_age
+        self.pending = []
+        self.oldest = None
+        self.lock = threading.RLock()
+
+    def add(self, records):
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            if records and not self.pending:
+                self.oldest = time.monotonic()
+            self.pending.extend(dict(r, detected_at=now) for r in records)
+            full = len(self.pending) >= self.flush_every
+        if full:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        # Long-running consumers call this so a quiet stream still gets its records written
+        if self.pending and time.monotonic() - self.oldest >= self.max_age:
+            self.flush()
+
+    def flush(self):
+        # Held through the insert, so a concurrent flush cannot return before it lands
+        with self.lock:
+            if self.pending:
+                self.coll.insert_many(self.pending, ordered=False)
+                self.pending = []
+
+def create_indexes():
+    db[ANOMALY_COLL].create_index([('key_field', 1), ('key', 1)])
+    db[ANOMALY_COLL].create_index('detected_at')
+
+def benchmark(events=BENCH_EVENTS):
+    """Events/sec of Detector.observe in each mode, replaying the stored URLs (no writes)."""
+    projection = {field: 1 for field in KEY_FIELDS + [VALUE_FIELD]}
+    projection['_id'] = 0
+    docs = list(col.find({}, projection).limit(events))
+    if not docs:
+        print("No documents in", COLL_NAME)
+        return
+    stream = [docs[i % len(docs)] for i in range(max(events, len(docs)))]
+    print(f"Replaying {len(stream)} events ({len(docs)} distinct documents)")
+    for mode in MODES:
+        detector = Detector(mode)
+        flagged = 0
+        start = time.perf_counter()
+        for doc in stream:
+            flagged += len(detector.observe(doc))
+        secs = time.perf_counter() - start
+        keys = sum(len(table) for table in detector.stats.values())
+        print(f"{mode:>8}: {len(stream) / secs:>10,.0f} events/s, {keys} keys, {flagged} anomaly records")
+
+def main():
+    parser = argparse.ArgumentParser(description='Online anomaly detection on threat scores.')
+    parser.add_argument('--benchmark', action='store_true', help='measure events/sec on the stored URLs')
+    parser.add_argument('--events', type=int, default=BENCH_EVENTS)
+    parser.add_argument('--recent', type=int, metavar='N', help='print the N most recent anomaly records')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.events)
+    elif args.recent:
+        for doc in db[ANOMALY_COLL].find({}, {'_id': 0}).sort('detected_at', -1).limit(args.recent):
+            print(f"{doc['key_field']}={doc['key']}: {doc['field']} {doc['value']:.2f} "
+                  f"(z={doc['score']:+.1f}, mean {doc['mean']:.2f} over {doc['n']}) {doc.get('url')}")
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
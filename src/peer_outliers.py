@@ -0,0 +1,274 @@
+"""
+peer_outliers.py
+Finds domains and TLDs far out of line with their peers, by malicious URL count
+and by average threat_score.
+
+Peers are the domains of the same TLD (level 'domain') or all TLDs (level 'tld').
+Each value gets a robust score against its peer group,
+  (value - median) / (1.4826 * MAD)
+(falling back to 1.2533 * mean absolute deviation when over half the peers share
+one value), and scores above THRESHOLD are kept, best TOP_K per level and metric,
+in cyber_intel.peer_outliers for the dashboard.
+
+Per-domain statistics are aggregated server-side into domain_stats, then read in
+chunks of CHUNK_ROWS twice: the first pass fills a SAMPLE-value reservoir per peer
+group (the medians and MADs come from these) and sums the TLD totals, the second
+scores each chunk with NumPy and keeps a running top-k, so memory does not grow with
+the number of domains. With --source mal_domains only the malicious count is scored,
+with the TLD split from the domain name by domains.split_netloc (so 'co.uk', not 'uk'). --benchmark times the scoring on synthetic domains.
+"""
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from pymongo import MongoClient
+from domains import split_netloc
+import mapreduce_queries
+
+MONGO_URI = "mongodb://localhost:27017/"
+DB_NAME = "cyber_intel"
+STATS_COLL = "domain_stats"
+OUTLIER_COLL = "peer_outliers"
+CHUNK_ROWS = 100000
+SAMPLE = 5000  # reservoir size per peer group
+MIN_PEERS = 10  # smaller groups are not scored
+THRESHOLD = 3.5
+TOP_K = 1000
+MAD_SCALE = 1.4826  # MAD -> standard deviation for normal data
+MEAN_AD_SCALE = 1.2533  # mean absolute deviation -> standard deviation
+METRICS = ['malicious', 'avg_threat_score']
+
+client = MongoClient(MONGO_URI)
+db = client[DB_NAME]
+
+DOMAIN_STATS = [
+    {"$group": {"_id": "$domain", "tld": {"$first": "$tld"}, "urls": {"$sum": 1},
+                "malicious": {"$sum": {"$cond": [{"$ne": ["$type", "benign"]}, 1, 0]}},
+                "score_sum": {"$sum": "$threat_score"},
+                "score_count": {"$sum": {"$cond": [{"$isNumber": "$threat_score"}, 1, 0]}}}},
+    {"$project": {"tld": {"$ifNull": ["$tld", "unknown"]}, "urls": 1, "malicious": 1,
+                  "score_sum": 1, "score_count": 1}}
+]
+
+class Reservoir:
+    """Uniform sample of at most `size` values of a stream (Algorithm R), fed in arrays."""
+
+    def __init__(self, size, rng):
+        self.values = np.empty(size)
+        self.filled = 0
+        self.seen = 0
+        self.rng = rng
+
+    def add(self, values):
+        size = len(self.values)
+        fill = min(len(values), size - self.filled)
+        self.values[self.filled:self.filled + fill] = values[:fill]
+        self.filled += fill
+        self.seen += fill
+        rest = values[fill:]
+        if len(rest):
+            # Item number i replaces a random slot with probability size / i; when two
+            # items pick the same slot, fancy assignment keeps the later one, as in order
+            slots = self.rng.integers(0, np.arange(self.seen + 1, self.seen + len(rest) + 1))
+            keep = slots < size
+            self.values[slots[keep]] = rest[keep]
+            self.seen += len(rest)
+
+    def sample(self):
+        return self.values[:self.filled]
+
+def robust_scale(sample):
+    """(median, scale) of a sample; scale is NaN when every value is the same."""
+    median = np.median(sample)
+    deviation = np.abs(sample - median)
+    scale = MAD_SCALE * np.median(deviation)
+    if scale == 0:
+        scale = MEAN_AD_SCALE * deviation.mean()
+    return median, (scale if scale > 0 else np.nan)
+
+def split_by_group(groups, values):
+    # (group, its values) pairs from one stable sort instead of a pandas groupby
+    codes, uniques = pd.factorize(groups)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1]
+    return zip(uniques, np.split(values[order], bounds))
+
+def score_chunks(chunks, metrics, sample=SAMPLE, min_peers=MIN_PEERS, threshold=THRESHOLD, top=TOP_K, seed=0,
+                 first_pass=None):
+    """
+    Two passes over chunks() -- each chunk a DataFrame with 'key', 'group' and one
+    column per metric -- returning {metric: DataFrame of the top outliers}.
+    first_pass, if given, is also called with each chunk of the first pass.
+    """
+    rng = np.random.default_rng(seed)
+    reservoirs = {metric: {} for metric in metrics}
+    for chunk in chunks():
+        if first_pass:
+            first_pass(chunk)
+        for metric in metrics:
+            values = chunk[metric].to_numpy(dtype='float64')
+            known = ~np.isnan(values)
+            for group, part in split_by_group(chunk['group'].to_numpy()[known], values[known]):
+                if group not in reservoirs[metric]:
+                    reservoirs[metric][group] = Reservoir(sample, rng)
+                reservoirs[metric][group].add(part)
+
+    baselines = {}
+    for metric in metrics:
+        rows = [(group, *robust_scale(r.sample()), r.seen) for group, r in reservoirs[metric].items()
+                if r.seen >= min_peers]
+        baselines[metric] = pd.DataFrame(rows, columns=['group', 'median', 'scale', 'peers']).set_index('group')
+
+    best = {metric: None for metric in metrics}
+    for chunk in chunks():
+        for metric in metrics:
+            base = baselines[metric].reindex(chunk['group'])
+            score = (chunk[metric].to_numpy(dtype='float64') - base['median'].to_numpy()) / base['scale'].to_numpy()
+            hits = np.flatnonzero(score > threshold)
+            if not len(hits):
+                continue
+            found = pd.DataFrame({'key': chunk['key'].to_numpy()[hits], 'group': chunk['group'].to_numpy()[hits],
+                                  'value': chunk[metric].to_numpy(dtype='float64')[hits], 'score': score[hits],
+                                  'median': base['median'].to_numpy()[hits],
+                                  'scale': base['scale'].to_numpy()[hits], 'peers': base['peers'].to_numpy()[hits]})
+            merged = found if best[metric] is None else pd.concat([best[metric], found], ignore_index=True)
+            best[metric] = merged.nlargest(top, 'score') if len(merged) > top else merged
+    return {metric: (frame.sort_values('score', ascending=False).reset_index(drop=True)
+                     if frame is not None else pd.DataFrame())
+            for metric, frame in best.items()}
+
+def cursor_chunks(cursor_fn, to_frame, chunk_rows=CHUNK_ROWS):
+    # A callable yielding DataFrames of chunk_rows documents each, re-reading the cursor per call
+    def chunks():
+        batch = []
+        for doc in cursor_fn():
+            batch.append(doc)
+            if len(batch) >= chunk_rows:
+                yield to_frame(batch)
+                batch = []
+        if batch:
+            yield to_frame(batch)
+    return chunks
+
+def domain_frame(docs):
+    df = pd.DataFrame(docs)
+    score_count = df['score_count'].astype('float64')
+    return pd.DataFrame({'key': df['_id'], 'group': df['tld'], 'malicious': df['malicious'].astype('float64'),
+                         'avg_threat_score': (df['score_sum'] / score_count.where(score_count > 0)).to_numpy(),
+                         'score_sum': df['score_sum'].astype('float64'), 'score_count': score_count})
+
+def mal_domain_frame(docs):
+    df = pd.DataFrame(docs)
+    keys = df['_id'].fillna('unknown').astype(str)
+    # The stored domains are whole; split_netloc is cached, so repeated TLDs cost a lookup
+    groups = [split_netloc(key)[2] or 'unknown' for key in keys.tolist()]
+    return pd.DataFrame({'key': keys, 'group': groups, 'malicious': df['value'].astype('float64')})
+
+class TldTotals:
+    """Per-TLD totals of the domain chunks, added during score_chunks' first pass."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.columns = ['malicious'] + (['score_sum', 'score_count'] if 'avg_threat_score' in metrics else [])
+        self.totals = None
+
+    def add(self, chunk):
+        sums = chunk.groupby('group')[self.columns].sum()
+        self.totals = sums if self.totals is None else self.totals.add(sums, fill_value=0)
+
+    def frame(self):
+        # One row per TLD with its domains' totals; the TLDs are the peers of each other
+        totals = self.totals
+        if totals is None:
+            return pd.DataFrame(columns=['key', 'group'] + self.metrics)
+        frame = pd.DataFrame({'key': totals.index, 'group': 'all', 'malicious': totals['malicious'].to_numpy()})
+        if 'avg_threat_score' in self.metrics:
+            count = totals['score_count'].where(totals['score_count'] > 0)
+            frame['avg_threat_score'] = (totals['score_sum'] / count).to_numpy()
+        return frame
+
+def outlier_docs(level, results):
+    docs = []
+    for metric, frame in results.items():
+        for rank, row in enumerate(frame.itertuples(index=False), 1):
+            docs.append({'_id': {'level': level, 'metric': metric, 'key': row.key},
+                         'level': level, 'metric': metric, 'key': row.key, 'group': row.group,
+                         'value': float(row.value), 'score': float(row.score), 'median': float(row.median),
+                         'scale': float(row.scale), 'peers': int(row.peers), 'rank': rank})
+    return docs
+
+def detect(source='urls', chunk_rows=CHUNK_ROWS, threshold=THRESHOLD, top=TOP_K):
+    """Scores domains and TLDs against their peers and stores the top outliers."""
+    start = time.perf_counter()
+    if source == 'urls':
+        mapreduce_queries.materialize(STATS_COLL, DOMAIN_STATS)
+        print(f"Aggregated {db[STATS_COLL].estimated_document_count()} domains "
+              f"in {time.perf_counter() - start:.1f}s")
+        chunks = cursor_chunks(lambda: db[STATS_COLL].find({'_id': {'$ne': None}},
+                                                           batch_size=mapreduce_queries.BATCH_SIZE),
+                               domain_frame, chunk_rows)
+        metrics = METRICS
+    else:
+        chunks = cursor_chunks(lambda: db['mal_domains'].find({}, batch_size=mapreduce_queries.BATCH_SIZE),
+                               mal_domain_frame, chunk_rows)
+        metrics = ['malicious']
+    totals = TldTotals(metrics)
+    docs = outlier_docs('domain', score_chunks(chunks, metrics, threshold=threshold, top=top, first_pass=totals.add))
+    tlds = totals.frame()
+    docs += outlier_docs('tld', score_chunks(lambda: iter([tlds]), metrics, threshold=threshold, top=top))
+    mapreduce_queries.save_results(OUTLIER_COLL, docs)
+    print(f"Stored {len(docs)} outliers in {OUTLIER_COLL} in {time.perf_counter() - start:.1f}s")
+    return docs
+
+def top_outliers(level='domain', metric='malicious', limit=10):
+    return list(db[OUTLIER_COLL].find({'level': level, 'metric': metric}, {'_id': 0}).sort('rank', 1).limit(limit))
+
+def benchmark(domains=2000000, chunk_rows=CHUNK_ROWS, outliers=100, seed=0):
+    """Scoring time on synthetic domains (Zipf-sized TLDs), and recall of injected outliers."""
+    rng = np.random.default_rng(seed)
+    groups = np.minimum(rng.zipf(1.5, domains), 2000).astype(str)
+    malicious = rng.poisson(2, domains).astype('float64')
+    scores = rng.normal(3, 1, domains)
+    planted = rng.choice(domains, outliers, replace=False)
+    malicious[planted] += 200
+    keys = np.arange(domains)
+
+    def chunks():
+        for lo in range(0, domains, chunk_rows):
+            hi = lo + chunk_rows
+            yield pd.DataFrame({'key': keys[lo:hi], 'group': groups[lo:hi], 'malicious': malicious[lo:hi],
+                                'avg_threat_score': scores[lo:hi]})
+
+    start = time.perf_counter()
+    results = score_chunks(chunks, METRICS)
+    secs = time.perf_counter() - start
+    found = set(results['malicious']['key']) & set(planted)
+    print(f"{domains:,} domains in {len(set(groups))} TLDs, chunks of {chunk_rows:,}: {secs:.2f}s "
+          f"({domains / secs:,.0f} domains/s)")
+    print(f"Planted outliers found: {len(found)}/{outliers} "
+          f"(those in groups under {MIN_PEERS} peers are not scored); "
+          f"top malicious score {results['malicious']['score'].max():.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Score domains and TLDs against their peers.')
+    parser.add_argument('--source', choices=['urls', 'mal_domains'], default='urls')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--top', type=int, default=TOP_K, help='outliers kept per level and metric')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='time the scoring on N synthetic domains')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.chunk_rows)
+        return
+    detect(args.source, args.chunk_rows, args.threshold, args.top)
+    for level in ['domain', 'tld']:
+        for metric in METRICS if args.source == 'urls' else ['malicious']:
+            print(f"Top {level} outliers by {metric}:")
+            for doc in top_outliers(level, metric):
+                print(f"  {doc['key']:<40} {doc['value']:>10.2f} vs median {doc['median']:.2f} "
+                      f"of {doc['peers']} in {doc['group']} (score {doc['score']:.1f})")
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,34 @@ Reads raw URL,label file and outputs processed_urls.json (JSON lines).
 
 Input expected: data/raw_urls.csv or data/raw_urls.txt
 Format: two columns (url and label), separator auto-detected.
+Use --workers N to parse chunks in a process pool (output order is preserved)
+and --shards to write one part file per chunk that ingest.py reads directly.
+With --incremental only lines appended to the source since the last run are parsed
+and appended; data/processed_urls.manifest.json records the checkpoint.
+--parquet also writes a typed Parquet copy of the records (see columnar.py).
 """
 
 import os
+import io
+import glob
+import hashlib
+import shutil
+import itertools
+import resource
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from urllib.parse import urlparse
-import tldextract
+from domains import split_netloc, cache_stats
+import columnar
+import geoip
 from tqdm import tqdm
 import json
 import argparse
+import time
+from datetime import datetime
 import requests
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
@@ -24,6 +43,24 @@ RAW_PATHS = [
     os.path.join(os.path.dirname(os.path.dirname(__file__)), 'malicious_phish.csv')  # Added this file
 ]
 OUTPATH = os.path.join(DATA_DIR, 'processed_urls.json')  # JSON lines
+SHARD_DIR = os.path.join(DATA_DIR, 'processed_urls_shards')  # part-NNNNN.json, one per chunk
+MANIFEST_PATH = os.path.join(DATA_DIR, 'processed_urls.manifest.json')  # incremental checkpoint
+FINGERPRINT_BYTES = 1 << 20  # bytes hashed at the head of the source and just before the offset
+
+# Field order of the records written by parse_row / parse_batch
+RECORD_FIELDS = ['url', 'type', 'domain', 'subdomain', 'tld', 'path', 'query', 'scheme',
+                 'has_https', 'url_length', 'num_subdomains', 'country', 'threat_score']
+SUSPICIOUS_TLDS = ['tk', 'xyz', 'info', 'top']
+BATCH_ROWS = 100000  # rows handed to parse_batch at a time
+SAMPLE_LINES = 1000  # lines used to detect the delimiter and header
+COLUMNS = ['url', 'type']
+SCALING_WORKERS = [1, 2, 4, 8, 16]
+
+# scheme, netloc, path(;params), query -- mirrors urlsplit for normalized http(s) URLs
+URL_PARTS_RE = r'^(https?)://([^/?#]*)([^?#]*)(?:\?([^#]*))?'
+# urlparse strips tabs/newlines, validates IPv6 brackets and NFKC-checks non-ASCII hosts;
+# rows containing these go through parse_row so both paths stay byte-identical
+SLOW_PATH_RE = r'[\t\r\n\[\]]|[^\x00-\x7f]'
 
 def detect_file():
     for p in RAW_PATHS:
@@ -31,7 +68,94 @@ def detect_file():
             return p
     raise FileNotFoundError("No raw file found. Place raw file as data/raw_urls.csv or .txt")
 
+def sniff_format(path):
+    """
+    Detects delimiter and header from the first SAMPLE_LINES lines only.
+    Returns (sep, has_header), or (None, False) for the whitespace fallback.
+    """
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        sample = ''.join(itertools.islice(f, SAMPLE_LINES))
+    # Try common delimiters
+    for sep in [',', '\t', ';', '|']:
+        try:
+            df = pd.read_csv(io.StringIO(sample), sep=sep, header=None, names=COLUMNS, dtype=str, engine='python', keep_default_na=False)
+            # Check if first row looks like header
+            has_header = df.shape[0] > 0 and df.iloc[0]['url'].strip().lower() == 'url' and df.iloc[0]['type'].strip().lower() == 'type'
+            if has_header:
+                df = df.iloc[1:]
+            # If second column has many non-empty values, assume correct
+            if df['type'].notna().sum() > 0:
+                return sep, has_header
+        except Exception:
+            continue
+    return None, False
+
+class RangeReader(io.RawIOBase):
+    # Exposes bytes [start, end) of a file so a growing feed is read up to a fixed point
+    def __init__(self, path, start, end):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(min(len(b), self.remaining))
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def iter_data(path, chunk_rows=BATCH_ROWS, start=0, end=None):
+    """
+    Streams the raw file as url/type DataFrames of at most chunk_rows rows.
+    start/end restrict reading to a byte range that begins on a line boundary.
+    """
+    sep, has_header = sniff_format(path)
+    if end is None:
+        end = os.path.getsize(path)
+    if end <= start:
+        return
+    with io.BufferedReader(RangeReader(path, start, end)) as f:
+        if sep is not None:
+            # Malformed lines are reported and skipped instead of aborting a multi-GB run
+            with pd.read_csv(f, sep=sep, header=None, names=COLUMNS, dtype=str, keep_default_na=False,
+                             skiprows=1 if has_header and start == 0 else 0, chunksize=chunk_rows,
+                             on_bad_lines='warn') as reader:
+                yield from reader
+            return
+        # fallback: split each line at the first whitespace
+        rows = []
+        for line in f:
+            line = line.decode('utf-8', errors='ignore').strip()
+            if not line:
+                continue
+            # try split by whitespace into two
+            if '\t' in line:
+                parts = line.split('\t', 1)
+            else:
+                parts = line.split(None, 1)
+            if len(parts) == 2:
+                rows.append(parts)
+            if len(rows) >= chunk_rows:
+                yield pd.DataFrame(rows, columns=COLUMNS)
+                rows = []
+        if rows:
+            yield pd.DataFrame(rows, columns=COLUMNS)
+
 def read_data(path):
+    # Whole file in memory; main() streams with iter_data instead
+    chunks = list(iter_data(path))
+    if not chunks:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(chunks, ignore_index=True)
+
+def read_data_original(path):
+    """The reader before iter_data (whole file, python engine), the baseline of --memory."""
     # Try common delimiters
     for sep in [',', '\t', ';', '|']:
         try:
@@ -61,6 +185,84 @@ def read_data(path):
                 rows.append(parts)
         return pd.DataFrame(rows, columns=['url','type'])
 
+def fingerprint(path, offset):
+    # Hashes the head of the source and the bytes just before offset; an append-only
+    # feed keeps both, while rotation, truncation or rewrites change them
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        h.update(f.read(min(offset, FINGERPRINT_BYTES)))
+        f.seek(max(0, offset - FINGERPRINT_BYTES))
+        h.update(f.read(min(offset, FINGERPRINT_BYTES)))
+    return h.hexdigest()
+
+def complete_end(path, start, end):
+    # Position just past the last newline in [start, end), so a half-written line is left for next time
+    with open(path, 'rb') as f:
+        pos = end
+        while pos > start:
+            block = min(65536, pos - start)
+            f.seek(pos - block)
+            i = f.read(block).rfind(b'\n')
+            if i >= 0:
+                return pos - block + i + 1
+            pos -= block
+    return start
+
+def ends_with_newline(path, end):
+    if end == 0:
+        return True
+    with open(path, 'rb') as f:
+        f.seek(end - 1)
+        return f.read(1) == b'\n'
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(path, offset, delta_start, rows, parquet_parts=None):
+    manifest = {
+        'source': os.path.abspath(path),
+        'offset': offset,
+        'ends_with_newline': ends_with_newline(path, offset),
+        'fingerprint': fingerprint(path, offset),
+        'output_size': os.path.getsize(OUTPATH),
+        'delta_start': delta_start,  # ingest.py --delta loads output bytes [delta_start, output_size)
+        'delta_rows': rows,
+        'parquet_parts': parquet_parts,  # None when no Parquet copy is kept
+        'updated': datetime.now().isoformat(timespec='seconds'),
+    }
+    tmp = MANIFEST_PATH + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, MANIFEST_PATH)
+
+def plan_incremental(path, manifest, parquet=False):
+    """
+    Returns (start, end) of the source bytes still to parse. start == 0 means
+    the checkpoint is unusable and the output must be rebuilt from scratch.
+    """
+    size = os.path.getsize(path)
+    if manifest is None:
+        reason = 'no checkpoint'
+    elif manifest['source'] != os.path.abspath(path):
+        reason = 'source file changed'
+    elif size < manifest['offset']:
+        reason = 'source shrank'
+    elif not manifest['ends_with_newline']:
+        reason = 'last run ended mid-line'
+    elif fingerprint(path, manifest['offset']) != manifest['fingerprint']:
+        reason = 'source prefix changed'
+    elif not os.path.exists(OUTPATH) or os.path.getsize(OUTPATH) < manifest['output_size']:
+        reason = 'output missing or truncated'
+    elif parquet and manifest.get('parquet_parts') is None:
+        reason = 'no Parquet copy of earlier runs'
+    else:
+        return manifest['offset'], complete_end(path, manifest['offset'], size)
+    print("Full rebuild:", reason)
+    return 0, size
+
 def normalize_url(u):
     if not u:
         return None
@@ -72,8 +274,8 @@ def normalize_url(u):
     return u
 
 def get_country(domain):
-    # For speed, skip API calls; return 'Unknown'
-    return 'Unknown'
+    # Local memory-mapped GeoIP lookup (see geoip.py); 'Unknown' without a database
+    return geoip.country_of(domain)
 
 def parse_row(u, label):
     try:
@@ -81,10 +283,7 @@ def parse_row(u, label):
         if not u_norm:
             return None
         p = urlparse(u_norm)
-        td = tldextract.extract(u_norm)
-        domain = '.'.join([s for s in [td.domain, td.suffix] if s]) or p.netloc
-        subdomain = td.subdomain or ''
-        tld = td.suffix or ''
+        domain, subdomain, tld = split_netloc(p.netloc)
         path = p.path or ''
         query = p.query or ''
         scheme = p.scheme or ''
@@ -92,7 +291,7 @@ def parse_row(u, label):
         num_subdomains = 0 if not subdomain else len(subdomain.split('.'))
         has_https = scheme == 'https'
         country = get_country(domain)
-        threat_score = (url_length / 100) + (num_subdomains * 2) + (1 if tld in ['tk', 'xyz', 'info', 'top'] else 0)
+        threat_score = (url_length / 100) + (num_subdomains * 2) + (1 if tld in SUSPICIOUS_TLDS else 0)
         # normalize label
         label = (label or '').strip().lower()
         if label == '':
@@ -115,27 +314,346 @@ def parse_row(u, label):
     except Exception:
         return None
 
-def main():
-    path = detect_file()
-    print("Reading:", path)
-    df = read_data(path)
-    print("Rows read:", len(df))
+def parse_batch(urls, labels):
+    """
+    Columnar version of parse_row over two aligned Series.
+    Returns a DataFrame with RECORD_FIELDS columns, keeping the input index;
+    rows parse_row would reject are dropped.
+    """
+    index = urls.index
+    urls = urls.reset_index(drop=True)
+    labels = labels.reset_index(drop=True)
+
+    stripped = urls.str.strip()
+    # parse_row drops None/'' and anything that is not a string
+    valid = stripped.notna() & (urls.str.len() > 0)
+    has_scheme = stripped.str.startswith(('http://', 'https://'), na=False)
+    u_norm = stripped.where(has_scheme, 'http://' + stripped)
+    # Non-string labels (None, NaN, numbers) keep parse_row's exact handling
+    label_ok = labels.str.len().notna()
+    slow = valid & (u_norm.str.contains(SLOW_PATH_RE, regex=True, na=False) | ~label_ok)
+    fast = valid & ~slow
+
+    u_fast = u_norm[fast]
+    parts = u_fast.str.extract(URL_PARTS_RE)
+    scheme = parts[0]
+    netloc = parts[1]
+    # urlparse splits ;params off the last path segment
+    path = parts[2].str.replace(r';[^/]*$', '', regex=True)
+    query = parts[3].fillna('')
+
+    # Each distinct netloc in the chunk is looked up once; split_netloc caches across chunks
+    codes, uniques = pd.factorize(netloc)
+    split = [split_netloc(n) for n in uniques]
+    domains = [d for d, _, _ in split]
+    subdomains = [sd for _, sd, _ in split]
+    countries = geoip.lookup_countries(domains)
+    num_subs = [0 if not sd else len(sd.split('.')) for sd in subdomains]
+    tlds = [t for _, _, t in split]
+
+    def take(values, dtype=object):
+        return pd.Series(np.array(values, dtype=dtype)[codes], index=u_fast.index, dtype=dtype)
+
+    tld = take(tlds)
+    num_subdomains = take(num_subs, 'int64')
+    url_length = u_fast.str.len().astype('int64')
+    threat_score = (url_length / 100) + (num_subdomains * 2) + tld.isin(SUSPICIOUS_TLDS).astype('int64')
+    label = labels[fast].fillna('').str.strip().str.lower()
+    label = label.where(label != '', 'unknown')
+
+    out = pd.DataFrame({
+        'url': u_fast.astype(object),
+        'type': label.astype(object),
+        'domain': take(domains),
+        'subdomain': take(subdomains),
+        'tld': tld,
+        'path': path.astype(object),
+        'query': query.astype(object),
+        'scheme': scheme.astype(object),
+        'has_https': (scheme == 'https').astype(bool),
+        'url_length': url_length,
+        'num_subdomains': num_subdomains,
+        'country': take(countries),
+        'threat_score': threat_score.astype('float64'),
+    }, columns=RECORD_FIELDS)
+
+    slow_rows = []
+    slow_pos = []
+    for pos in slow[slow].index:
+        rec = parse_row(urls[pos], labels[pos])
+        if rec:
+            slow_rows.append(rec)
+            slow_pos.append(pos)
+    if slow_rows:
+        out = pd.concat([out, pd.DataFrame(slow_rows, index=slow_pos, columns=RECORD_FIELDS)])
+        out = out.sort_index().astype({'has_https': bool, 'url_length': 'int64',
+                                       'num_subdomains': 'int64', 'threat_score': 'float64'})
+    out.index = index.take(out.index)
+    return out
+
+def to_json_lines(out):
+    return ''.join(json.dumps(rec, ensure_ascii=False) + '\n' for rec in out.to_dict('records'))
+
+def serialize_chunk(chunk):
+    # Runs in worker processes: one DataFrame of rows in, (rows, block of JSON lines) out
+    out = parse_batch(chunk['url'], chunk['type'])
+    return len(chunk), to_json_lines(out)
+
+def serialize_chunk_with_frame(chunk):
+    # With --parquet the parsed frame comes back too, for the parent's Parquet writer
+    out = parse_batch(chunk['url'], chunk['type'])
+    return len(chunk), to_json_lines(out), out
+
+def parse_chunk(chunk):
+    # For stream_ingest.py: the parsed frame itself, with no JSON step
+    return len(chunk), parse_batch(chunk['url'], chunk['type'])
+
+def write_shard(task):
+    chunk, shard_path, parquet_path = task
+    out = parse_batch(chunk['url'], chunk['type'])
+    with open(shard_path, 'w', encoding='utf-8') as fout:
+        fout.write(to_json_lines(out))
+    if parquet_path:
+        columnar.write_part(out, parquet_path)
+    return len(chunk), shard_path
+
+def shard_path(seq):
+    return os.path.join(SHARD_DIR, f'part-{seq:05d}.json')
+
+def iter_chunks(df, size=BATCH_ROWS):
+    for start in range(0, len(df), size):
+        yield df.iloc[start:start + size]
+
+def map_chunks(fn, tasks, workers=1):
+    """
+    Yields fn(task) for each task in input order. With workers > 1 the tasks run
+    in a process pool with at most two per worker in flight, so memory stays bounded.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield fn(task)
+        return
+    # Workers start with the parent's GeoIP settings whatever the start method
+    with ProcessPoolExecutor(max_workers=workers, initializer=geoip.configure,
+                             initargs=geoip.current_settings()) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(fn, task))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def clean_data(df):
     # Basic cleaning
     df['url'] = df['url'].astype(str).str.strip()
     df['type'] = df['type'].astype(str).str.strip().str.lower()
     # Drop blank URLs
-    df = df[df['url'].str.len() > 0].copy()
-    print("After dropping empty URLs:", len(df))
-
-    # Parse and convert
-    out_file = OUTPATH
-    os.makedirs(os.path.dirname(out_file), exist_ok=True)
-    with open(out_file, 'w', encoding='utf-8') as fout:
-        for _, row in tqdm(df.iterrows(), total=len(df), desc='Parsing URLs'):
-            rec = parse_row(row['url'], row['type'])
-            if rec:
-                fout.write(json.dumps(rec, ensure_ascii=False) + '\n')
-    print("Processed data saved to:", out_file)
+    return df[df['url'].str.len() > 0].copy()
+
+def benchmark(df, rows=200000):
+    """Times the per-row parse_row loop against parse_batch and checks both write identical bytes."""
+    df = df.head(rows)
+    print(f"Benchmarking on {len(df)} rows")
+
+    start = time.perf_counter()
+    row_lines = []
+    for _, row in df.iterrows():
+        rec = parse_row(row['url'], row['type'])
+        if rec:
+            row_lines.append(json.dumps(rec, ensure_ascii=False) + '\n')
+    row_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_lines = [json.dumps(rec, ensure_ascii=False) + '\n'
+                   for rec in parse_batch(df['url'], df['type']).to_dict('records')]
+    batch_secs = time.perf_counter() - start
+
+    identical = ''.join(row_lines).encode('utf-8') == ''.join(batch_lines).encode('utf-8')
+    print(f"parse_row:   {row_secs:.2f}s ({len(df) / row_secs:,.0f} rows/s)")
+    print(f"parse_batch: {batch_secs:.2f}s ({len(df) / batch_secs:,.0f} rows/s)")
+    print(f"Speedup: {row_secs / batch_secs:.1f}x, output identical: {identical}")
+    if not identical:
+        for a, b in zip(row_lines, batch_lines):
+            if a != b:
+                print("First mismatch:\n  row:  ", a.strip(), "\n  batch:", b.strip())
+                break
+    if geoip.enabled():
+        geoip_overhead(df)
+    return identical
+
+def geoip_overhead(df):
+    # parse_batch with a cold GeoIP cache against parse_batch without enrichment, best of 3
+    db_path, resolve = geoip.current_settings()
+    timings = {'without GeoIP': [], 'with GeoIP': []}
+    for _ in range(3):
+        for name, path in [('without GeoIP', None), ('with GeoIP', db_path)]:
+            geoip.configure(path, resolve)
+            start = time.perf_counter()
+            parse_batch(df['url'], df['type'])
+            timings[name].append(time.perf_counter() - start)
+    timings = {name: min(secs) for name, secs in timings.items()}
+    print(f"GeoIP enrichment ({resolve} resolve): "
+          f"{timings['with GeoIP'] / timings['without GeoIP'] - 1:+.1%} parse time")
+
+def scaling_benchmark(df, rows=200000, worker_counts=SCALING_WORKERS):
+    """Reports rows/sec of the ordered single-file path for each worker count."""
+    df = df.head(rows)
+    # Same chunking for every run so only the worker count changes
+    chunk_rows = max(1000, -(-len(df) // (max(worker_counts) * 4)))
+    print(f"Scaling on {len(df)} rows, {chunk_rows} rows per chunk ({os.cpu_count()} CPUs)")
+    base = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        for _ in map_chunks(serialize_chunk, iter_chunks(df, chunk_rows), workers):
+            pass
+        rate = len(df) / (time.perf_counter() - start)
+        base = base or rate
+        print(f"{workers:>3} workers: {rate:,.0f} rows/s ({rate / base:.2f}x)")
+
+def _peak_rss(mode, path, chunk_rows):
+    # Runs in a fresh process so ru_maxrss covers only this reader
+    if mode == 'eager':
+        chunks = iter_chunks(clean_data(read_data_original(path)), chunk_rows)
+    else:
+        chunks = (clean_data(chunk) for chunk in iter_data(path, chunk_rows))
+    rows = 0
+    with open(os.devnull, 'w', encoding='utf-8') as fout:
+        for n, lines in map(serialize_chunk, chunks):
+            rows += n
+            fout.write(lines)
+    return rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def memory_benchmark(path, chunk_rows=BATCH_ROWS):
+    """Compares peak RSS of the original whole-file reader against the streaming reader."""
+    print(f"Peak RSS for {path} ({os.path.getsize(path) / 2**20:.0f} MB)")
+    results = {}
+    for mode in ['eager', 'stream']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            start = time.perf_counter()
+            rows, peak_mb = pool.submit(_peak_rss, mode, path, chunk_rows).result()
+            secs = time.perf_counter() - start
+        results[mode] = peak_mb
+        print(f"{mode:>7}: {peak_mb:,.0f} MB peak, {rows} rows in {secs:.1f}s")
+    print(f"Streaming uses {results['stream'] / results['eager']:.0%} of the whole-file peak")
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess raw URL feeds into JSON lines.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare parse_row and parse_batch throughput instead of writing output')
+    parser.add_argument('--bench-rows', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=1, help='parse chunks in N worker processes')
+    parser.add_argument('--chunk-rows', type=int, default=BATCH_ROWS, help='rows per chunk sent to a worker')
+    parser.add_argument('--shards', action='store_true',
+                        help=f'write one part file per chunk into {SHARD_DIR} instead of {OUTPATH}')
+    parser.add_argument('--scaling', action='store_true',
+                        help='report rows/sec for 1, 2, 4, 8 and 16 workers instead of writing output')
+    parser.add_argument('--memory', action='store_true',
+                        help='compare peak RSS of whole-file reading and streaming instead of writing output')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'parse only lines appended since the checkpoint in {MANIFEST_PATH}')
+    parser.add_argument('--parquet', action='store_true',
+                        help=f'also write the records as Parquet into {columnar.PARQUET_DIR}')
+    parser.add_argument('--geoip-db', default=geoip.GEOIP_DB,
+                        help='MaxMind-format .mmdb used for the country field (skipped if missing)')
+    parser.add_argument('--resolve', choices=geoip.RESOLVE_MODES, default='off',
+                        help=f'how domains become IPs for GeoIP: off (IP literals only), '
+                             f'cache ({geoip.RESOLVER_CACHE}) or dns (cache, then DNS)')
+    args = parser.parse_args()
+    if args.incremental and args.shards:
+        parser.error('--incremental appends to the JSON file and cannot be combined with --shards')
+    if args.parquet:
+        columnar.require_pyarrow()
+
+    geoip.configure(args.geoip_db, args.resolve)
+    path = detect_file()
+    print("Reading:", path)
+    print("GeoIP:", f"{args.geoip_db} ({args.resolve} resolve)" if geoip.enabled() else "disabled")
+
+    if args.memory:
+        memory_benchmark(path, args.chunk_rows)
+        return
+    if args.benchmark or args.scaling:
+        df = clean_data(next(iter_data(path, args.bench_rows), pd.DataFrame(columns=COLUMNS)))
+        if args.benchmark:
+            benchmark(df, args.bench_rows)
+        else:
+            scaling_benchmark(df, args.bench_rows)
+        return
+
+    manifest = load_manifest()
+    if args.incremental:
+        start, end = plan_incremental(path, manifest, args.parquet)
+        if start:
+            print(f"Resuming at byte {start:,}: {end - start:,} new bytes")
+    else:
+        start, end = 0, os.path.getsize(path)
+    # A resumed run keeps an existing Parquet copy in step with the JSON file
+    parquet = args.parquet or bool(start and manifest.get('parquet_parts') is not None)
+
+    stats = {'read': 0, 'kept': 0}
+
+    def cleaned_chunks():
+        for chunk in iter_data(path, args.chunk_rows, start, end):
+            stats['read'] += len(chunk)
+            chunk = clean_data(chunk)
+            stats['kept'] += len(chunk)
+            yield chunk
+
+    # Parse and convert; the JSON file and the shard directory replace each other
+    os.makedirs(DATA_DIR, exist_ok=True)
+    if not start:
+        shutil.rmtree(columnar.PARQUET_DIR, ignore_errors=True)
+    if parquet:
+        os.makedirs(columnar.PARQUET_DIR, exist_ok=True)
+    with tqdm(desc='Parsing URLs', unit=' rows') as bar:
+        if args.shards:
+            if os.path.exists(OUTPATH):
+                os.remove(OUTPATH)
+            shutil.rmtree(SHARD_DIR, ignore_errors=True)
+            os.makedirs(SHARD_DIR)
+            if os.path.exists(MANIFEST_PATH):
+                os.remove(MANIFEST_PATH)
+            tasks = ((chunk, shard_path(seq), columnar.part_path(seq) if parquet else None)
+                     for seq, chunk in enumerate(cleaned_chunks()))
+            for rows, _ in map_chunks(write_shard, tasks, args.workers):
+                bar.update(rows)
+        else:
+            shutil.rmtree(SHARD_DIR, ignore_errors=True)
+            parquet_parts = manifest.get('parquet_parts') if start else 0
+            if start:
+                # Drop anything a crashed run appended after the checkpoint
+                delta_start = manifest['output_size']
+                with open(OUTPATH, 'r+b') as f:
+                    f.truncate(delta_start)
+                for seq in range(parquet_parts or 0, columnar.next_part_seq()):
+                    os.remove(columnar.part_path(seq))
+            else:
+                delta_start = 0
+            # One Parquet part per run, one row group per chunk
+            writer = columnar.open_writer(columnar.part_path(parquet_parts)) if parquet else None
+            fn = serialize_chunk_with_frame if parquet else serialize_chunk
+            written = 0
+            with open(OUTPATH, 'a' if start else 'w', encoding='utf-8') as fout:
+                for rows, lines, *frame in map_chunks(fn, cleaned_chunks(), args.workers):
+                    fout.write(lines)
+                    if writer:
+                        writer.write_table(columnar.to_table(frame[0]))
+                    written += lines.count('\n')
+                    bar.update(rows)
+            if writer:
+                writer.close()
+            save_manifest(path, end, delta_start, written, parquet_parts + 1 if parquet else None)
+    print("Rows read:", stats['read'])
+    print("After dropping empty URLs:", stats['kept'])
+    if args.workers <= 1:
+        print("Domain cache:", cache_stats())
+    if args.shards:
+        print("Processed shards saved to:", SHARD_DIR, f"({len(glob.glob(os.path.join(SHARD_DIR, '*.json')))} files)")
+    else:
+        print("Processed data saved to:", OUTPATH)
+    if parquet:
+        print("Parquet copy saved to:", columnar.PARQUET_DIR)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
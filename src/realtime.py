@@ -1,23 +1,489 @@
 """
 realtime.py
-Listens for new inserts using MongoDB Change Streams.
+Scores new URLs as they are inserted, from a MongoDB Change Stream (needs a replica set).
+
+Inserts are buffered into micro-batches, flushed at --batch-size events or when the
+oldest buffered event is --max-latency-ms old, whichever comes first. Each batch:
+ - is classified in one call to the model saved by ml_predict.py (predict_batch)
+ - gets its verdicts written back with one bulk update (predicted_type, confidence)
+ - is added to the predicted_counts collection with one bulk $inc
+ - is scored by the online anomaly detector (online_anomaly.py), which writes
+   what it flags to the anomalies collection
+Every SUMMARY_SECONDS the consumer also runs heavy_hitters.update() in a thread, which
+folds the settled inserts into the heavy-hitter summaries (a fold already running
+elsewhere is left to finish instead).
+Without a saved model the verdicts are skipped and only the aggregates are updated.
+
+The consumer runs on asyncio: the model runs in a thread while up to --max-in-flight
+batch writes are outstanding. The resume token of the last batch whose writes have
+finished (and of every batch before it) is saved to stream_checkpoints every
+CHECKPOINT_SECONDS and on exit, and a restart resumes after it. A batch only counts
+as finished once the anomalies flagged so far are stored too. Events are therefore
+never dropped; after a crash the batches in flight are scored again. Verdicts are
+only written to documents without one, and predicted_counts only gets the verdicts
+this run wrote, so the counts stay exact.
+
+--workers N runs N processes, each watching the inserts whose document key falls in
+its hash partition (partition_of, evaluated by the server in the change stream's
+$match), with its own checkpoint; --partition I --partitions N runs one of them, for
+spreading the partitions over machines. After a change of worker count each new
+worker starts from the oldest checkpoint of the old layout, whose checkpoints are
+deleted once every new partition has saved one. A checkpoint older than the oplog
+cannot be resumed from; the worker warns and starts from the current inserts. The summary fold reads the whole collection,
+so only partition 0 runs it. The anomaly detector keeps statistics per type, tld and
+domain, and a worker would see only its share of each key's events, so partitioned
+workers skip it; run a single worker for online anomaly detection.
+
+Latency is measured from the insert (the event's wallTime, else the document's
+ingested_at) to the end of the verdict write; p50/p99 and events/sec are printed
+every REPORT_SECONDS and on exit. --replay N feeds N stored documents through an
+in-process stand-in for the change stream instead, to measure without a replica set.
+A replay works on copies: the documents are copied (without their verdicts) into
+replay_urls, and verdicts, counts and anomalies go to the replay_ collections, which
+are cleared first; checkpoints and summaries are left alone.
 """
 
-from pymongo import MongoClient
+import time
+import asyncio
+import argparse
+import multiprocessing
+from collections import Counter, deque
+from datetime import datetime, timezone
+import numpy as np
+from pymongo import MongoClient, AsyncMongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+from domains import split_url
+import heavy_hitters
+import online_anomaly
+import ml_predict
 
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "cyber_intel"
 COLL_NAME = "urls"
+COUNTS_COLL = "predicted_counts"
+CHECKPOINT_COLL = "stream_checkpoints"
+REPLAY_PREFIX = "replay_"  # scratch collections of --replay
+VERDICT_FIELDS = ['predicted_type', 'confidence', 'scored_at']
+SUMMARY_SECONDS = 30  # between heavy-hitter folds
+BATCH_SIZE = 256  # events per micro-batch
+MAX_LATENCY_MS = 200  # oldest buffered event waits at most this long before a flush
+MAX_IN_FLIGHT = 8  # batch writes outstanding per worker
+CHECKPOINT_SECONDS = 5
+REPORT_SECONDS = 10
+LATENCY_SAMPLES = 100000  # most recent latencies kept for the percentiles
+HEX_DIGITS = '0123456789abcdef'
+PARTITION_CHARS = 6  # trailing characters of the key that are hashed
+PARTITION_BASE = 31
+HISTORY_LOST = 286  # ChangeStreamHistoryLost: the resume point has left the oplog
 
 client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 col = db[COLL_NAME]
 
+def partition_of(key, partitions):
+    """
+    Partition of a document key. Keys are ObjectIds (ending in a counter), URL hashes
+    or '<load id>-<source>-<byte offset>', so their last characters vary the most.
+    """
+    value = 0
+    for c in str(key)[-PARTITION_CHARS:]:
+        value = value * PARTITION_BASE + HEX_DIGITS.find(c) + 1
+    return value % partitions
+
+def partition_expr(field, partitions):
+    # partition_of() as an aggregation expression, for the server to filter with
+    length = {"$strLenCP": "$$key"}
+    terms = []
+    for i in range(PARTITION_CHARS):
+        at = {"$subtract": [length, PARTITION_CHARS - i]}
+        digit = {"$add": [{"$indexOfCP": [HEX_DIGITS, {"$substrCP": ["$$key", {"$max": [at, 0]}, 1]}]}, 1]}
+        terms.append({"$cond": [{"$gte": [at, 0]},
+                                {"$multiply": [digit, PARTITION_BASE ** (PARTITION_CHARS - 1 - i)]}, 0]})
+    return {"$let": {"vars": {"key": {"$toString": field}}, "in": {"$mod": [{"$add": terms}, partitions]}}}
+
+def watch_pipeline(partition=0, partitions=1):
+    match = {'operationType': 'insert'}
+    if partitions > 1:
+        match['$expr'] = {"$eq": [partition_expr("$documentKey._id", partitions), partition]}
+    return [{'$match': match}]
+
+def checkpoint_id(partition, partitions):
+    return f"realtime-{partition}of{partitions}"
+
+def resume_options(partition=0, partitions=1):
+    """watch() arguments that continue where this partition's last run stopped."""
+    saved = db[CHECKPOINT_COLL].find_one({'_id': checkpoint_id(partition, partitions)})
+    if saved:
+        print(f"Resuming after {saved['events']} events (checkpoint of {saved['saved_at']:%Y-%m-%d %H:%M:%S})")
+        return {'resume_after': saved['token']}
+    # The worker count changed: the old tokens cover other partitions, so start
+    # from the oldest of them, inclusive
+    oldest = db[CHECKPOINT_COLL].find_one({'_id': {'$regex': '^realtime-'}}, sort=[('cluster_time', 1)])
+    if oldest:
+        print(f"No checkpoint for {partitions} partitions; starting from the oldest of {oldest['partitions']}")
+        return {'start_at_operation_time': oldest['cluster_time']}
+    return {}
+
+def age_seconds(stamp, now):
+    # pymongo returns naive UTC datetimes
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=timezone.utc)
+    return (now - stamp).total_seconds()
+
+class ReplayStream:
+    """Change-stream stand-in that emits stored documents as inserts, stamped when emitted."""
+
+    def __init__(self, docs, rate=None):
+        self.docs = iter(docs)
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.alive = True
+
+    async def try_next(self):
+        if self.interval and time.monotonic() < self.next_at:
+            await asyncio.sleep(min(self.next_at - time.monotonic(), 0.01))
+            return None
+        doc = next(self.docs, None)
+        if doc is None:
+            self.alive = False
+            return None
+        self.next_at += self.interval
+        return {'operationType': 'insert', 'fullDocument': doc, 'wallTime': datetime.now(timezone.utc)}
+
+    async def close(self):
+        self.alive = False
+
+class Checkpoint:
+    """Resume token of one partition, advanced only past batches whose writes all finished."""
+
+    def __init__(self, coll, partition=0, partitions=1, every=CHECKPOINT_SECONDS):
+        self.coll = coll
+        self.partition = partition
+        self.partitions = partitions
+        self.every = every
+        self.issued = 0
+        self.next = 0  # first batch not finished yet
+        self.finished = {}  # seq -> last event, for batches finished out of order
+        self.last = None
+        self.events = 0
+        self.saved = None
+        self.saved_at = time.monotonic()
+        self.superseded = False  # checkpoints of other worker counts deleted
+
+    def issue(self):
+        self.issued += 1
+        return self.issued - 1
+
+    def finish(self, seq, change, events):
+        self.finished[seq] = (change, events)
+        while self.next in self.finished:
+            change, events = self.finished.pop(self.next)
+            self.next += 1
+            self.events += events
+            if change.get('_id') is not None:
+                self.last = change
+
+    async def save(self, force=False):
+        if self.last is None or self.last is self.saved:
+            return
+        if not force and time.monotonic() - self.saved_at < self.every:
+            return
+        last, self.saved, self.saved_at = self.last, self.last, time.monotonic()
+        await self.coll.replace_one({'_id': checkpoint_id(self.partition, self.partitions)}, {
+            'token': last['_id'], 'cluster_time': last.get('clusterTime'), 'partition': self.partition,
+            'partitions': self.partitions, 'events': self.events, 'saved_at': datetime.now(timezone.utc)},
+            upsert=True)
+        if not self.superseded:
+            await self.supersede()
+
+    async def supersede(self):
+        # Old-layout checkpoints are where new partitions without one start, so they
+        # go only once every partition of this layout has its own
+        ours = {'_id': {'$regex': '^realtime-'}, 'partitions': self.partitions}
+        if await self.coll.count_documents(ours) >= self.partitions:
+            await self.coll.delete_many({'_id': {'$regex': '^realtime-'}, 'partitions': {'$ne': self.partitions}})
+            self.superseded = True
+
+class ScoringConsumer:
+    """Buffers insert events and scores, writes and aggregates them a batch at a time."""
+
+    def __init__(self, bundle, urls, counts, checkpoint=None, batch_size=BATCH_SIZE,
+                 max_latency_ms=MAX_LATENCY_MS, max_in_flight=MAX_IN_FLIGHT, verbose=True,
+                 detector=None, sink=None, summaries=True, anomalies=True):
+        self.bundle = bundle
+        self.urls = urls
+        self.counts = counts
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.writes = set()
+        self.failed = None
+        self.verbose = verbose
+        self.detector = (detector or online_anomaly.Detector()) if anomalies else None
+        self.sink = sink or online_anomaly.AnomalySink()
+        self.summaries = summaries
+        self.folding = None
+        self.folded = time.monotonic()
+        self.batch = []
+        self.deadline = None
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.events = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    async def add(self, change):
+        if not self.batch:
+            self.deadline = time.monotonic() + self.max_latency
+        self.batch.append(change)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    async def poll(self):
+        # Flushes a partial batch once its oldest event has waited max_latency
+        if self.failed:
+            raise self.failed
+        if self.batch and time.monotonic() >= self.deadline:
+            await self.flush()
+        self.sink.poll()
+        if self.checkpoint:
+            await self.checkpoint.save()
+        if self.summaries and self.folding is None and time.monotonic() - self.folded >= SUMMARY_SECONDS:
+            self.folding = asyncio.create_task(self.fold())
+
+    async def fold(self):
+        try:
+            await asyncio.to_thread(heavy_hitters.update, wait=False, verbose=False)
+        except Exception as e:
+            # The summaries only lag; the next fold picks up from the same watermark
+            print(f"Heavy-hitter fold failed: {e}")
+        finally:
+            self.folded = time.monotonic()
+            self.folding = None
+
+    async def flush(self):
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        seq = self.checkpoint.issue() if self.checkpoint else None
+        # The model and detectors run in a thread while earlier writes complete
+        docs, verdicts, updates, scored_at = await asyncio.to_thread(self.score, batch)
+        await self.slots.acquire()
+        task = asyncio.create_task(self.write(seq, batch, docs, verdicts, updates, scored_at))
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+
+    def score(self, batch):
+        docs = []
+        for change in batch:
+            doc = change['fullDocument']
+            if not doc.get('domain'):
+                doc = dict(doc, domain=split_url(doc['url'])[0])
+            docs.append(doc)
+            self.observe(doc)
+
+        verdicts = Counter()
+        updates = []
+        scored_at = None
+        if self.bundle is not None:
+            labels, confidence = ml_predict.predict_batch(self.bundle, docs)
+            scored_at = datetime.now(timezone.utc)
+            # BSON dates keep milliseconds; rounded, the stamp finds this batch's writes again
+            scored_at = scored_at.replace(microsecond=scored_at.microsecond // 1000 * 1000)
+            updates = [UpdateOne({'_id': doc['_id'], 'predicted_type': {'$exists': False}}, {'$set': {
+                'predicted_type': label, 'confidence': conf, 'scored_at': scored_at}})
+                for doc, label, conf in zip(docs, labels, confidence)]
+            verdicts.update(labels)
+        return docs, verdicts, updates, scored_at
+
+    async def write(self, seq, batch, docs, verdicts, updates, scored_at):
+        try:
+            if updates:
+                result = await self.urls.bulk_write(updates, ordered=False)
+                if result.modified_count < len(updates):
+                    # Part of the batch was scored before a restart: count only what this write set
+                    cursor = self.urls.find({'_id': {'$in': [doc['_id'] for doc in docs]}, 'scored_at': scored_at},
+                                            {'predicted_type': 1})
+                    verdicts = Counter([d['predicted_type'] async for d in cursor])
+            if verdicts:
+                await self.counts.bulk_write([UpdateOne({'_id': label}, {'$inc': {'value': count}}, upsert=True)
+                                              for label, count in verdicts.items()], ordered=False)
+            # The checkpoint must not pass anomalies still buffered in the sink
+            await asyncio.to_thread(self.sink.flush)
+        except Exception as e:
+            # The checkpoint stays before this batch; poll() stops the worker
+            self.failed = e
+            return
+        finally:
+            self.slots.release()
+
+        now = datetime.now(timezone.utc)
+        for change, doc in zip(batch, docs):
+            stamp = change.get('wallTime') or doc.get('ingested_at')
+            if stamp is not None:
+                self.latencies.append(age_seconds(stamp, now))
+        self.events += len(batch)
+        self.batches += 1
+        if self.checkpoint:
+            self.checkpoint.finish(seq, batch[-1], len(batch))
+        if self.verbose:
+            print(f"Scored {len(batch)} URLs: {dict(verdicts) or 'no model, aggregates only'}")
+
+    def observe(self, doc):
+        if self.detector is None:
+            return
+        for record in self.detector.observe(doc):
+            print(f"  anomaly: {record['key_field']}={record['key']} "
+                  f"{record['field']} {record['value']:.2f} (z={record['score']:+.1f})")
+            self.sink.add([record])
+
+    async def close(self):
+        if not self.failed:
+            await self.flush()
+        await asyncio.gather(*self.writes)
+        self.sink.flush()
+        if self.folding:
+            await self.folding
+        if self.checkpoint:
+            await self.checkpoint.save(force=True)
+        if self.failed:
+            raise self.failed
+
+    def report(self):
+        secs = time.perf_counter() - self.started
+        if not self.latencies:
+            print(f"{self.events} events in {secs:.1f}s")
+            return
+        p50, p99 = np.percentile(np.fromiter(self.latencies, float), [50, 99]) * 1000
+        print(f"{self.events} events in {self.batches} batches, {self.events / secs:,.0f} events/s, "
+              f"insert-to-verdict latency p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+
+async def consume(stream, consumer):
+    """Feeds a change stream (or ReplayStream) into consumer until the stream closes."""
+    last_report = time.monotonic()
+    try:
+        while stream.alive:
+            change = await stream.try_next()
+            if change is not None:
+                await consumer.add(change)
+            await consumer.poll()
+            if time.monotonic() - last_report >= REPORT_SECONDS:
+                consumer.report()
+                last_report = time.monotonic()
+    finally:
+        await consumer.close()
+        await stream.close()
+        consumer.report()
+
+def replay_docs(n, partition=0, partitions=1):
+    """This partition's share of n stored documents, copied into the scratch urls collection."""
+    docs = [{k: v for k, v in d.items() if k not in VERDICT_FIELDS}
+            for d in col.find({}).limit(n) if partition_of(d['_id'], partitions) == partition]
+    scratch = db[REPLAY_PREFIX + COLL_NAME]
+    scratch.delete_many({'_id': {'$in': [d['_id'] for d in docs]}})
+    if docs:
+        scratch.insert_many(docs, ordered=False)
+    return docs
+
+def clear_replay():
+    for name in [COLL_NAME, COUNTS_COLL, online_anomaly.ANOMALY_COLL]:
+        db[REPLAY_PREFIX + name].drop()
+
+async def open_stream(coll, partition, partitions, max_await_time_ms):
+    # try_next() waits at most max_await_time_ms, so partial batches still meet their deadline
+    pipeline = watch_pipeline(partition, partitions)
+    try:
+        return await coll.watch(pipeline, max_await_time_ms=max_await_time_ms,
+                                **resume_options(partition, partitions))
+    except OperationFailure as e:
+        if e.code != HISTORY_LOST:
+            raise
+        print("The checkpoint is older than the oplog; starting from new inserts. "
+              "URLs inserted in between are not scored.")
+        return await coll.watch(pipeline, max_await_time_ms=max_await_time_ms)
+
+async def run_partition(args, partition=0, partitions=1):
+    """Consumes one partition of the inserts; returns (events, seconds)."""
+    bundle = ml_predict.load_model()
+    if bundle is None:
+        print("No trained model at", ml_predict.MODEL_PATH, "- run ml_predict.py; scoring is skipped")
+    aclient = AsyncMongoClient(MONGO_URI)
+    adb = aclient[DB_NAME]
+    name = f"[{partition + 1}/{partitions}] " if partitions > 1 else ""
+    if args.replay:
+        docs = replay_docs(args.replay, partition, partitions)
+        prefix, checkpoint = REPLAY_PREFIX, None
+    else:
+        prefix, checkpoint = "", Checkpoint(adb[CHECKPOINT_COLL], partition, partitions)
+    consumer = ScoringConsumer(bundle, adb[prefix + COLL_NAME], adb[prefix + COUNTS_COLL], checkpoint,
+                               args.batch_size, args.max_latency_ms, args.max_in_flight, verbose=not args.replay,
+                               detector=online_anomaly.Detector(args.mode, args.threshold),
+                               sink=online_anomaly.AnomalySink(db[prefix + online_anomaly.ANOMALY_COLL]),
+                               summaries=partition == 0 and not args.replay, anomalies=partitions == 1)
+    try:
+        if args.replay:
+            print(f"{name}Replaying {len(docs)} documents")
+            await consume(ReplayStream(docs, args.rate), consumer)
+        else:
+            print(f"{name}Listening for changes...")
+            stream = await open_stream(adb[COLL_NAME], partition, partitions, max(int(args.max_latency_ms / 2), 1))
+            await consume(stream, consumer)
+    finally:
+        await aclient.close()
+    return consumer.events, time.perf_counter() - consumer.started
+
+def worker(args, partition, partitions, results):
+    try:
+        results.put(asyncio.run(run_partition(args, partition, partitions)))
+    except KeyboardInterrupt:
+        results.put((0, 0.0))
+
+def run_workers(args):
+    # spawn, not fork: every process opens its own clients
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(args, i, args.workers, results)) for i in range(args.workers)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    try:
+        done = [results.get() for _ in procs]
+    except KeyboardInterrupt:
+        # The workers got the interrupt too and are saving their checkpoints
+        done = []
+    for p in procs:
+        p.join()
+    if done:
+        events = sum(e for e, _ in done)
+        print(f"{args.workers} workers: {events} events in {time.perf_counter() - start:.1f}s "
+              f"({events / max(max(s for _, s in done), 1e-9):,.0f} events/s)")
+
 def main():
-    print("Listening for changes...")
-    with col.watch() as stream:
-        for change in stream:
-            print("New document inserted:", change['fullDocument']['url'])
+    parser = argparse.ArgumentParser(description='Score new URLs from the change stream in micro-batches.')
+    parser.add_argument('--mode', choices=online_anomaly.MODES, default='welford',
+                        help='running statistics of the anomaly detector')
+    parser.add_argument('--threshold', type=float, default=online_anomaly.THRESHOLD)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--max-latency-ms', type=float, default=MAX_LATENCY_MS)
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help='batch writes outstanding per worker')
+    parser.add_argument('--workers', type=int, default=1, help='processes, one hash partition each')
+    parser.add_argument('--partition', type=int, help='run only this partition (0-based) of --partitions')
+    parser.add_argument('--partitions', type=int, default=1)
+    parser.add_argument('--replay', type=int, metavar='N',
+                        help='score N stored documents through an in-process stream instead of watching')
+    parser.add_argument('--rate', type=float, help='with --replay, events per second (default: as fast as possible)')
+    args = parser.parse_args()
+
+    online_anomaly.create_indexes()
+    if args.replay and args.partition is None:
+        # A single --partition leaves the other partitions' copies in place
+        clear_replay()
+    if args.workers > 1:
+        run_workers(args)
+    elif args.partition is not None:
+        asyncio.run(run_partition(args, args.partition, args.partitions))
+    else:
+        asyncio.run(run_partition(args))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
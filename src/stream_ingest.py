@@ -0,0 +1,160 @@
+"""
+stream_ingest.py
+Preprocesses and ingests in one pass: chunks of the raw feed are parsed by
+preprocess.parse_batch and the records go straight into MongoDB bulk writes,
+without writing and re-reading data/processed_urls.json.
+
+Parsing runs on this process (or --workers processes) and writing on --writers
+threads; both stages hold at most two chunks/batches per worker, so a slow
+database stalls the reader instead of filling memory.
+--audit also writes the JSON lines file, as a record of what was loaded.
+--compare times this against the two-stage run (preprocess to a JSON file,
+then ingest it) on scratch collections and reports the time saved.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from pymongo import MongoClient
+from tqdm import tqdm
+import geoip
+import preprocess
+import ingest
+
+SCRATCH_PREFIX = 'stream_compare_'  # --compare loads into these and drops them
+
+def cleaned_chunks(path, chunk_rows, stats):
+    for chunk in preprocess.iter_data(path, chunk_rows):
+        stats['read'] += len(chunk)
+        chunk = preprocess.clean_data(chunk)
+        stats['kept'] += len(chunk)
+        yield chunk
+
+def doc_batches(frames, batch_size, audit=None):
+    """Turns parsed frames into (rows, documents) batches, optionally logging JSON lines to `audit`."""
+    batch = []
+    for out in frames:
+        if audit:
+            # From the frame, before the writers stamp the documents and add their _id
+            audit.write(preprocess.to_json_lines(out))
+        for doc in out.to_dict('records'):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield len(batch), batch
+                batch = []
+    if batch:
+        yield len(batch), batch
+
+def stream_ingest(col, path, chunk_rows=preprocess.BATCH_ROWS, batch_size=ingest.BATCH_SIZE,
+                  workers=1, writers=4, dedup=False, overwrite_type=False, audit_path=None):
+    """Parses `path` and writes the records into `col`. Returns read/kept/inserted counts."""
+    stats = {'read': 0, 'kept': 0}
+    audit = open(audit_path, 'w', encoding='utf-8') if audit_path else None
+    try:
+        with tqdm(desc='Streaming URLs', unit=' docs') as bar:
+            frames = (out for _, out in preprocess.map_chunks(
+                preprocess.parse_chunk, cleaned_chunks(path, chunk_rows, stats), workers))
+            written = ingest.write_concurrently(
+                col, doc_batches(frames, batch_size, audit), writers,
+                lambda tag, count, written: bar.update(count), ingest.request_maker(dedup, overwrite_type))
+    finally:
+        if audit:
+            audit.close()
+    stats.update(written)
+    return stats
+
+def two_stage_ingest(col, path, json_path, chunk_rows=preprocess.BATCH_ROWS,
+                     batch_size=ingest.BATCH_SIZE, workers=1, writers=4):
+    # What main.py did before: preprocess.py writes JSON lines, ingest.py decodes them again
+    # (its pipelined loader with the same writers and batch size, progress kept next to json_path)
+    stats = {'read': 0, 'kept': 0}
+    with open(json_path, 'w', encoding='utf-8') as fout:
+        for _, lines in preprocess.map_chunks(preprocess.serialize_chunk,
+                                              cleaned_chunks(path, chunk_rows, stats), workers):
+            fout.write(lines)
+
+    progress = ingest.pipelined_ingest(col, [(json_path, 0, None)], batch_size, writers, resume=False,
+                                       progress_path=json_path + '.progress')
+    stats.update({key: progress[key] for key in ['inserted', 'new', 'modified']})
+    return stats
+
+def compare(db, path, chunk_rows, batch_size, workers, writers):
+    """Times the two-stage run against the fused one on scratch collections."""
+    timings = {}
+    counts = {}
+    with tempfile.TemporaryDirectory(dir=preprocess.DATA_DIR) as tmp:
+        runs = [
+            ('two-stage', lambda col: two_stage_ingest(col, path, os.path.join(tmp, 'processed_urls.json'),
+                                                       chunk_rows, batch_size, workers, writers)),
+            ('fused', lambda col: stream_ingest(col, path, chunk_rows, batch_size, workers, writers)),
+        ]
+        for name, run in runs:
+            col = db[SCRATCH_PREFIX + name.replace('-', '_')]
+            col.drop()
+            start = time.perf_counter()
+            run(col)
+            timings[name] = time.perf_counter() - start
+            counts[name] = col.count_documents({})
+            col.drop()
+    for name, secs in timings.items():
+        print(f"{name:>9}: {secs:.1f}s, {counts[name]} documents ({counts[name] / secs:,.0f} docs/s)")
+    saved = timings['two-stage'] - timings['fused']
+    print(f"Time saved: {saved:.1f}s ({saved / timings['two-stage']:.0%}), "
+          f"same document count: {counts['two-stage'] == counts['fused']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess raw URL feeds straight into MongoDB.')
+    parser.add_argument('--workers', type=int, default=1, help='parse chunks in N worker processes')
+    parser.add_argument('--writers', type=int, default=4, help='concurrent bulk writer threads')
+    parser.add_argument('--chunk-rows', type=int, default=preprocess.BATCH_ROWS)
+    parser.add_argument('--batch-size', type=int, default=ingest.BATCH_SIZE)
+    parser.add_argument('--audit', action='store_true',
+                        help=f'also write the records to {preprocess.OUTPATH}')
+    parser.add_argument('--dedup', action='store_true',
+                        help='key documents by a hash of their URL and upsert (see ingest.py)')
+    parser.add_argument('--overwrite-type', action='store_true',
+                        help='with --dedup, let a newer feed overwrite the stored type of an existing URL')
+    parser.add_argument('--compare', action='store_true',
+                        help='time the two-stage and fused runs on scratch collections instead of loading')
+    parser.add_argument('--geoip-db', default=geoip.GEOIP_DB)
+    parser.add_argument('--resolve', choices=geoip.RESOLVE_MODES, default='off')
+    args = parser.parse_args()
+    if args.overwrite_type and not args.dedup:
+        parser.error('--overwrite-type requires --dedup')
+    if args.writers < 1:
+        parser.error('--writers must be at least 1')
+
+    geoip.configure(args.geoip_db, args.resolve)
+    path = preprocess.detect_file()
+    print("Reading:", path)
+    client = MongoClient(ingest.MONGO_URI)
+    db = client[ingest.DB_NAME]
+
+    if args.compare:
+        compare(db, path, args.chunk_rows, args.batch_size, args.workers, args.writers)
+        return
+
+    col = db[ingest.COLL_NAME]
+    if args.audit and os.path.exists(preprocess.MANIFEST_PATH):
+        # The audit copy replaces processed_urls.json, so its --incremental checkpoint no longer holds
+        os.remove(preprocess.MANIFEST_PATH)
+    started = time.perf_counter()
+    stats = stream_ingest(col, path, args.chunk_rows, args.batch_size, args.workers, args.writers,
+                          args.dedup, args.overwrite_type, preprocess.OUTPATH if args.audit else None)
+    elapsed = time.perf_counter() - started
+    print("Rows read:", stats['read'])
+    print("After dropping empty URLs:", stats['kept'])
+    print(f"Inserted (approx): {stats['inserted']} documents into {ingest.DB_NAME}.{ingest.COLL_NAME}")
+    if args.dedup:
+        print(f"New URLs: {stats['new']}, relabelled: {stats['modified']}, "
+              f"unchanged: {stats['inserted'] - stats['new'] - stats['modified']}")
+    print(f"Throughput: {stats['inserted'] / elapsed:,.0f} docs/s over {elapsed:.1f}s")
+    if args.audit:
+        print("Audit copy saved to:", preprocess.OUTPATH)
+
+    ingest.create_indexes(col)
+    print("Done.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+time_windows.py
+Pre-aggregates URL counts into fixed time windows of the ingested_at stamp
+(one minute by default), per type, per tld and in total, into cyber_intel.url_windows:
+  {'_id': {'field': 'type', 'key': 'phishing', 'start_ms': 1767261900000},
+   'field': 'type', 'key': 'phishing', 'start': <datetime>, 'start_ms': ..., 'count': 12}
+Counts are added with $inc, so each run reads only the documents stamped since the
+last one (same settle window as mapreduce_queries.py). Documents without
+ingested_at have no time and are left out. burst_detect.py scores these series.
+"""
+
+import time
+import calendar
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+from pymongo import MongoClient, UpdateOne
+import mapreduce_queries
+
+MONGO_URI = "mongodb://localhost:27017/"
+DB_NAME = "cyber_intel"
+COLL_NAME = "urls"
+WINDOWS_COLL = "url_windows"
+WINDOW_SECONDS = 60
+WINDOW_FIELDS = ['type', 'tld']  # plus field 'all', key 'all' for the total
+EPOCH = datetime(1970, 1, 1)  # naive datetimes are UTC to the server
+
+client = MongoClient(MONGO_URI)
+db = client[DB_NAME]
+col = db[COLL_NAME]
+
+def to_ms(dt):
+    # Naive datetimes (as pymongo returns them) are UTC
+    return calendar.timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000
+
+def from_ms(ms):
+    return datetime.fromtimestamp(ms / 1000, timezone.utc)
+
+def window_pipeline(match, window_seconds=WINDOW_SECONDS):
+    width = window_seconds * 1000
+    return [
+        {"$match": match},
+        {"$match": {"ingested_at": {"$type": "date"}}},
+        {"$project": {"ms": {"$subtract": ["$ingested_at", EPOCH]},
+                      "type": {"$ifNull": ["$type", "unknown"]},
+                      "tld": {"$ifNull": ["$tld", "unknown"]}}},
+        {"$project": {"start_ms": {"$subtract": ["$ms", {"$mod": ["$ms", width]}]}, "type": 1, "tld": 1}},
+        {"$group": {"_id": {"start_ms": "$start_ms", "type": "$type", "tld": "$tld"}, "count": {"$sum": 1}}}
+    ]
+
+def window_counts(match, window_seconds=WINDOW_SECONDS):
+    """{(field, key, start_ms): count} for the documents matching `match`, from one $group pass."""
+    counts = defaultdict(int)
+    for row in col.aggregate(window_pipeline(match, window_seconds), allowDiskUse=True):
+        start = int(row['_id']['start_ms'])
+        counts[('all', 'all', start)] += row['count']
+        for field in WINDOW_FIELDS:
+            counts[(field, row['_id'][field], start)] += row['count']
+    return counts
+
+def merge_counts(counts):
+    requests = [UpdateOne({'_id': {'field': field, 'key': key, 'start_ms': start}},
+                          {'$inc': {'count': count},
+                           '$setOnInsert': {'field': field, 'key': key, 'start_ms': start,
+                                            'start': from_ms(start)}}, upsert=True)
+                for (field, key, start), count in counts.items()]
+    if requests:
+        db[WINDOWS_COLL].bulk_write(requests, ordered=False)
+
+def load_state():
+    return db[mapreduce_queries.STATE_COLL].find_one({'_id': 'time_windows'})
+
+def update(rebuild=False, window_seconds=WINDOW_SECONDS):
+    """Adds the documents stamped since the last run into their windows."""
+    state = None if rebuild else load_state()
+    if state and state.get('window_seconds') != window_seconds:
+        print("Window size changed; rebuilding")
+        state = None
+    upper = mapreduce_queries.settled_time()
+    if state is None:
+        db[WINDOWS_COLL].drop()
+        match = {'ingested_at': {'$lte': upper}}
+    else:
+        match = {'ingested_at': {'$gt': state['watermark'], '$lte': upper}}
+    start = time.perf_counter()
+    counts = window_counts(match, window_seconds)
+    merge_counts(counts)
+    db[WINDOWS_COLL].create_index([('field', 1), ('key', 1), ('start_ms', 1)])
+    db[mapreduce_queries.STATE_COLL].replace_one(
+        {'_id': 'time_windows'}, {'watermark': upper, 'window_seconds': window_seconds}, upsert=True)
+    print(f"Updated {len(counts)} window counts in {time.perf_counter() - start:.2f}s "
+          f"(up to {upper:%Y-%m-%d %H:%M:%S} UTC)")
+    return upper
+
+def closed_until():
+    # Windows ending at or before this (ms) hold all of their documents
+    state = load_state()
+    if state is None:
+        return None
+    width = state['window_seconds'] * 1000
+    wm = to_ms(state['watermark'])
+    return wm - wm % width
+
+def load_series(field, key, since_ms=None, until_ms=None):
+    """(start_ms array, count array) of one series, as stored (windows without URLs are absent)."""
+    query = {'field': field, 'key': key}
+    bounds = {}
+    if since_ms is not None:
+        bounds['$gte'] = since_ms
+    if until_ms is not None:
+        bounds['$lt'] = until_ms
+    if bounds:
+        query['start_ms'] = bounds
+    rows = list(db[WINDOWS_COLL].find(query, {'start_ms': 1, 'count': 1, '_id': 0}).sort('start_ms', 1))
+    return [r['start_ms'] for r in rows], [r['count'] for r in rows]
+
+def load_all_series(since_ms=None, until_ms=None):
+    """
+    {(field, key): (start_ms list, count list)} of every series in one aggregation,
+    each sorted by start_ms. A series of a year of minute windows is about 6 MB of
+    the 16 MB a grouped document may hold.
+    """
+    bounds = {}
+    if since_ms is not None:
+        bounds['$gte'] = since_ms
+    if until_ms is not None:
+        bounds['$lt'] = until_ms
+    pipeline = [{"$match": {'start_ms': bounds}}] if bounds else []
+    # The (field, key, start_ms) index serves the sort, and $push keeps its order
+    pipeline += [{"$sort": {'field': 1, 'key': 1, 'start_ms': 1}},
+                 {"$group": {"_id": {"field": "$field", "key": "$key"},
+                             "starts": {"$push": "$start_ms"}, "counts": {"$push": "$count"}}}]
+    return {(d['_id']['field'], d['_id']['key']): (d['starts'], d['counts'])
+            for d in db[WINDOWS_COLL].aggregate(pipeline, allowDiskUse=True)}
+
+def series_keys():
+    return [(d['_id']['field'], d['_id']['key']) for d in db[WINDOWS_COLL].aggregate(
+        [{"$group": {"_id": {"field": "$field", "key": "$key"}}}])]
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-aggregate URL counts into time windows.')
+    parser.add_argument('--rebuild', action='store_true', help='recount every window from scratch')
+    parser.add_argument('--window-seconds', type=int, default=WINDOW_SECONDS)
+    args = parser.parse_args()
+    update(args.rebuild, args.window_seconds)
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,22 @@
 visualize.py
 Pulls MapReduce result collections and produces PNGs for your report/ppt.
 Saves charts to report/images/
+With --source parquet the result collections are computed from the Parquet copy
+written by preprocess.py --parquet, without MongoDB.
 """
 
 import os
+import argparse
 from pymongo import MongoClient
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import plotly.express as px
 import plotly.graph_objects as go
+import columnar
+import histograms
+import heavy_hitters
+from mapreduce_queries import to_country_docs, add_distinct, distinct_domain_docs
 
 MONGO_URI = "mongodb://localhost:27017/"
 DB_NAME = "cyber_intel"
@@ -20,8 +27,48 @@ os.makedirs(OUT_DIR, exist_ok=True)
 client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 
+# Set by main() for --source parquet: result documents keyed by collection name
+parquet_results = None
+
+def find_results(name, sort_field=None, limit=0):
+    if parquet_results is None:
+        cur = db[name].find()
+        if sort_field:
+            cur = cur.sort(sort_field, -1)
+        return list(cur.limit(limit))
+    docs = parquet_results.get(name, [])
+    if sort_field:
+        docs = sorted(docs, key=lambda d: d[sort_field], reverse=True)
+    return docs[:limit] if limit else docs
+
+def compute_parquet_results():
+    # Same documents mapreduce_queries.py would store, built with pandas
+    df = columnar.load_records(['type', 'domain', 'tld', 'url_length', 'num_subdomains', 'threat_score', 'country'])
+    mal = df[df['type'] != 'benign']
+    scores = df.groupby('type')['threat_score'].agg(['mean', 'max'])
+    results = {
+        'counts_by_type': [{'_id': k, 'value': int(v)} for k, v in df.groupby('type').size().items()],
+        'mal_domains': [{'_id': k, 'value': int(v)} for k, v in mal.groupby('domain').size().items()],
+        'malicious_tld_counts': [{'_id': k, 'value': int(v)} for k, v in mal.groupby('tld').size().items()],
+        'threat_scores': [{'_id': k, 'avg_threat_score': r['mean'], 'max_threat_score': r['max']}
+                          for k, r in scores.iterrows()],
+        'country_counts': to_country_docs([{'_id': k, 'count': int(v)}
+                                           for k, v in mal.groupby('country').size().items()]),
+        'distinct_domains': parquet_distinct_domains(df),
+    }
+    for name, spec in histograms.HISTOGRAMS.items():
+        results[name] = histograms.frame_histogram(df, spec)
+    return results
+
+def parquet_distinct_domains(df):
+    # Repeats of a (domain, group) pair do not change a sketch, so sketch each pair once
+    sketches = {}
+    for row in df[['domain', 'type', 'tld', 'country']].drop_duplicates().to_dict('records'):
+        add_distinct(sketches, row)
+    return distinct_domain_docs(sketches)
+
 def plot_top_types(n=10):
-    cur = db['counts_by_type'].find().sort('value', -1).limit(n)
+    cur = find_results('counts_by_type', 'value', n)
     rows = [(d['_id'], d['value']) for d in cur]
     if not rows:
         print("No data in counts_by_type. Run mapreduce_queries.py first.")
@@ -39,15 +86,18 @@ def plot_top_types(n=10):
     print("Saved:", out)
 
 def plot_top_mal_domains(n=15):
-    cur = db['mal_domains'].find().sort('value', -1).limit(n)
-    rows = [(d['_id'], d['value']) for d in cur]
+    # Space-Saving summary (heavy_hitters.py); the exact counts until one is stored
+    top, bound = heavy_hitters.top_k('mal_domains', n) if parquet_results is None else ([], 0)
+    rows = [(r['item'], r['count']) for r in top]
+    if not rows:
+        rows = [(d['_id'], d['value']) for d in find_results('mal_domains', 'value', n)]
     if not rows:
         print("No data in mal_domains. Run mapreduce_queries.py first.")
         return
     df = pd.DataFrame(rows, columns=['domain','count'])
     df.set_index('domain', inplace=True)
     ax = df.plot(kind='bar', legend=False, figsize=(12,6))
-    ax.set_title('Top Malicious Domains')
+    ax.set_title('Top Malicious Domains' + (f' (counts high by at most {bound:,.0f})' if bound else ''))
     ax.set_ylabel('Count')
     plt.xticks(rotation=45, ha='right')
     plt.tight_layout()
@@ -57,7 +107,7 @@ def plot_top_mal_domains(n=15):
     print("Saved:", out)
 
 def plot_tld_distribution(n=20):
-    cur = db['malicious_tld_counts'].find().sort('value', -1).limit(n)
+    cur = find_results('malicious_tld_counts', 'value', n)
     rows = [(d['_id'], d['value']) for d in cur]
     if not rows:
         print("No data in malicious_tld_counts. Run mapreduce_queries.py first.")
@@ -71,8 +121,51 @@ def plot_tld_distribution(n=20):
     plt.close()
     print("Saved:", out)
 
+def plot_distinct_domains(n=15):
+    docs = find_results('distinct_domains', 'estimate')
+    if not docs:
+        print("No data in distinct_domains. Run mapreduce_queries.py first.")
+        return
+    fig, axes = plt.subplots(1, 2, figsize=(14, 6))
+    for ax, field in zip(axes, ['type', 'tld']):
+        rows = [(str(d['value']), d['estimate']) for d in docs if d['field'] == field][:n]
+        df = pd.DataFrame(rows, columns=[field, 'domains']).set_index(field)
+        df.plot(kind='bar', legend=False, ax=ax)
+        ax.set_title(f'Distinct Domains by {field.upper() if field == "tld" else field.title()} (~1.6% error)')
+        ax.set_ylabel('Distinct domains')
+        ax.tick_params(axis='x', rotation=45)
+    plt.tight_layout()
+    out = os.path.join(OUT_DIR, 'distinct_domains.png')
+    plt.savefig(out)
+    plt.close()
+    print("Saved:", out)
+
+def plot_histogram(name='url_length_by_type', title='URL Length by Type', max_width=None):
+    # Stored numeric bins drawn at their real widths, one series per key;
+    # max_width merges fixed-width bins into wider ones first
+    docs = sorted(find_results(name), key=lambda d: (str(d['key']), d['lower']))
+    if not docs:
+        print(f"No data in {name}. Run mapreduce_queries.py first.")
+        return
+    if max_width:
+        docs = histograms.rebin(docs, max_width)
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for key in sorted({str(d['key']) for d in docs}):
+        bins = [d for d in docs if str(d['key']) == key]
+        ax.bar([b['lower'] for b in bins], [b['value'] for b in bins],
+               width=[b['upper'] - b['lower'] for b in bins], align='edge', alpha=0.5, label=key)
+    ax.set_title(title)
+    ax.set_xlabel(histograms.HISTOGRAMS[name]['field'])
+    ax.set_ylabel('URLs')
+    ax.legend()
+    plt.tight_layout()
+    out = os.path.join(OUT_DIR, f'{name}.png')
+    plt.savefig(out)
+    plt.close()
+    print("Saved:", out)
+
 def plot_threat_scores():
-    cur = db['threat_scores'].find()
+    cur = find_results('threat_scores')
     rows = [(d['_id'], d['avg_threat_score']) for d in cur]
     if not rows:
         print("No data in threat_scores.")
@@ -91,7 +184,7 @@ def plot_threat_scores():
 
 def plot_country_map():
     # Get country data
-    cur = db['country_counts'].find()
+    cur = find_results('country_counts')
     rows = [(d['_id'], d.get('count', 0), d.get('country_name', '')) for d in cur]
     if not rows:
         print("No data in country_counts.")
@@ -198,10 +291,21 @@ def plot_country_map():
     print("Saved:", out)
 
 def main():
+    global parquet_results
+    parser = argparse.ArgumentParser(description='Plot aggregation results.')
+    parser.add_argument('--source', choices=['mongo', 'parquet'], default='mongo',
+                        help='read result collections from MongoDB or compute them from the Parquet copy')
+    args = parser.parse_args()
+    if args.source == 'parquet':
+        parquet_results = compute_parquet_results()
+
     plot_top_types()
     plot_top_mal_domains()
     plot_tld_distribution()
     plot_threat_scores()
+    plot_distinct_domains()
+    plot_histogram('url_length_by_type', 'URL Length by Type', max_width=100)
+    plot_histogram('threat_score_hist', 'Threat Score Distribution')
     plot_country_map()
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+"""
+conftest.py
+Puts src/ on the import path and points every module's MongoClient at one in-memory
+mongomock client, so the tests run without a MongoDB server.
+
+Needs the packages in requirements-dev.txt (pip install -r requirements-dev.txt); the
+modules create their clients at import time, so the patch has to come before any of
+them is imported.
+"""
+
+import os
+import sys
+import pytest
+import mongomock
+import mongomock.collection
+import pymongo
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+client = mongomock.MongoClient()
+pymongo.MongoClient = lambda *args, **kwargs: client
+
+# pymongo's UpdateOne passes sort= to the bulk builder, which mongomock does not take
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+def _add_update_without_sort(self, *args, sort=None, **kwargs):
+    return _add_update(self, *args, **kwargs)
+
+mongomock.collection.BulkOperationBuilder.add_update = _add_update_without_sort
+
+@pytest.fixture
+def mongo():
+    """The mongomock database every module writes to, emptied after each test."""
+    yield client['cyber_intel']
+    client.drop_database('cyber_intel')
@@ -0,0 +1,57 @@
+import random
+import numpy as np
+import pandas as pd
+import pytest
+import features
+
+ALPHABETS = ['abcdefghijklmnopqrstuvwxyz0123456789-.', 'aab', 'äöüßéñ', 'пример', '例子测试中文', '😀🔒x']
+
+def synthetic_frame(rows=5000, seed=3):
+    rng = random.Random(seed)
+    domains = []
+    for _ in range(rows // 4):
+        alphabet = rng.choice(ALPHABETS)
+        domains.append(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 70))) + rng.choice(['.com', '.рф', '']))
+    domains += ['', 'a', 'aaaa', 'ab' * 100, 'x' * 300]
+    picked = [rng.choice(domains) for _ in range(rows)]
+    urls = [f"http://{d}/{rng.choice(['', 'login', 'Secure/Bank', 'PayPal?x=1', 'home'])}" for d in picked]
+    return pd.DataFrame({'domain': picked, 'url': urls})
+
+@pytest.fixture(autouse=True)
+def cold_cache():
+    features._cache.clear()
+    yield
+    features._cache.clear()
+
+def assert_same_features(df):
+    fast = features.derived_features(df.copy())
+    ref = features.reference_features(df.copy())
+    for column in ['domain_length', 'has_suspicious_words']:
+        assert fast[column].tolist() == ref[column].tolist()
+    np.testing.assert_allclose(fast['entropy'].to_numpy(), ref['entropy'].to_numpy(), rtol=0, atol=features.TOLERANCE)
+
+def test_matches_reference_on_synthetic_frame():
+    assert_same_features(synthetic_frame())
+
+def test_matches_reference_with_warm_cache():
+    df = synthetic_frame()
+    features.derived_features(df.head(1000).copy())
+    assert_same_features(df)
+
+def test_small_chunks_match(monkeypatch):
+    # Many code point matrices of mixed widths instead of one
+    monkeypatch.setattr(features, 'CHUNK_ROWS', 7)
+    monkeypatch.setattr(features, 'CHUNK_CELLS', 64)
+    assert_same_features(synthetic_frame(800))
+
+def test_non_ascii_entropy():
+    lengths, entropy = features.domain_stats(['例子例子', 'äb', '😀😀😀😀', 'aabb'])
+    assert lengths.tolist() == [4, 2, 4, 4]
+    np.testing.assert_allclose(entropy, [1.0, 1.0, 0.0, 1.0], atol=features.TOLERANCE)
+
+def test_missing_domains_are_zero():
+    length, entropy = features.domain_features(pd.Series(['abc', None, np.nan, 'abc'], dtype=object))
+    assert length.tolist() == [3, 0, 0, 3]
+    assert entropy[1] == entropy[2] == 0.0
+    length, entropy = features.domain_features(pd.Series([], dtype=object))
+    assert len(length) == len(entropy) == 0
@@ -0,0 +1,54 @@
+import pytest
+import geoip
+
+mmdb_writer = pytest.importorskip('mmdb_writer')
+netaddr = pytest.importorskip('netaddr')
+pytest.importorskip('maxminddb')
+
+NETWORKS = {
+    '1.2.3.0/24': {'country': {'iso_code': 'AU', 'names': {'en': 'Australia'}}},
+    '5.6.0.0/16': {'registered_country': {'iso_code': 'DE', 'names': {'en': 'Germany'}}},
+    '9.9.9.0/24': {'continent': {'code': 'EU'}},
+}
+
+@pytest.fixture
+def country_db(tmp_path):
+    """A small GeoLite2-Country style database, written with mmdb_writer."""
+    writer = mmdb_writer.MMDBWriter(4, 'GeoLite2-Country', languages=['en'])
+    for network, record in NETWORKS.items():
+        writer.insert_network(netaddr.IPSet([network]), record)
+    path = str(tmp_path / 'country.mmdb')
+    writer.to_db_file(path)
+    geoip.configure(path)
+    yield path
+    geoip.configure()
+
+def test_ip_literals(country_db):
+    assert geoip.enabled()
+    assert geoip.country_of('1.2.3.4') == 'Australia'
+    # falls back to the registered country
+    assert geoip.country_of('5.6.7.8') == 'Germany'
+    # in the database without a country, and not in it at all
+    assert geoip.country_of('9.9.9.9') == 'Unknown'
+    assert geoip.country_of('8.8.8.8') == 'Unknown'
+
+def test_names_need_a_resolve_mode(country_db, monkeypatch):
+    monkeypatch.setattr(geoip, 'load_resolver_cache', lambda: {'au.example': '1.2.3.10', 'gone.example': ''})
+    assert geoip.country_of('au.example') == 'Unknown'
+    geoip.configure(country_db, 'cache')
+    assert geoip.country_of('au.example') == 'Australia'
+    # a failed lookup recorded in the cache, and a name the cache has never seen
+    assert geoip.country_of('gone.example') == 'Unknown'
+    assert geoip.country_of('new.example') == 'Unknown'
+
+def test_lookup_countries_keeps_order(country_db):
+    assert geoip.lookup_countries(['5.6.0.1', '1.2.3.4', 'example.com', '5.6.0.1']) == \
+        ['Germany', 'Australia', 'Unknown', 'Germany']
+
+def test_without_database(tmp_path):
+    geoip.configure(str(tmp_path / 'missing.mmdb'))
+    try:
+        assert not geoip.enabled()
+        assert geoip.country_of('1.2.3.4') == 'Unknown'
+    finally:
+        geoip.configure()
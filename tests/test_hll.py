@@ -0,0 +1,45 @@
+import math
+import random
+import pytest
+import hll
+
+def sketch(items, p=hll.P):
+    h = hll.HyperLogLog(p)
+    for item in items:
+        h.add(item)
+    return h
+
+@pytest.mark.parametrize('p', [10, 12, 14])
+@pytest.mark.parametrize('n', [100, 5000, 200000])
+def test_relative_error_within_three_standard_errors(p, n):
+    salt = random.Random(n * p).getrandbits(64)
+    h = sketch((f"{salt}-{i}.example" for i in range(n)), p)
+    assert abs(h.count() - n) / n <= 3 * 1.04 / math.sqrt(1 << p)
+
+def test_error_spread_matches_the_standard_error():
+    # Over many sketches the spread of the error should be close to 1.04 / sqrt(m)
+    p, n, trials = 10, 20000, 40
+    rng = random.Random(7)
+    errors = []
+    for _ in range(trials):
+        salt = rng.getrandbits(64)
+        errors.append((sketch((f"{salt}-{i}" for i in range(n)), p).count() - n) / n)
+    rms = math.sqrt(sum(e * e for e in errors) / trials)
+    assert rms <= 1.5 * hll.HyperLogLog(p).relative_error()
+
+def test_duplicates_do_not_count():
+    h = sketch([f"d{i % 1000}" for i in range(50000)])
+    assert abs(h.count() - 1000) / 1000 <= 3 * h.relative_error()
+
+def test_merge_equals_sketch_of_union():
+    items = [f"{i}.example" for i in range(30000)]
+    left, right = sketch(items[::2]), sketch(items[1::2])
+    assert left.merge(right).registers == sketch(items).registers
+
+def test_round_trip_and_precision_checks():
+    h = sketch(['a', 'b', 'c'])
+    assert hll.HyperLogLog.from_bytes(h.to_bytes()).count() == h.count() == 3
+    with pytest.raises(ValueError):
+        hll.HyperLogLog(12).merge(hll.HyperLogLog(10))
+    with pytest.raises(ValueError):
+        hll.HyperLogLog.from_bytes(b'\0' * 10)
@@ -0,0 +1,118 @@
+import re
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+import ml_predict
+import realtime
+
+class AsyncCollection:
+    """The few AsyncCollection methods ScoringConsumer uses, over a mongomock collection."""
+
+    def __init__(self, coll):
+        self.coll = coll
+        self.bulk_writes = []
+
+    async def bulk_write(self, requests, ordered=True):
+        self.bulk_writes.append(len(requests))
+        return self.coll.bulk_write(requests, ordered=ordered)
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.coll.find(*args, **kwargs))
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = iter(cursor)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+@pytest.fixture(autouse=True)
+def model(monkeypatch):
+    # Every URL is 'phishing'; the tests are about batching, not the model
+    monkeypatch.setattr(ml_predict, 'predict_batch', lambda bundle, docs: (['phishing'] * len(docs), [0.9] * len(docs)))
+
+def make_events(mongo, n, ages_ms=None):
+    now = datetime.now(timezone.utc)
+    docs = [{'_id': f'doc-{i}', 'url': f'http://site{i}.example/login', 'domain': f'site{i}.example'}
+            for i in range(n)]
+    mongo.urls.insert_many(docs)
+    ages_ms = ages_ms or [0] * n
+    return [{'_id': {'_data': f'{i:08d}'}, 'operationType': 'insert', 'fullDocument': doc,
+             'wallTime': now - timedelta(milliseconds=age)} for i, (doc, age) in enumerate(zip(docs, ages_ms))]
+
+def make_consumer(mongo, **kwargs):
+    return realtime.ScoringConsumer(object(), AsyncCollection(mongo.urls), AsyncCollection(mongo.predicted_counts),
+                                    verbose=False, summaries=False, **kwargs)
+
+def test_flushes_at_batch_size(mongo):
+    consumer = make_consumer(mongo, batch_size=4, max_latency_ms=60000)
+
+    async def run():
+        for event in make_events(mongo, 10):
+            await consumer.add(event)
+        await asyncio.gather(*consumer.writes)
+        full = list(consumer.urls.bulk_writes)
+        await consumer.close()
+        return full
+
+    assert asyncio.run(run()) == [4, 4]
+    # close() flushes the partial batch
+    assert consumer.urls.bulk_writes == [4, 4, 2]
+    assert mongo.urls.count_documents({'predicted_type': 'phishing'}) == 10
+
+def test_flushes_partial_batch_at_deadline(mongo):
+    consumer = make_consumer(mongo, batch_size=100, max_latency_ms=20)
+
+    async def run():
+        for event in make_events(mongo, 3):
+            await consumer.add(event)
+        await consumer.poll()
+        before = list(consumer.urls.bulk_writes)
+        await asyncio.sleep(0.03)
+        await consumer.poll()
+        await asyncio.gather(*consumer.writes)
+        return before
+
+    assert asyncio.run(run()) == []
+    assert consumer.urls.bulk_writes == [3]
+    assert consumer.batches == 1
+
+def test_one_bulk_update_per_batch(mongo):
+    consumer = make_consumer(mongo, batch_size=8, max_latency_ms=60000)
+
+    async def run():
+        for event in make_events(mongo, 24):
+            await consumer.add(event)
+        await consumer.close()
+
+    asyncio.run(run())
+    assert consumer.urls.bulk_writes == [8, 8, 8]
+    # and one $inc per batch for its verdicts
+    assert consumer.counts.bulk_writes == [1, 1, 1]
+    assert mongo.predicted_counts.find_one({'_id': 'phishing'})['value'] == 24
+
+def test_report_prints_latency_percentiles(mongo, capsys):
+    # Events inserted 0, 10, ..., 990 ms before they are consumed
+    consumer = make_consumer(mongo, batch_size=25, max_latency_ms=60000)
+
+    async def run():
+        for event in make_events(mongo, 100, ages_ms=[10 * i for i in range(100)]):
+            await consumer.add(event)
+        await consumer.close()
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    slack = (time.perf_counter() - start) * 1000
+    consumer.report()
+    out = capsys.readouterr().out
+    p50, p99 = (float(x) for x in re.search(r'p50 ([\d.]+) ms, p99 ([\d.]+) ms', out).groups())
+    assert '100 events in 4 batches' in out
+    assert 495 <= p50 <= 495 + slack
+    assert 980 <= p99 <= 981 + slack